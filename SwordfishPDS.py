@@ -1,27 +1,81 @@
 #!/usr/bin/env python3
 import atexit
-import csv
+import collections
+import contextlib
+import contextvars
+import hashlib
 import http.client
-import http.cookiejar
+import itertools
+import json
+import math
 import os
 import queue
+import random
+import select
+import shutil
 import socket
 import sys
-import tempfile
 import threading
 import time
 import urllib.parse
-import urllib.request
-import zipfile
+import zlib
+# csv, email.utils, http.cookiejar, tempfile, urllib.request and zipfile are imported by whatever needs them, so that a
+# launcher importing us doesn't pay for modules an install that's already up to date never touches.
 
-ZIP_THREADS = 5
-THREADS = 3
+MAX_TRANSFERS = 16  # most downloads in flight at once, across every host; the scheduler works out how many help
+START_TRANSFERS = 4  # how many it starts out with
+TUNE_INTERVAL = 1.0  # seconds between the scheduler's looks at how fast things are going
+PROBE_SIZES = True  # HEAD files we don't know the size of, so the biggest downloads can be started first
+MAX_PER_HOST = 8  # connections open to any one host at once
+SOCKET_TIMEOUT = 60
+CHUNK_THRESHOLD = 16 * 1024 ** 2  # files at least this big get downloaded in parallel chunks...
+CHUNKS = 4  # ...this many of them
+FULL_EXTRACT = False  # extract every file from Zipfiles, not just the ones that changed
+USER_AGENT = 'SwordfishPDS-1.0'
 SERVER_MODE = False  # set to True by __main__
 NO_COOKIE = False  # ditto
+NO_CACHE = False  # ditto
+CACHE_DIR = None  # None means default_cache_dir()
+CACHE_MAX_SIZE = 4 * 1024 ** 3  # bytes; least recently used files get evicted past this
+COOKIE_JAR = None  # set by init_cookies()
+MIRROR = None  # --mirror=: base URL of a LAN mirror to try before upstream; otherwise the pack server's, if it has one
+NO_MIRROR = False  # ignore the mirror the pack server advertises
+DELTAS = None  # base URL of make_delta.py's deltas; otherwise the pack server's (see Installer.take_extras())
+NO_DELTAS = False  # --no-deltas: download updated files whole even if there are deltas to patch them with
+TRACE_FILE = None  # --trace=FILE: where run() saves a Chrome trace of everything it did
+PROGRESS_JSON = None  # --progress-json=PATH: where run() writes progress events, one JSON object per line
+ZERO_COPY = True  # splice plain HTTP downloads straight from the socket to the file, where the OS can
+COPY_BUFFER_SIZE = 256 * 1024  # per thread, for downloads that can't be spliced (TLS, mostly)
+RETRIES = 4  # --retries=: times a download that failed for a reason that might go away gets another go
+RETRY_DELAY = 1.0  # seconds, roughly, before the first retry; each one after waits about twice as long...
+RETRY_MAX_DELAY = 30.0  # ...up to this.  A server asking (with Retry-After) for longer than this gets failed instead.
+BREAKER_THRESHOLD = 5  # requests to a host that fail in a row before we give it a rest...
+BREAKER_COOLDOWN = 10.0  # ...of this many seconds
+BREAKER_GIVE_UP = 3  # times in a row a host can fail the request that ends its rest before we give up on it for good
+HEDGE = True  # race a duplicate from another origin against downloads that are going slowly; --no-hedge turns it off
+HEDGE_PERCENTILE = 95  # slow means a first byte later than this percentile of the origin's, or a rate under 100 - it
+HEDGE_DELAY = 2.0  # seconds without a first byte that count as slow, for origins we don't know enough about yet
+HEDGE_MIN_DELAY = 0.2  # never hedge sooner than this, however quick the origin usually is
+HEDGE_GRACE = 1.0  # seconds of a download's body before we judge its rate
+ORIGIN_SAMPLES = 100  # times to first byte and transfer rates remembered per origin
+SURPLUS = None  # --surplus=: what to do about mods the pack doesn't list (one of SURPLUS_CHOICES), rather than ask
+SURPLUS_CHOICES = ('leave', 'disable', 'delete')
+WATCH_TIMEOUT = 120  # seconds a --daemon goes without hearing from the pack server before reconnecting
+RECONNECT_DELAY = 10  # seconds a --daemon waits before reconnecting
+# The Tracer (if TRACE_FILE is set) and the Progress of the run() going on.  Context variables rather than globals, so
+# that runs going on in different threads at once each see their own; the threads a run starts get its context with
+# spawn().
+_tracer = contextvars.ContextVar('tracer', default=None)
+_progress = contextvars.ContextVar('progress', default=None)
+_output = contextvars.ContextVar('output', default=None)  # see output()
+PROTOCOL = 'SWORDFISHPDS/2'  # what we speak to server.py, on top of the original just-send-me-the-pack exchange
 
 
 def init_cookies():
-    cookiejar = http.cookiejar.MozillaCookieJar('_swordfishpds_cookies.txt')
+    import http.cookiejar
+    import urllib.request
+    global COOKIE_JAR
+    cookiejar = COOKIE_JAR = http.cookiejar.MozillaCookieJar('_swordfishpds_cookies.txt')
     try:
         cookiejar.load()
     except (FileNotFoundError, http.cookiejar.LoadError):
@@ -32,279 +86,3250 @@ def init_cookies():
     opener.add_handler(urllib.request.HTTPCookieProcessor(cookiejar))
     urllib.request.install_opener(opener)
 
-# This global variable becomes true when we are done prompting the user about things,
-# and other threads are now free to start writing to stdout.
-allow_other_threads_to_print = False
+#######################################################
+#######               TRACING                 #########
+#######################################################
+
+class Tracer:
+    def __init__(self):
+        """
+        Records how long everything in a run() took -- each request broken down into waiting for a connection, DNS,
+        TCP, TLS, time to first byte and reading the body, plus downloads, extraction and so on -- as Chrome trace
+        events (load the saved file in chrome://tracing or ui.perfetto.dev), and sums it up per host and file.
+        """
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.events = []
+        self.requests = []  # the trace dict of every finished request
+        self.threads = set()
+
+    def _us(self, t):
+        return round((t - self.origin) * 1e6, 1)
+
+    def add(self, name, cat, start, end, args=None):
+        tid = threading.get_ident()
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': 1, 'tid': tid, 'ts': self._us(start),
+                 'dur': round((end - start) * 1e6, 1)}
+        if args:
+            event['args'] = args
+        with self.lock:
+            if tid not in self.threads:
+                self.threads.add(tid)
+                self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                                    'args': {'name': threading.current_thread().name}})
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, cat, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, cat, start, time.perf_counter(), args)
+
+    def request_started(self, method, url):
+        """A dict for ConnectionPool to fill in as the request goes, then hand to request_done()."""
+        return {'method': method, 'url': url, 'host': urllib.parse.urlsplit(url).netloc, 'start': time.perf_counter(),
+                'phases': [], 'retries': 0, 'status': None, 'bytes': 0, 'disk': 0.0}
+
+    def request_done(self, trace):
+        end = time.perf_counter()
+        trace['end'] = end
+        for name, start, stop in trace['phases']:
+            self.add(name, 'http', start, stop)
+        if trace['phases']:
+            # Everything after the headers arrived was reading the body (and whatever the caller did with it).
+            self.add('body', 'http', trace['phases'][-1][2], end, {'bytes': trace['bytes'],
+                                                                   'disk_ms': round(trace['disk'] * 1000, 1)})
+        self.add('%s %s' % (trace['method'], trace['url']), 'request', trace['start'], end,
+                 {'status': trace['status'], 'bytes': trace['bytes'], 'retries': trace['retries']})
+        with self.lock:
+            self.requests.append(trace)
+
+    def save(self, path):
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self, top=10):
+        """The slowest hosts and files, as lines of text."""
+        hosts = {}
+        for trace in self.requests:
+            host = hosts.setdefault(trace['host'], {'requests': 0, 'bytes': 0, 'time': 0.0, 'ttfb': 0.0})
+            host['requests'] += 1
+            host['bytes'] += trace['bytes']
+            host['time'] += trace['end'] - trace['start']
+            host['ttfb'] += sum(stop - start for name, start, stop in trace['phases'] if name == 'ttfb')
+        lines = ['%-40s %8s %12s %9s %10s %8s' % ('host', 'requests', 'bytes', 'time (s)', 'TTFB (ms)', 'MB/s')]
+        for name, host in sorted(hosts.items(), key=lambda item: -item[1]['time'])[:top]:
+            lines.append('%-40s %8d %12d %9.2f %10.1f %8.2f' % (
+                name[:40], host['requests'], host['bytes'], host['time'], host['ttfb'] / host['requests'] * 1000,
+                host['bytes'] / host['time'] / 1024 ** 2 if host['time'] else 0))
+        with self.lock:
+            files = [event for event in self.events if event.get('cat') == 'file']
+        lines.append('')
+        lines.append('%-60s %9s %12s' % ('file', 'time (s)', 'bytes'))
+        for event in sorted(files, key=lambda event: -event['dur'])[:top]:
+            lines.append('%-60s %9.2f %12s' % (event['name'][:60], event['dur'] / 1e6,
+                                                event.get('args', {}).get('size') or ''))
+        return lines
+
+
+_NOT_TRACING = contextlib.nullcontext()
+
+
+def trace(name, cat, **args):
+    """with trace(...): records how long the block took, if we're tracing.  Otherwise does nothing, cheaply."""
+    tracer = _tracer.get()
+    if tracer is None:
+        return _NOT_TRACING
+    return tracer.span(name, cat, **args)
+
+
+def trace_span(name, cat, start, **args):
+    """Record something that ran from start (a perf_counter() time) until now, if we're tracing."""
+    tracer = _tracer.get()
+    if tracer is not None:
+        tracer.add(name, cat, start, time.perf_counter(), args)
+
+
+def _traced_connect(conn, phases):
+    # Connect conn now rather than letting its first request do it, timing the DNS lookup and the TCP handshake by
+    # standing in for the socket.create_connection() it connects with.  Whatever connect() spends after that is TLS.
+    def create_connection(address, *args):
+        start = time.perf_counter()
+        infos = socket.getaddrinfo(address[0], address[1], 0, socket.SOCK_STREAM)
+        resolved = time.perf_counter()
+        phases.append(('dns', start, resolved))
+        error = None
+        for family, type, proto, canonname, sockaddr in infos:
+            try:
+                sock = socket.create_connection(sockaddr[:2], *args)
+            except OSError as e:
+                error = e
+                continue
+            phases.append(('tcp', resolved, time.perf_counter()))
+            return sock
+        raise error or OSError('no addresses for %s' % address[0])
+
+    conn._create_connection = create_connection
+    conn.connect()
+    if isinstance(conn, http.client.HTTPSConnection):
+        phases.append(('tls', phases[-1][2], time.perf_counter()))
+
+
+#######################################################
+#######               PROGRESS                #########
+#######################################################
+
+class Progress:
+    def __init__(self, stream, events=None, interval=0.5):
+        """
+        Keeps track of every download in a run() -- bytes planned and done, files planned and done, how fast it's
+        going, how long it's got left and how much each Downloader has queued -- and reports it.  On a terminal that's
+        one status line kept at the bottom of the screen (see start()); anywhere else, a plain line every few
+        seconds.
+
+        :param stream: Where to report to, normally sys.stdout.
+        :param events: Text file to also write newline delimited JSON events to, or None.
+        """
+        self.stream = stream
+        self.events = events
+        self.interval = interval
+        self.tty = stream.isatty()
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.started = time.perf_counter()
+        self.bytes_planned = 0
+        self.bytes_done = 0
+        self.files_planned = 0
+        self.files_done = 0
+        self.failed = 0
+        self.queued_by = {}  # Downloader tag -> jobs queued but not started
+        self.active = set()
+        self.samples = collections.deque(maxlen=10)  # (time, bytes_done), for the recent transfer rate
+        self.shown = 0  # length of the status line on screen, 0 if there isn't one
+        self.at_line_start = True
+        self.last_plain = self.started
+        self.stopping = threading.Event()
+        self.thread = None
+        self.output = stream  # what to print through while we're reporting: see start()
+
+    # -- what the downloaders tell us --
+
+    def queued(self, tag, size=None):
+        with self.lock:
+            self.files_planned += 1
+            self.bytes_planned += size or 0
+            self.queued_by[tag] = self.queued_by.get(tag, 0) + 1
+
+    def expect(self, size):
+        """A queued job we didn't know the size of turns out to be size bytes."""
+        with self.lock:
+            self.bytes_planned += size
+
+    def begin(self, tag, name, size=None):
+        """A queued job has started, on this thread.  Returns the job, for advance() from other threads."""
+        job = {'downloader': tag, 'file': name, 'size': size or 0, 'done': 0}
+        with self.lock:
+            self.queued_by[tag] -= 1
+            self.active.add(id(job))
+        self.local.job = job
+        self.event('start', downloader=tag, file=name, size=size)
+        return job
+
+    def current(self):
+        """The job running on this thread, if any."""
+        return getattr(self.local, 'job', None)
+
+    def sized(self, size, job=None):
+        """Now we know how many bytes job (default: this thread's) has to transfer."""
+        job = job or self.current()
+        if job is None:
+            return
+        with self.lock:
+            self.bytes_planned += size - job['size']
+            job['size'] = size
+
+    def advance(self, n, job=None):
+        job = job or self.current()
+        with self.lock:
+            self.bytes_done += n
+            if job is not None:
+                job['done'] += n
+
+    def retry(self, job):
+        """job failed, but is going back in the queue to be tried again."""
+        with self.lock:
+            # What it got through still counts as done; the next attempt plans for the whole file again, and says so
+            # with sized() if it resumes rather than starting over.
+            self.bytes_planned += job['done']
+            self.queued_by[job['downloader']] = self.queued_by.get(job['downloader'], 0) + 1
+            self.active.discard(id(job))
+        self.local.job = None
+        self.event('retry', downloader=job['downloader'], file=job['file'], bytes=job['done'])
+
+    def follow(self, job):
+        """Count what this thread transfers towards job, which started on another one."""
+        self.local.job = job
+
+    def hedge(self, job):
+        """
+        A duplicate of job has started on this thread, from another origin.  Returns a job of its own for the
+        duplicate's bytes, which end_hedge() once it's finished, won or lost.
+        """
+        hedge = {'downloader': job['downloader'], 'file': job['file'], 'size': job['size'], 'done': 0}
+        with self.lock:
+            self.bytes_planned += hedge['size']
+        self.local.job = hedge
+        self.event('hedge', downloader=job['downloader'], file=job['file'])
+        return hedge
+
+    def end_hedge(self, hedge):
+        with self.lock:
+            self.bytes_planned += hedge['done'] - hedge['size']
+
+    def end(self, job, ok=True):
+        with self.lock:
+            # Whatever we guessed the size was, it's what we actually transferred now.
+            self.bytes_planned += job['done'] - job['size']
+            self.files_done += 1
+            self.failed += not ok
+            self.active.discard(id(job))
+        self.local.job = None
+        self.event('done', downloader=job['downloader'], file=job['file'], ok=ok, bytes=job['done'])
+
+    # -- reporting --
+
+    def status(self, sample=True):
+        with self.lock:
+            now = time.perf_counter()
+            if sample:
+                self.samples.append((now, self.bytes_done))
+            then, before = self.samples[0] if self.samples else (now, self.bytes_done)
+            rate = (self.bytes_done - before) / (now - then) if now > then else 0
+            left = max(self.bytes_planned - self.bytes_done, 0)
+            return {'bytes_done': self.bytes_done, 'bytes_planned': self.bytes_planned,
+                    'files_done': self.files_done, 'files_planned': self.files_planned, 'failed': self.failed,
+                    'rate': round(rate), 'eta': round(left / rate, 1) if rate else None,
+                    'queued': {tag: n for tag, n in self.queued_by.items() if n}}
+
+    def line(self, status):
+        planned = max(status['bytes_planned'], status['bytes_done'])
+        parts = ['%3d%%' % (status['bytes_done'] * 100 // planned if planned else 0),
+                 '%s of %s' % (format_bytes(status['bytes_done']), format_bytes(planned)),
+                 '%s/s' % format_bytes(status['rate'])]
+        if status['eta'] is not None:
+            parts.append('ETA %d:%02d' % divmod(int(status['eta']), 60))
+        parts.append('%d/%d files' % (status['files_done'], status['files_planned']))
+        if status['failed']:
+            parts.append('%d failed' % status['failed'])
+        if status['queued']:
+            parts.append('queued: ' + ', '.join('%s %d' % item for item in status['queued'].items()))
+        return '  '.join(parts)
+
+    def event(self, event, **fields):
+        if self.events is None:
+            return
+        fields['event'] = event
+        fields['t'] = round(time.perf_counter() - self.started, 3)
+        with self.lock:
+            self.events.write(json.dumps(fields) + '\n')
+            self.events.flush()
+
+    def _clear(self):
+        # Called with the lock held.
+        if self.shown:
+            self.stream.write('\r' + ' ' * self.shown + '\r')
+            self.shown = 0
+
+    def _draw(self, status):
+        # Called with the lock held.
+        if not status['files_planned']:
+            return
+        line = self.line(status)[:shutil.get_terminal_size().columns - 1]
+        self.stream.write('\r' + line + ' ' * max(self.shown - len(line), 0))
+        self.stream.flush()
+        self.shown = len(line)
+
+    def write(self, text):
+        # Everything printed through our output goes through here, so it can go above the status line.
+        with self.lock:
+            self._clear()
+            self.stream.write(text)
+            if text:
+                self.at_line_start = text.endswith('\n')
+            if self.at_line_start and self.thread is not None:
+                self._draw(self.status(sample=False))
+
+    def _report(self):
+        while not self.stopping.wait(self.interval):
+            status = self.status()
+            self.event('progress', **status)
+            with self.lock:
+                if self.tty:
+                    if self.at_line_start:
+                        self._draw(status)
+                elif self.active and time.perf_counter() >= self.last_plain + 5:
+                    self.stream.write(self.line(status) + '\n')
+                    self.last_plain = time.perf_counter()
+
+    def start(self):
+        """
+        Start reporting.  On a terminal, whatever is written to output from now on lands above the status line rather
+        than on top of it, so run() makes output what output() returns for as long as it's going.
+        """
+        if self.tty:
+            self.output = _StatusLineStream(self)
+        self.thread = threading.Thread(target=self._report, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop reporting, and leave the final tally behind.  Safe to call more than once."""
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        status = self.status()
+        self.event('finished', **status)
+        with self.lock:
+            self._clear()
+            if status['files_planned']:
+                status['rate'] = status['bytes_done'] / (time.perf_counter() - self.started)
+                status['eta'] = None
+                self.stream.write(self.line(status) + '\n')
+
+
+class _StatusLineStream:
+    # A Progress's output while it's drawing a status line, so that whatever a run prints lands above it instead of on
+    # top of it.
+    def __init__(self, progress):
+        self.progress = progress
+
+    def write(self, text):
+        self.progress.write(text)
+        return len(text)
+
+    def __getattr__(self, name):
+        return getattr(self.progress.stream, name)
+
+
+def output():
+    """
+    Where to print to: the stream of the run() going on in this context (by way of its status line, if it's drawing
+    one), so that runs going on at once each print to their own, or sys.stdout outside of one.
+    """
+    stream = _output.get()
+    return sys.stdout if stream is None else stream
+
+
+def format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024 or unit == 'GB':
+            return ('%d %s' if unit == 'B' else '%.1f %s') % (n, unit)
+        n /= 1024
+
+
+#######################################################
+#######          DOWNLOAD MACHINERY           #########
+#######################################################
+
+
+def extract_filename(resp, fallback=None):
+    content_disposition = resp.headers.get('Content-Disposition')
+    if content_disposition:
+        for part in content_disposition.split(';'):
+            part = part.strip()
+            if part.startswith('filename='):
+                return part[9:].strip('"')
+                break
+    return fallback or filename_from_url(resp.geturl())
+
+
+def filename_from_url(url):
+    if '?' in url:
+        return url
+    path = urllib.parse.urlsplit(url).path
+    return path[path.rfind('/') + 1:]
+
+
+def get_content_length(resp, default=0):
+    length = resp.getheader('Content-Length', default)
+    try:
+        return int(length)
+    except ValueError:
+        return 0
+
+
+_buffers = threading.local()
+
+
+def transfer(fin, fout, limit=None, job=None):
+    """
+    Move the next piece of fin, up to limit bytes, to wherever fout is, and say how much that was (0 at the end of
+    fin).  Plain HTTP responses are spliced from the socket to the file without passing through Python at all, so fout
+    has to be unbuffered (open(..., buffering=0)), and not in append mode.
+
+    :param job: The Progress job to count the bytes towards, if it isn't the one running on this thread.
+    """
+    trace = getattr(fin, 'trace', None)
+    if isinstance(fin, _PooledResponse) and fin.pool is not None and fin.pool.zero_copy and fin.spliceable():
+        n, disk = fin.splice_into(fout.fileno(), limit)
+    else:
+        buffer = getattr(_buffers, 'buffer', None)
+        if buffer is None:
+            buffer = _buffers.buffer = bytearray(COPY_BUFFER_SIZE)
+        with memoryview(buffer) as view:
+            n = fin.readinto(view[:limit])
+            started = time.perf_counter()
+            fout.write(view[:n])
+            disk = time.perf_counter() - started
+    if n:
+        if trace is not None:
+            trace['disk'] += disk
+        progress = _progress.get()
+        if progress is not None:
+            progress.advance(n, job)
+    return n
+
+
+def copyfileobj(fin, fout):
+    while transfer(fin, fout):
+        pass
+
+
+_spare_pipes = []  # (read end, write end, capacity) for splice_into(), so every response doesn't make its own
+
+
+def _take_pipe():
+    try:
+        return _spare_pipes.pop()
+    except IndexError:
+        pass
+    r, w = os.pipe()
+    capacity = 64 * 1024  # Linux's default
+    try:
+        import fcntl
+        # Bigger means fewer trips through splice() per megabyte.  Unprivileged processes can go up to 1MB by default.
+        capacity = fcntl.fcntl(w, fcntl.F_SETPIPE_SZ, 1024 * 1024)
+    except (ImportError, AttributeError, OSError):
+        pass
+    return r, w, capacity
+
+
+def _splice_out(r, fd, count):
+    # Empty count bytes out of pipe r into fd.  Returns how long that took.
+    started = time.perf_counter()
+    while count:
+        try:
+            count -= os.splice(r, fd, count, flags=os.SPLICE_F_MOVE)
+        except OSError:
+            # Not every filesystem takes splice().  Do it the old fashioned way.
+            while count:
+                data = os.read(r, count)
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+                count -= len(data)
+    return time.perf_counter() - started
+
+
+def sanitize_path(filename, server_mode=False):
+    if server_mode:
+        if filename.startswith('.minecraft'):
+            filename = filename[10:]
+            if filename.startswith('/'):
+                filename = filename[1:]
+    return filename.replace('/', os.path.sep)
+
+
+class PoolBusy(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+    # The host has been failing, and is being given a rest -- or, if retry_after is None, given up on.
+    def __init__(self, key, retry_after):
+        if retry_after is None:
+            super().__init__('%s://%s is down, giving up on it' % key)
+        else:
+            super().__init__('%s://%s keeps failing, leaving it alone for %.0fs' % (key + (retry_after,)))
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=None, cooldown=None, give_up=None):
+        """
+        Once threshold requests in a row to a host have failed, stop sending it any for cooldown seconds, then let a
+        single one through to find out whether it has come back: if so, carry on as normal, and if not, leave it alone
+        for another cooldown.  Better than every worker separately waiting out its own timeout against a host that's
+        down, and then all of them piling back in at once the moment it comes up.  A host that is still down after
+        give_up of those is taken to be down for the rest of the run, and every request to it fails straight away.
+
+        Defaults are BREAKER_THRESHOLD, BREAKER_COOLDOWN and BREAKER_GIVE_UP.
+        """
+        self.threshold = BREAKER_THRESHOLD if threshold is None else threshold
+        self.cooldown = BREAKER_COOLDOWN if cooldown is None else cooldown
+        self.give_up = BREAKER_GIVE_UP if give_up is None else give_up
+        self.lock = threading.Lock()
+        self.failures = {}  # (scheme, netloc) -> requests failed in a row
+        self.opened = {}  # (scheme, netloc) -> time.monotonic() we stopped sending it requests
+        self.reopened = {}  # (scheme, netloc) -> times in a row the request to see if it's back has failed
+        self.trials = set()  # hosts with the one request out that decides whether they're back
+
+    def allow(self, key):
+        """Raises CircuitOpen if the host is being left alone, with a retry_after of None if it's been given up on."""
+        with self.lock:
+            opened = self.opened.get(key)
+            if opened is None:
+                return
+            if self.reopened.get(key, 0) >= self.give_up:
+                raise CircuitOpen(key, None)
+            left = opened + self.cooldown - time.monotonic()
+            if left > 0 or key in self.trials:
+                raise CircuitOpen(key, max(left, 1.0))
+            self.trials.add(key)
+
+    def is_open(self, key):
+        with self.lock:
+            return key in self.opened
+
+    def record(self, key, ok):
+        with self.lock:
+            trial = key in self.trials
+            self.trials.discard(key)
+            if ok:
+                self.failures.pop(key, None)
+                self.opened.pop(key, None)
+                self.reopened.pop(key, None)
+                return
+            failures = self.failures[key] = self.failures.get(key, 0) + 1
+            if failures < self.threshold and key not in self.opened:
+                return
+            if key not in self.opened:
+                output().write('%s://%s keeps failing, leaving it alone for %gs\n' % (key + (self.cooldown,)))
+            elif trial:
+                reopened = self.reopened[key] = self.reopened.get(key, 0) + 1
+                if reopened == self.give_up:
+                    output().write('%s://%s is still down, giving up on it\n' % key)
+            self.opened[key] = time.monotonic()
+
+
+class _PooledResponse(http.client.HTTPResponse):
+    # Hands its connection back to the ConnectionPool it came from when closed, instead of leaving it to the garbage
+    # collector.
+    pool = None
+    pool_key = None
+    connection = None
+    trace = None  # the Tracer's record of this request, if we're tracing
+    mirrored = False  # whether it came from the mirror, in which case geturl() is the mirror's URL
+    answered = None  # time.perf_counter() when the headers came in
+    received = 0  # bytes of body read so far
+
+    leftover = None  # how much of the body came in with the headers; see splice_into()
+
+    def readinto(self, b):
+        # read(amt) goes through here too.  Count everything so the TransferScheduler knows how fast we're going.
+        n = super().readinto(b)
+        self._count(n)
+        return n
+
+    def _count(self, n):
+        if n and self.pool is not None:
+            self.received += n
+            self.pool.note(received=n)
+            if self.trace is not None:
+                self.trace['bytes'] += n
+
+    def spliceable(self):
+        # Whether splice_into() can be used: a plain HTTP body of known length, on a platform with splice().  (TLS has
+        # to be decrypted by Python anyway, and chunked encoding has framing in the way.)
+        return (hasattr(os, 'splice') and self.connection is not None and not self.chunked and bool(self.length)
+                and type(self.connection.sock) is socket.socket)
+
+    def splice_into(self, fd, limit=None):
+        """
+        Like readinto(), except that the bytes go from the socket to fd's current position through a pipe, without
+        being copied into Python.  Only use it if spliceable().
+
+        :returns: (how many bytes, how many seconds were spent writing them out)
+        """
+        amount = self.length if limit is None else min(limit, self.length)
+        if self.leftover is None:
+            # Whatever arrived along with the headers is in http.client's buffer, where splice() can't get at it.
+            self.leftover = min(len(self.fp.peek(1)), self.length)
+        if self.leftover:
+            data = self.read(min(self.leftover, amount))
+            self.leftover -= len(data)
+            started = time.perf_counter()
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            return len(data), time.perf_counter() - started
+        sock = self.connection.sock
+        r, w, capacity = _take_pipe()
+        try:
+            while True:
+                try:
+                    n = os.splice(sock.fileno(), w, min(amount, capacity),
+                                  flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+                    break
+                except BlockingIOError:
+                    if not select.select([sock], [], [], sock.gettimeout())[0]:
+                        raise socket.timeout('timed out')
+            if n == 0:
+                raise http.client.IncompleteRead(b'', self.length)
+            disk = _splice_out(r, fd, n)
+        except BaseException:
+            # There may be something stuck in the pipe, which would end up in somebody else's file.
+            os.close(r)
+            os.close(w)
+            raise
+        _spare_pipes.append((r, w, capacity))
+        self._count(n)
+        self.length -= n
+        if not self.length:
+            self._close_conn()  # what http.client does when it reads the end of a body itself
+        return n, disk
+
+    def close(self):
+        trace, self.trace = self.trace, None
+        tracer = _tracer.get()
+        if trace is not None and tracer is not None:
+            tracer.request_done(trace)
+        conn, self.connection = self.connection, None
+        if conn is None:
+            return super().close()
+        if self.received >= 256 * 1024:
+            # Anything smaller is over too quickly to say much about the origin's bandwidth.
+            self.pool.stats.rate(self.pool_key, self.received / max(time.perf_counter() - self.answered, 1e-3))
+        reusable = not self.will_close
+        if reusable and self.fp is not None:
+            # The caller didn't read the whole body.  If what's left is short, finish reading it so the connection can
+            # be reused; if it isn't, it's cheaper to hang up.
+            if self.length is not None and self.length <= 64 * 1024:
+                try:
+                    self.read()
+                except (OSError, http.client.HTTPException):
+                    reusable = False
+            else:
+                reusable = False
+        super().close()
+        self.pool.release(self.pool_key, conn, reusable)
+
+
+class ConnectionPool:
+    def __init__(self, max_per_host=MAX_PER_HOST, mirror=None):
+        """
+        Keep-alive HTTP(S) connections, shared between every thread of a TransferScheduler, with at most max_per_host
+        of them open to any one host at a time.  Cookies go through the cookies attribute (COOKIE_JAR, unless whoever
+        made us says otherwise) exactly like they do for urlopen().  Likewise chunk_threshold, chunks and zero_copy
+        (CHUNK_THRESHOLD, CHUNKS and ZERO_COPY) say how fetch_file() and transfer() download through us.
+
+        :param mirror: Base URL of a LAN mirror (server.py --mirror).  Every request is tried there first and only goes
+                       upstream if the mirror doesn't have it or can't get it.
+        """
+        self.max_per_host = max_per_host
+        self.mirror = mirror if mirror is None or mirror.endswith('/') else mirror + '/'
+        self.mirror_down = False  # whether the last request to the mirror failed, so we've said so already
+        self.lock = threading.Lock()
+        self.idle = {}  # (scheme, netloc) -> [connection]
+        self.slots = {}  # (scheme, netloc) -> threading.BoundedSemaphore
+        self.received = 0  # bytes of response bodies read since the last take_stats()
+        self.requests = 0  # requests answered since the last take_stats()
+        self.errors = 0  # failed requests and "slow down" responses since the last take_stats()
+        self.breaker = CircuitBreaker()  # Installers swap in one with their own threshold and cooldown
+        self.stats = OriginStats()  # run() swaps in one that's kept in the cache directory
+        self.timeout = SOCKET_TIMEOUT  # for connecting and for every read
+        self.cookies = COOKIE_JAR
+        # How the downloads made through us go about it; Installers set their own.
+        self.chunk_threshold = CHUNK_THRESHOLD
+        self.chunks = CHUNKS
+        self.zero_copy = ZERO_COPY
+
+    def _acquire(self, key, blocking=True):
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None:
+                slot = self.slots[key] = threading.BoundedSemaphore(self.max_per_host)
+        if not slot.acquire(blocking):
+            raise PoolBusy(key)
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, netloc = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        conn.response_class = _PooledResponse
+        return conn, False
+
+    def release(self, key, conn, reusable=True):
+        if reusable:
+            with self.lock:
+                self.idle.setdefault(key, []).append(conn)
+        else:
+            conn.close()
+        self.slots[key].release()
+
+    def note(self, received=0, requests=0, errors=0):
+        with self.lock:
+            self.received += received
+            self.requests += requests
+            self.errors += errors
+
+    def take_stats(self):
+        """Returns (bytes received, requests answered, errors) since the last call."""
+        with self.lock:
+            stats = (self.received, self.requests, self.errors)
+            self.received = self.requests = self.errors = 0
+        return stats
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _request_once(self, method, url, headers, blocking=True):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(headers or ())
+        headers.setdefault('User-Agent', USER_AGENT)
+        cookies = self.cookies
+        req = None
+        if cookies is not None:
+            # CookieJar only deals in urllib.request's Requests.
+            from urllib.request import Request
+            req = Request(url, headers=headers, method=method)
+            cookies.add_cookie_header(req)
+            headers = dict(req.header_items())
+        tracer = _tracer.get()
+        trace = tracer.request_started(method, url) if tracer is not None else None
+        conn, reused = self._acquire(key, blocking)
+        try:
+            self.breaker.allow(key)
+        except CircuitOpen:
+            self.release(key, conn)
+            raise
+        asked = time.perf_counter()
+        try:
+            try:
+                if trace is not None:
+                    trace['phases'].append(('wait for connection', trace['start'], time.perf_counter()))
+                    if conn.sock is None:
+                        _traced_connect(conn, trace['phases'])
+                    sent = time.perf_counter()
+                conn.request(method, path, headers=headers)
+                resp = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                # The server hung up on an idle keep-alive connection.  Not an error, just try again on a fresh one.
+                conn.close()
+                if trace is not None:
+                    trace['retries'] += 1
+                    _traced_connect(conn, trace['phases'])
+                    sent = time.perf_counter()
+                conn.request(method, path, headers=headers)
+                resp = conn.getresponse()
+        except BaseException as e:
+            self.release(key, conn, False)
+            self.note(errors=1)
+            if isinstance(e, (OSError, http.client.HTTPException)):
+                self.breaker.record(key, False)
+            if trace is not None:
+                trace['end'] = time.perf_counter()
+                tracer.add('%s %s' % (method, url), 'request', trace['start'], trace['end'], {'error': True})
+            raise
+        resp.answered = time.perf_counter()
+        self.note(requests=1, errors=resp.status in (429, 503))
+        self.breaker.record(key, resp.status < 500 and resp.status != 429)
+        self.stats.ttfb(key, resp.answered - asked)
+        if trace is not None:
+            trace['phases'].append(('ttfb', sent, time.perf_counter()))
+            trace['status'] = resp.status
+            resp.trace = trace
+        resp.pool = self
+        resp.pool_key = key
+        resp.connection = conn
+        resp.url = url
+        if cookies is not None:
+            cookies.extract_cookies(resp, req)
+        return resp
+
+    def mirror_url(self, url):
+        """Where to find url on the mirror, or None if there's no mirror or url is already on it."""
+        mirror = self.mirror
+        if mirror is None or url.startswith(mirror):
+            return None
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            return None
+        if parts.netloc == 'media.forgecdn.net' and parts.path.startswith('/files/'):
+            return mirror + parts.path[1:]
+        return mirror + 'fetch?url=' + urllib.parse.quote(url, safe='')
+
+    def request(self, method, url, headers=None, max_redirects=10, blocking=True, mirror=True):
+        """
+        Make a request, following redirects.  Returns an http.client.HTTPResponse whose geturl() is the URL we ended
+        up at.  Close it (or use it in a with statement) when done, or the connection is never reused.
+
+        :param blocking: If False, raise PoolBusy rather than wait for a connection to the host to free up.
+        :param mirror: If False, go straight to url even if there's a mirror.
+        """
+        mirrored = self.mirror_url(url) if mirror else None
+        if mirrored is not None:
+            try:
+                resp = self._follow(method, mirrored, headers, max_redirects, blocking)
+            except PoolBusy:
+                raise
+            except CircuitOpen:
+                resp = None  # it's having a bad patch; upstream for now
+            except (OSError, http.client.HTTPException) as e:
+                # Upstream for this one.  One timeout (a big file the mirror is slow getting, say) doesn't mean it's
+                # gone; if it keeps failing, the breaker stops us asking it, and gives up on it if it stays down.
+                if not self.mirror_down:
+                    self.mirror_down = True
+                    output().write('Mirror unavailable (%s), downloading from upstream for now\n' % e)
+            else:
+                self.mirror_down = False
+                # 403 is the mirror refusing a URL that isn't in any of its packs; 404 and 5xx are it failing to get
+                # the file itself.  Either way upstream might still have it.
+                if resp is not None and resp.status not in (403, 404) and resp.status < 500:
+                    resp.mirrored = True
+                    return resp
+                if resp is not None:
+                    resp.close()
+        return self._follow(method, url, headers, max_redirects, blocking)
+
+    def _follow(self, method, url, headers, max_redirects, blocking):
+        for _ in range(max_redirects):
+            resp = self._request_once(method, url, headers, blocking)
+            location = resp.getheader('Location')
+            if resp.status not in (301, 302, 303, 307, 308) or not location:
+                return resp
+            resp.close()
+            url = urllib.parse.urljoin(url, location.replace(' ', '%20'))
+            if resp.status == 303:
+                method = 'GET'
+        raise http.client.HTTPException('too many redirects')
+
+
+def spawn(target, *args):
+    """
+    Start a daemon thread running target(*args) as part of whatever run() this thread is part of: it gets a copy of
+    this thread's context, and with it the run's Progress and Tracer.  Returns the thread.
+    """
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(target,) + args, daemon=True)
+    thread.start()
+    return thread
+
+
+class TransferScheduler:
+    def __init__(self, max_transfers=MAX_TRANSFERS, max_per_host=MAX_PER_HOST, mirror=None):
+        """
+        Owns every transfer made during a run(): a pool of worker threads that all the Downloaders share, and the
+        ConnectionPool (through mirror, if given) they make their requests through.
+
+        Jobs run lowest priority first, which Downloaders use to get the biggest files going before the small ones
+        rather than leaving some huge jar that happened to be last in the pack to finish on its own.  How many workers
+        are allowed to run at once gets tuned as we go, from START_TRANSFERS up to max_transfers: see _tune().
+        """
+        self.max_transfers = max_transfers
+        self.target = min(START_TRANSFERS, max_transfers)  # how many workers may run jobs at once
+        self.running = 0
+        self.gate = threading.Condition()
+        self.pool = ConnectionPool(max_per_host, mirror)
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()  # tie breaker, so equal priorities go first come first served
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def _worker(self):
+        while True:
+            with self.gate:
+                self.gate.wait_for(lambda: self.running < self.target or self.stopping.is_set())
+                self.running += 1
+            try:
+                fn, args = self.queue.get()[2:]
+                if fn is None:
+                    return
+                fn(*args)
+            finally:
+                with self.gate:
+                    self.running -= 1
+                    self.gate.notify()
+
+    def _tune(self):
+        # Hill climbing on throughput.  Every TUNE_INTERVAL, if every worker we allow has had something to do, try
+        # allowing one more, and keep it if that made things faster -- more bytes or more files a second, since small
+        # files are limited by round trips rather than bandwidth.  If it didn't, go back and leave it a few intervals
+        # before trying again.  Throughput also drifts on its own (biggest files go first, so bytes a second fall off
+        # as we go), which is why we only ever compare the interval just after a change with the one just before it,
+        # and never back off just because things got slower.  The exception is requests failing or servers telling
+        # us to slow down: then we're pushing too hard, and halve it.
+        last_time = time.perf_counter()
+        last = None
+        raised = False
+        hold = 0
+        while not self.stopping.wait(TUNE_INTERVAL):
+            now = time.perf_counter()
+            received, requests, errors = self.pool.take_stats()
+            elapsed, last_time = now - last_time, now
+            rates = (received / elapsed, requests / elapsed)
+            with self.gate:
+                busy = self.queue.qsize() and self.running >= self.target
+                if errors:
+                    self.target = max(1, self.target // 2)
+                    raised = False
+                    hold = 3
+                elif raised and not any(rate > before * 1.1 for rate, before in zip(rates, last)):
+                    self.target -= 1
+                    raised = False
+                    hold = 3
+                elif hold:
+                    hold -= 1
+                elif busy and self.target < self.max_transfers:
+                    self.target += 1
+                    raised = True
+                else:
+                    raised = False
+                self.gate.notify_all()
+            last = rates
+
+    def start(self):
+        if self.threads:
+            # No-op if we're already running.
+            return
+        self.stopping.clear()
+        for _ in range(self.max_transfers):
+            self.threads.append(spawn(self._worker))
+        self.threads.append(spawn(self._tune))
+
+    def submit(self, fn, *args, priority=0):
+        self.start()
+        self.queue.put((priority, next(self.counter), fn, args))
+
+    def submit_later(self, delay, fn, *args, priority=0):
+        # Without holding up a worker in the meantime.
+        timer = threading.Timer(delay, self.submit, (fn,) + args, {'priority': priority})
+        timer.daemon = True
+        timer.start()
+
+    def stop(self):
+        # The None jobs sort after everything else, so anything already submitted still gets done.
+        for _ in range(self.max_transfers):
+            self.queue.put((math.inf, next(self.counter), None, None))
+        with self.gate:
+            self.stopping.set()
+            self.gate.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads.clear()
+        self.pool.close()
+
+
+class IntegrityError(Exception):
+    pass
+
+
+class DownloadError(Exception):
+    # An HTTP error status.  str() of it is what ends up in the list of failed downloads.
+    def __init__(self, resp):
+        super().__init__('%d %s' % (resp.status, resp.reason))
+        self.status = resp.status
+        self.retry_after = parse_retry_after(resp.getheader('Retry-After'))
+
+
+def parse_retry_after(value):
+    """Seconds from now that a Retry-After header (either a number of seconds or an HTTP date) means, or None."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    import email.utils
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(when.timestamp() - time.time(), 0.0)
+
+
+class RetryPolicy:
+    STATUSES = {408, 429, 500, 502, 503, 504}  # worth asking again; any other error status isn't going to change
+    ERRORS = (ConnectionError, TimeoutError, socket.gaierror, http.client.IncompleteRead, http.client.BadStatusLine,
+              CircuitOpen, IntegrityError)
+
+    def __init__(self, retries=None, delay=None, max_delay=None):
+        """
+        Which failures are worth trying again -- dropped and refused connections, timeouts, DNS hiccups, downloads cut
+        short or mangled on the way, and servers that are overloaded or broken for the moment -- and how long to wait
+        first.  Waits double with every retry, each one a random amount between half and all of that so a burst of
+        failures doesn't come back as a burst of retries, unless the server said how long to wait with Retry-After.
+
+        Defaults are RETRIES, RETRY_DELAY and RETRY_MAX_DELAY.
+        """
+        self.retries = RETRIES if retries is None else retries
+        self.delay = RETRY_DELAY if delay is None else delay
+        self.max_delay = RETRY_MAX_DELAY if max_delay is None else max_delay
+
+    def retryable(self, e):
+        if isinstance(e, CircuitOpen):
+            return e.retry_after is not None
+        if isinstance(e, DownloadError):
+            return e.status in self.STATUSES
+        return isinstance(e, self.ERRORS)
+
+    def wait(self, attempt, e):
+        """Seconds to wait before trying again after attempt (counting from 0) failed with e, or None to give up."""
+        if attempt >= self.retries or not self.retryable(e):
+            return None
+        retry_after = getattr(e, 'retry_after', None)
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_delay else None
+        wait = min(self.delay * 2 ** attempt, self.max_delay)
+        return random.uniform(wait / 2, wait)
+
+
+def parse_content_range(resp):
+    """Returns (first byte, last byte, total length) from a 206 response, or None if we can't make sense of it."""
+    content_range = resp.getheader('Content-Range', '')
+    try:
+        unit, _, spec = content_range.partition(' ')
+        span, _, total = spec.partition('/')
+        first, _, last = span.partition('-')
+        return int(first), int(last), int(total)
+    except ValueError:
+        return None
+
+
+def validators(resp):
+    """The ETag and Last-Modified of resp, for checking later on that a file hasn't changed underneath us."""
+    return {'etag': resp.getheader('ETag'), 'last_modified': resp.getheader('Last-Modified')}
+
+
+def preallocate(f, size):
+    # Reserve the whole file up front so that it doesn't end up fragmented (chunks written out of order especially),
+    # and so that we find out about a full disk now rather than halfway through.
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass  # filesystem doesn't support it
+    f.truncate(size)
+
+
+class StagedDownload:
+    def __init__(self, pool, url, output_path, filename, size, source_url=None, validators=None, chunks=1,
+                 contender=None):
+        """
+        Downloads a file into a preallocated output_path.part, and renames it into place once all of it is in, so that
+        nothing ever mistakes half a file for the real thing.  Progress is saved in output_path.part.chunks along with
+        the file's ETag and Last-Modified, so an interrupted download picks up where it left off, provided the server
+        (asked with If-Range, and checked against its Content-Range) still has the same file.
+
+        Big files can be split into byte ranges, fetched over parallel connections.
+
+        :param url: Where to get it from.  Should already be past any redirects.
+        :param size: The length of the file.
+        :param source_url: The URL we were asked to download, before redirects, if that's different.
+        :param validators: validators() of the response we got the file's size from.
+        :param chunks: How many ranges to split the file into.
+        :param contender: The Contender in a Race this download is, if it's one.
+        """
+        self.pool = pool
+        self.url = url
+        self.source_url = source_url or url
+        self.output_path = output_path
+        self.filename = filename
+        self.size = size
+        self.validators = validators or {}
+        self.chunks = chunks
+        self.contender = contender
+        self.part_path = output_path + '.part'
+        self.state_path = output_path + '.part.chunks'
+        self.lock = threading.Condition()
+        self.ranges = []  # [start, end, pos] with end exclusive; pos is how far we've got
+        # Who is working on each range: None, 'claimed' (waiting to hear back from the server), 'active' or 'done'.
+        self.owners = []
+        self.ranges_ok = True  # becomes False if the server turns out to ignore Range
+        self.changed = False  # the file on the server isn't the one we started downloading
+        self.errors = []
+        self.last_save = time.perf_counter()
+        # Our helpers run on their own threads, so they need telling which job their bytes count towards.
+        progress = _progress.get()
+        self.job = progress.current() if progress is not None else None
+
+    @classmethod
+    def load(cls, pool, url, output_path, filename, contender=None):
+        """Pick up an interrupted download.  Returns None if there isn't one."""
+        try:
+            with open(output_path + '.part.chunks') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if state.get('url') != url or not os.path.exists(output_path + '.part'):
+            return None
+        self = cls(pool, state['final_url'], output_path, filename, state['size'], url, state.get('validators'),
+                   contender=contender)
+        self.ranges = state['ranges']
+        self.owners = [('done' if pos >= end else None) for start, end, pos in self.ranges]
+        return self
+
+    def discard(self):
+        for path in (self.part_path, self.state_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def _save(self):
+        with self.lock:
+            state = {'url': self.source_url, 'final_url': self.url, 'size': self.size, 'validators': self.validators,
+                     'ranges': [list(r) for r in self.ranges]}
+            self.last_save = time.perf_counter()
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def _copy(self, resp, index, sweep):
+        # Copy resp into range index.  If sweep, resp runs to the end of the file, and we carry on into each following
+        # range for as long as nobody else has claimed it.
+        with open(self.part_path, 'r+b', buffering=0) as f:
+            while True:
+                start, end, pos = self.ranges[index]
+                f.seek(pos)
+                while pos < end:
+                    n = transfer(resp, f, end - pos, self.job)
+                    if n == 0:
+                        raise http.client.IncompleteRead(b'', end - pos)
+                    if self.contender is not None:
+                        self.contender.advance(n)
+                    pos += n
+                    self.ranges[index][2] = pos
+                    if time.perf_counter() >= self.last_save + 1:
+                        f.flush()
+                        self._save()
+                with self.lock:
+                    self.owners[index] = 'done'
+                    self.lock.notify_all()
+                    index += 1
+                    if not sweep or index >= len(self.ranges):
+                        return
+                    # If a helper has asked for the next range but not heard back yet, wait and see whether the server
+                    # gives it to them.
+                    self.lock.wait_for(lambda: self.owners[index] != 'claimed')
+                    if self.owners[index] is not None:
+                        return
+                    self.owners[index] = 'active'
+                    # We're arriving at the start of this range.  If somebody else had a go at it and gave up partway
+                    # through, we rewrite what they wrote with the same bytes.
+                    self.ranges[index][2] = self.ranges[index][0]
+
+    def _helper(self, blocking=False):
+        # Claim ranges nobody is working on (from the back, to stay out of the first stream's way) and fetch them.
+        # Carries on until there are none left.
+        while True:
+            with self.lock:
+                if not self.ranges_ok or self.errors:
+                    return
+                for index in reversed(range(len(self.ranges))):
+                    if self.owners[index] is None:
+                        self.owners[index] = 'claimed'
+                        break
+                else:
+                    return
+            start, end, pos = self.ranges[index]
+            headers = {'Range': 'bytes=%d-%d' % (pos, end - 1)}
+            if_range = self.if_range()
+            if if_range:
+                headers['If-Range'] = if_range
+            try:
+                resp = self.pool.request('GET', self.url, headers, blocking=blocking,
+                                         mirror=self.contender is None or self.contender.mirror)
+            except PoolBusy:
+                resp = None
+            except Exception as e:
+                resp = e
+            if not isinstance(resp, http.client.HTTPResponse):
+                with self.lock:
+                    self.owners[index] = None
+                    self.lock.notify_all()
+                    if resp is not None:
+                        self.errors.append(resp)
+                        return
+                # Every connection to the host is taken.  Some will free up as other downloads finish, so try again in
+                # a bit, unless the first stream has swept up everything by then.  (Not waiting for a connection while
+                # holding a claim, because the first stream may be waiting on that claim while holding a connection.)
+                time.sleep(0.25)
+                continue
+            with resp:
+                if self.contender is not None:
+                    self.contender.answered(resp)
+                if resp.status != 206 or parse_content_range(resp) != (pos, end - 1, self.size) \
+                        or not self.same_file(resp):
+                    with self.lock:
+                        self.owners[index] = None
+                        self.lock.notify_all()
+                        if resp.status == 206 and ((parse_content_range(resp) or (0, 0, None))[2] != self.size
+                                                   or not self.same_file(resp)) \
+                                or resp.status == 200 and if_range:  # a 200 here means If-Range didn't match
+                            self.changed = True
+                            self.ranges_ok = False
+                        elif resp.status in (200, 206, 416):
+                            self.ranges_ok = False
+                        else:
+                            self.errors.append(DownloadError(resp))
+                    return
+                with self.lock:
+                    self.owners[index] = 'active'
+                    self.lock.notify_all()
+                try:
+                    self._copy(resp, index, False)
+                except Exception as e:
+                    with self.lock:
+                        self.owners[index] = None
+                        self.lock.notify_all()
+                        self.errors.append(e)
+                    return
+
+    def if_range(self):
+        # What to send in If-Range, so that the server sends the whole file rather than a piece of a different one.
+        # Weak ETags aren't allowed there; Last-Modified will do instead.
+        etag = self.validators.get('etag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return self.validators.get('last_modified')
+
+    def same_file(self, resp):
+        # Whether the validators resp carries (if any) match the ones we started with.
+        for key, value in validators(resp).items():
+            if value is not None and self.validators.get(key) not in (None, value):
+                return False
+        return True
+
+    def _finish(self):
+        if any(owner != 'done' for owner in self.owners):
+            self._save()
+            if self.errors:
+                raise self.errors[0]
+            raise http.client.IncompleteRead(b'')
+        if self.contender is not None:
+            self.contender.finish(self.part_path)
+        else:
+            os.replace(self.part_path, self.output_path)
+        try:
+            os.unlink(self.state_path)
+        except FileNotFoundError:
+            pass  # it was quick enough that we never saved any progress
+
+    def start(self, resp):
+        """
+        Download the whole thing.  resp is the response to a plain GET of the file, which we keep reading as the first
+        chunk.  If the server turns out to ignore Range, it just carries on to the end of the file on its own.
+        """
+        progress = _progress.get()
+        if progress is not None:
+            progress.sized(self.size, self.job)
+        if self.contender is not None:
+            self.contender.size = self.size
+        step = -(-self.size // self.chunks)
+        self.ranges = [[start, min(start + step, self.size), start] for start in range(0, self.size, step)]
+        self.owners = ['active'] + [None] * (len(self.ranges) - 1)
+        with open(self.part_path, 'wb') as f:
+            preallocate(f, self.size)
+        # Progress first gets saved a second in, so the many files that take less than that never write any.
+        self.last_save = time.perf_counter()
+        helpers = [spawn(self._helper) for _ in range(len(self.ranges) - 1)]
+        try:
+            self._copy(resp, 0, True)
+        except Exception as e:
+            with self.lock:
+                self.errors.append(e)
+        for helper in helpers:
+            helper.join()
+        self._finish()
+
+    def resume(self):
+        """
+        Fetch whatever ranges an interrupted download didn't get to.  Returns False if that turned out to be
+        impossible (the file changed on the server, or it stopped honouring Range), in which case the caller should
+        start over.
+        """
+        progress = _progress.get()
+        if progress is not None:
+            progress.sized(sum(end - pos for start, end, pos in self.ranges), self.job)
+        if self.contender is not None:
+            self.contender.size = sum(end - pos for start, end, pos in self.ranges)
+        left = sum(owner != 'done' for owner in self.owners)
+        helpers = [spawn(self._helper) for _ in range(min(left, self.pool.chunks) - 1)]
+        self._helper(blocking=True)
+        for helper in helpers:
+            helper.join()
+        if not self.ranges_ok:
+            self.discard()
+            return False
+        self._finish()
+        return True
+
+
+def fetch_file(pool, url, dest, filename=None, contender=None):
+    """
+    Download url to dest, by way of dest.part so that dest is only ever the whole file, and resuming whatever an
+    earlier run left behind (see StagedDownload).  Big files from servers that honour Range are fetched in parallel
+    chunks.
+
+    :param dest: Path to download to.  If it's a directory, the file goes in it, under whatever name the server gives.
+    :param filename: Human readable name for progress messages.
+    :param contender: The Contender in a Race this download is, if it's one.  It goes to the race's dest once it's
+    done, rather than to dest, and only if nobody beat it there.
+    :returns: The path of the downloaded file, or None if we already had all of it.
+    :raises DownloadError: if the server answers with an error.
+    """
+    headers = {}
+    mirror = contender is None or contender.mirror
+    if not os.path.isdir(dest):
+        staged = StagedDownload.load(pool, url, dest, filename, contender)
+        if staged is not None and staged.resume():
+            return dest
+        if os.path.isfile(dest):
+            # Something's already there.  If it's as long as the server's copy, take it to be that.
+            have = os.path.getsize(dest)
+            headers['Range'] = 'bytes=%d-' % have
+    while True:
+        with pool.request('GET', url, headers, mirror=mirror) as resp:
+            if contender is not None:
+                contender.answered(resp)
+            if headers and resp.status in (206, 416):  # 416 Range Not Satisfiable
+                # Only a 416 that says how long the file is (Content-Range: bytes */length) tells us what's there is as
+                # long as the real thing.  One that doesn't might mean anything, and taking it at its word would put a
+                # file we know nothing about in the lock file and the cache.
+                total = resp.getheader('Content-Range', '').rpartition('/')[2]
+                if resp.status == 416 and total.isdigit() and int(total) == have:
+                    progress = _progress.get()
+                    if progress is not None:
+                        progress.sized(0)
+                    return None
+                # What's there is shorter (or longer) than the real thing, so it isn't it.  Or we can't tell.
+                headers = {}
+                continue
+            elif resp.status != 200:
+                raise DownloadError(resp)
+            if os.path.isdir(dest):
+                filename = extract_filename(resp)
+                dest = os.path.join(dest, filename)
+            os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+            size = get_content_length(resp)
+            if size:
+                ranges_ok = resp.getheader('Accept-Ranges', '').lower() == 'bytes'
+                chunks = pool.chunks if ranges_ok and size >= pool.chunk_threshold else 1
+                StagedDownload(pool, resp.geturl(), dest, filename, size, url, validators(resp), chunks,
+                               contender).start(resp)
+            else:
+                # No idea how long it is, so no resuming it either, but it still doesn't go in place until it's done.
+                with open(dest + '.part', 'wb', buffering=0) as fout:
+                    if contender is None:
+                        copyfileobj(resp, fout)
+                    else:
+                        while contender.advance(transfer(resp, fout)):
+                            pass
+                if contender is not None:
+                    contender.finish(dest + '.part')
+                else:
+                    os.replace(dest + '.part', dest)
+            return dest
+
+
+def origin_of(url):
+    # What ConnectionPool and OriginStats know url's host by.
+    parts = urllib.parse.urlsplit(url)
+    return parts.scheme, parts.netloc
+
+
+class HedgeLost(Exception):
+    # Another origin got the whole file first.
+    pass
+
+
+class Contender:
+    def __init__(self, race, url, path, mirror):
+        """
+        One of the downloads in a Race, of url to path.  fetch_file() and StagedDownload tell it how they're getting on,
+        and it tells them to stop once somebody else has won.
+
+        :param mirror: Whether it's allowed to go through the mirror.
+        """
+        self.race = race
+        self.url = url
+        self.path = path
+        self.mirror = mirror
+        mirrored = race.pool.mirror_url(url) if mirror else None
+        self.origin = origin_of(mirrored or url)  # where its requests actually go
+        self.started = time.perf_counter()
+        self.first_byte = None  # time.perf_counter() its first response came in
+        self.size = None  # how many bytes it has to transfer, once it knows
+        self.received = 0
+        self.responses = []  # so the winner can hang up on it
+        self.problem = None  # set if it turns out to be downloading some other file
+        self.error = None
+        self.done = False
+
+    def answered(self, resp):
+        if resp.status == 206:
+            total = (parse_content_range(resp) or (None, None, None))[2]
+        else:
+            total = get_content_length(resp, None) if resp.status == 200 else None
+        race = self.race
+        with race.cond:
+            if self.first_byte is None:
+                self.first_byte = resp.answered or time.perf_counter()
+            self.responses.append(resp)
+            if total is not None and race.total is None:
+                race.total = total
+            elif total is not None and total != race.total:
+                self.problem = '%s is %d bytes, but %s has it as %d' % (self.url, total, race.contenders[0].url,
+                                                                         race.total)
+            race.cond.notify_all()
+
+    def advance(self, n):
+        """n more bytes are in.  Returns n, unless it's time to give up."""
+        with self.race.cond:
+            self.received += n
+            lost = self.race.winner is not None
+        if self.problem is not None:
+            raise IntegrityError(self.problem)
+        if lost:
+            raise HedgeLost()
+        return n
+
+    def finish(self, path):
+        """The whole file is at path.  Moves it to the race's dest, unless somebody beat us to it."""
+        if self.problem is not None:
+            raise IntegrityError(self.problem)
+        self.race.finish(self, path)
+
+
+class HedgePolicy:
+    def __init__(self, percentile=None, delay=None, min_delay=None, grace=None):
+        """
+        How slow a download in a Race has to be before a duplicate is raced against it: no first byte after the
+        origin's percentileth percentile time to first byte (delay seconds, for origins OriginStats doesn't know enough
+        about yet, and never less than min_delay), or, once grace seconds of the body are in, a rate under its
+        (100 - percentile)th percentile rate.
+
+        Defaults are HEDGE_PERCENTILE, HEDGE_DELAY, HEDGE_MIN_DELAY and HEDGE_GRACE.
+        """
+        self.percentile = HEDGE_PERCENTILE if percentile is None else percentile
+        self.delay = HEDGE_DELAY if delay is None else delay
+        self.min_delay = HEDGE_MIN_DELAY if min_delay is None else min_delay
+        self.grace = HEDGE_GRACE if grace is None else grace
+
+    def first_byte_delay(self, stats, origin):
+        """How long to wait for a first byte from origin (going by stats, an OriginStats) before trying elsewhere too."""
+        delay = stats.percentile(origin, 'ttfb', self.percentile)
+        return self.delay if delay is None else max(delay, self.min_delay)
+
+
+class Race:
+    def __init__(self, pool, urls, dest, filename=None, policy=None):
+        """
+        Downloads a file to dest from the first of urls, the way fetch_file() does, and if that turns out slow, races a
+        duplicate from the next of urls against it.  Slow is as policy (a HedgePolicy; default one if None) says, and
+        so far under the origin's usual rate that starting again from the next origin would still get there first.  Each duplicate can have one raced
+        against it in turn, and one that fails outright is replaced at once.  The first to finish is moved to dest, and
+        the rest are hung up on.
+
+        Every contender downloads to a path of its own (the first to dest, and resumable like any other download; the
+        rest alongside it), so none of them can ever see the others' half files.
+        """
+        self.pool = pool
+        self.dest = dest
+        self.filename = filename
+        self.policy = policy or HedgePolicy()
+        # The first URL goes through the mirror, if there is one, like any other download.  Duplicates go straight to
+        # their origins, starting with the first one if it's the mirror that's being slow.
+        self.plan = [(urls[0], True)] + [(url, False) for url in (urls if pool.mirror_url(urls[0]) else urls[1:])]
+        self.cond = threading.Condition()
+        self.contenders = []
+        self.winner = None
+        self.fresh = True  # False if the winner found dest already there, so there was nothing to download
+        self.total = None  # the file's size, going by the first contender to hear it
+
+    def fetch(self):
+        """Run the race.  Returns what fetch_file() would, and raises what the first contender failed with."""
+        progress = _progress.get()
+        job = progress.current() if progress is not None else None
+        with self.cond:
+            self._start(job)
+            while self.winner is None:
+                last = self.contenders[-1]
+                if len(self.contenders) < len(self.plan) and (last.done or self._slow(last)):
+                    self._start(job)
+                elif all(contender.done for contender in self.contenders):
+                    break
+                else:
+                    self.cond.wait(0.1)
+        if self.winner is None:
+            raise next(contender.error for contender in self.contenders if contender.error is not None)
+        if self.winner is not self.contenders[0]:
+            output().write('%s: got it from %s instead\n' % (self.filename or filename_from_url(self.dest),
+                                                       self.winner.origin[1]))
+        return self.dest if self.fresh else None
+
+    def _start(self, job):
+        url, mirror = self.plan[len(self.contenders)]
+        path = '%s.hedge%d' % (self.dest, len(self.contenders)) if self.contenders else self.dest
+        contender = Contender(self, url, path, mirror)
+        self.contenders.append(contender)
+        spawn(self._contend, contender, job)
+
+    def _contend(self, contender, job):
+        hedge = None
+        progress = _progress.get()
+        if job is not None:
+            if contender.path == self.dest:
+                progress.follow(job)
+            else:
+                hedge = progress.hedge(job)
+        try:
+            with trace('%s from %s' % (filename_from_url(contender.url), contender.origin[1]), 'hedge'):
+                if fetch_file(self.pool, contender.url, contender.path, self.filename, contender) is None:
+                    self.finish(contender, None)
+        except HedgeLost:
+            pass
+        except Exception as e:
+            contender.error = e
+        finally:
+            if self.winner is not contender and (self.winner is not None or contender.path != self.dest):
+                # It's not going to be resumed: either the file's already in place, or it was a duplicate.
+                for path in (contender.path + '.part', contender.path + '.part.chunks'):
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+            if hedge is not None:
+                progress.end_hedge(hedge)
+            with self.cond:
+                contender.done = True
+                self.cond.notify_all()
+
+    def _slow(self, contender):
+        # Whether contender is far enough behind its origin's usual pace to be worth racing the next one against it.
+        stats = self.pool.stats
+        now = time.perf_counter()
+        if contender.first_byte is None:
+            return now - contender.started > self.policy.first_byte_delay(stats, contender.origin)
+        elapsed = now - contender.first_byte
+        if elapsed < self.policy.grace or not contender.size:
+            return False
+        rate = contender.received / elapsed
+        slow = stats.percentile(contender.origin, 'rate', 100 - self.policy.percentile)
+        if slow is None or rate >= slow:
+            return False
+        origin = origin_of(self.plan[len(self.contenders)][0])
+        usual = stats.percentile(origin, 'rate', 50) or stats.percentile(contender.origin, 'rate', 50)
+        again = (stats.percentile(origin, 'ttfb', 50) or 0) + contender.size / usual
+        return (contender.size - contender.received) / max(rate, 1) > again
+
+    def finish(self, contender, path):
+        with self.cond:
+            if self.winner is not None:
+                raise HedgeLost()
+            self.winner = contender
+            if path is not None:
+                os.replace(path, self.dest)
+            else:
+                self.fresh = False
+            responses = [resp for other in self.contenders if other is not contender for resp in other.responses]
+            self.cond.notify_all()
+        for resp in responses:
+            # Make whoever is in the middle of reading one of these find out now, rather than at the end of a read
+            # that may be taking its time.
+            try:
+                resp.connection.sock.shutdown(socket.SHUT_RDWR)
+            except (AttributeError, OSError):
+                pass  # it's already been closed
+
+
+class Downloader:
+    resolve_ttl = 7 * 24 * 3600  # a CurseForge file never changes once it's up, so what we know about it keeps
+
+    def __init__(self, scheduler, host, urlformat, tag='', cache=None, cache_key=None):
+        """
+
+
+        :param scheduler: The TransferScheduler to do our downloading on.
+        :param host: The FQDN of the host to connect to. (Everything before the first slash in the url.)
+        :param urlformat: Everything after (and including) the first slash in the URL.  Should contain str.format()
+        paramters (i.e. {0}) that will be substituted with values passed to put().
+        :param dir: Path to the local directory we should dump our files in.
+        :param tag: Human readable string of what this downloader is for.  Returned by str(downloader).
+        :param cache: ModCache to store completed downloads in, or None.
+        :param cache_key: Function of the values urlformat gets that returns the key completed downloads get stored in
+        the cache and the lock file under.
+        """
+        self.scheduler = scheduler
+        self.host=host
+        self.urltemplate=urlformat
+        self.cache = cache
+        self.cache_key = cache_key
+        self.packlock = None  # PackLock to record completed downloads in; set by run()
+        self.batch = None  # Batch to tell the other instances being installed into about completed downloads
+        self.pending = 0
+        self.idle = threading.Condition()
+        self.failed_downloads = {}
+        self.resolutions = None  # ResolutionCache to remember what HEAD requests told us in; set by run()
+        self.resolved = {}  # item -> resolution, for the ones _resolve() already found out about
+        self.hashes = {}  # source -> the SHA-256 the pack says its file has; set by run()
+        self.origins = []  # base URLs of the pack's Origins, which have our files at the same paths; set by run()
+        self.alternates = {}  # URL -> other URLs the pack says the same file is at; set by run()
+        self.retry_policy = RetryPolicy()  # run() swaps in one with the Installer's retries and delays
+        self.hedge = HEDGE  # whether to race slow downloads against the other places they can be had; set by run()
+        self.hedge_policy = HedgePolicy()  # how slow is slow, for that; run() swaps in one with the Installer's
+        self.probe_sizes = PROBE_SIZES  # whether to HEAD files we don't know the size of up front; set by run()
+        self.tag = tag
+
+    def __str__(self):
+        return str(self.tag)
+
+    @property
+    def pool(self):
+        return self.scheduler.pool
+
+    def _installed(self, path, source):
+        # Bookkeeping for a file that has finished downloading.
+        digest = None
+        expected = self.hashes.get(source)
+        if expected is not None:
+            digest = hash_file(path)
+            if digest != expected:
+                # Don't leave it where the lock file (or the next run) might take it for the real thing.
+                os.unlink(path)
+                raise IntegrityError('SHA-256 is %s, but the pack says %s' % (digest, expected))
+        if self.cache is not None:
+            digest = self.cache.add(source, path, digest)
+        elif digest is None:
+            digest = hash_file(path)
+        if self.packlock is not None:
+            self.packlock.record(path, source, digest)
+        if self.batch is not None:
+            self.batch.record(source, path, digest)
+
+    def _run(self, item, size=None, attempt=0):
+        name = filename_from_url(str(item[-2]))
+        progress = _progress.get()
+        job = progress.begin(self.tag, name, size) if progress is not None else None
+        ok = False
+        wait = None
+        try:
+            with trace(name, 'file', downloader=self.tag, size=size, attempt=attempt):
+                ok = self._process(item) is not False
+        except Exception as e:
+            wait = self.retry_policy.wait(attempt, e)
+            if wait is None:
+                self.failed_downloads[name] = e
+            else:
+                # Whatever made it to disk stays there, and the next attempt picks up from it.
+                output().write('%s: %s; trying again in %.1fs\n' % (name, e, wait))
+                # Waiting for a host to be given another chance uses up a retry too, or a download could wait on a
+                # dead host for as long as it kept failing the one request let through to it each cooldown.
+                attempt += 1
+        finally:
+            if wait is not None:
+                if job is not None:
+                    progress.retry(job)
+                self.scheduler.submit_later(wait, self._run, item, size, attempt, priority=-size if size else 0)
+            else:
+                if job is not None:
+                    progress.end(job, ok)
+                with self.idle:
+                    self.pending -= 1
+                    self.idle.notify_all()
+
+    def _process(self, item):
+        # item will be a tuple that gets formatted into our template, except for the last element,
+        # which is the output directory.
+        # we assume that the second last element in this tuple is some sort of human readable filename,
+        # or at least one we can fall back on if the server doesn't tell us what the actual filename is.
+        url = self._url(item)
+        output_dir = item[-1]
+        item = item[:-1]
+
+        resolution = self.resolved.pop(item, None)
+        maybe_filename = urllib.parse.unquote(item[-1])
+        if maybe_filename.endswith('.jar'):
+            # then it is definitely a filename
+            filename = maybe_filename
+        elif resolution is not None:
+            filename = resolution['filename'] or maybe_filename
+        else:
+            # we can't be absolutely certain that it's a filename, and put() couldn't find out ahead of time.  Best
+            # to double check.
+            with self.pool.request('HEAD', url) as resp:
+                if resp.status != 200:
+                    # Single writes to output() are atomic.  Calls to print(), which make multiple writes to
+                    # it, are not.
+                    output().write(f'Error {resp.status} on {maybe_filename}\n')
+                    raise DownloadError(resp)
+                resolution = self._remember(url, resp)
+            filename = resolution['filename'] or maybe_filename
+        # Now we know for certain what the filename is.
+        # Why do we need to know what the local filename is before we make the request? To resume downloads,
+        # of course!
+        output_path = os.path.join(output_dir, filename)
+        source = self.cache_key(*item)
+        self._unless_ours(source, output_path)
+        if self._patch(source, output_path):
+            pass
+        elif self._fetch(url, output_path, filename, resolution) is None:
+            output().write('%s is already up to date.\n'%filename)
+        self._installed(output_path, source)
+
+    def _unless_ours(self, source, path):
+        # Delete the file at path if it's as long as the one we last installed from source, but not the same file: it
+        # has been edited since, and fetch_file() would take it for the real thing by its size alone.
+        if self.packlock is None or os.path.isdir(path):
+            return
+        try:
+            if os.path.getsize(path) != self.packlock.size_of(source):
+                return
+            if hash_file(path) != self.packlock.sha256_of(source):
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _previous(self, digests):
+        # Path of a file we already have whose SHA-256 is one of digests, and which one, or None.  Anything installed
+        # here and untouched since will do, as will anything in the mod cache.
+        if self.packlock is not None:
+            with self.packlock.lock:
+                entries = list(self.packlock.files.items())
+            for relpath, entry in entries:
+                if entry['sha256'] in digests:
+                    path = os.path.join(self.packlock.outdir, relpath.replace('/', os.path.sep))
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    if st.st_size == entry['size'] and st.st_mtime_ns == entry['mtime']:
+                        return path, entry['sha256']
+        if self.cache is not None:
+            for digest in digests:
+                path = self.cache.object_path(digest)
+                if digest in self.cache.objects and os.path.exists(path):
+                    return path, digest
+        return None
+
+    def _patch(self, source, path):
+        # Make the file from source at path by patching an earlier version of it we already have with a delta from
+        # make_delta.py, if there is one.  Returns False if there isn't, or it didn't work out, in which case the file
+        # has to be downloaded whole after all.
+        if self.batch is None or os.path.isdir(path):
+            return False
+        deltas = self.batch.delta_index().get(source)
+        previous = deltas and self._previous(deltas)
+        if not previous:
+            return False
+        old_path, old_digest = previous
+        name = os.path.basename(path)
+        progress = _progress.get()
+        try:
+            with self.pool.request('GET', self.batch.deltas_url + deltas[old_digest], mirror=False) as resp:
+                if resp.status != 200:
+                    raise DownloadError(resp)
+                if progress is not None:
+                    progress.sized(get_content_length(resp))
+                delta = resp.read()
+            if progress is not None:
+                progress.advance(len(delta))
+            digest = apply_delta(delta, old_path, path)
+            expected = self.hashes.get(source)
+            if expected is not None and digest != expected:
+                os.unlink(path)
+                raise DeltaError('SHA-256 is %s, but the pack says %s' % (digest, expected))
+        except (OSError, http.client.HTTPException, DownloadError, DeltaError) as e:
+            output().write('Could not patch %s (%s), downloading it whole\n' % (name, e))
+            return False
+        output().write('Patched %s from %s with a %s delta\n' % (name, os.path.basename(old_path),
+                                                                   format_bytes(len(delta))))
+        return True
+
+    def _url(self, item):
+        return 'https://' + self.host + self.urltemplate.format(*item[:-1]).replace(' ', '+')
+
+    def _needs_name(self, item):
+        # Whether we have to ask the server what item's file is called before we can download it.
+        return not urllib.parse.unquote(item[-2]).endswith('.jar')
+
+    def _remember(self, url, resp):
+        # Note what a HEAD of url said, for this run and (if there's a cache) the ones after it.
+        resolution = {'final_url': None if resp.mirrored else resp.geturl(), 'filename': extract_filename(resp),
+                      'size': get_content_length(resp) or None, 'time': time.time()}
+        resolution.update(validators(resp))
+        if self.resolutions is not None:
+            self.resolutions.record(url, resolution)
+        return resolution
+
+    def _lookup(self, item):
+        # What we already know about item's download, if it's recent enough to go on.
+        if self.resolutions is None:
+            return None
+        return self.resolutions.get(self._url(item), self.resolve_ttl)
+
+    def _resolve(self, item):
+        # HEAD item's download to find out how big it is, what it's really called and where it really is.  Returns
+        # the resolution, or None if the HEAD failed (in which case _process() will try again, and report it).
+        url = self._url(item)
+        with self.pool.request('HEAD', url) as resp:
+            if resp.status != 200:
+                return None
+            resolution = self._remember(url, resp)
+        self.resolved[item[:-1]] = resolution
+        return resolution
+
+    def _fetch(self, url, dest, filename, resolution):
+        # fetch_file(), except that if we know where url redirects to, we go straight there.  (Not through a mirror,
+        # though, which only knows files by the URLs in the pack.)
+        final_url = resolution and resolution['final_url']
+        if final_url and final_url != url and self.pool.mirror is None:
+            try:
+                return self._download(url, dest, filename, final_url)
+            except DownloadError:
+                # Where it used to redirect to doesn't want us any more.  Links that expire do that.
+                if self.resolutions is not None:
+                    self.resolutions.forget(url)
+        return self._download(url, dest, filename)
+
+    def _download(self, url, dest, filename, via=None):
+        # fetch_file() of url (from via, if that's where we know it redirects to), raced against the other places the
+        # file can be had from if it's slow.
+        path = urllib.parse.urlsplit(url).path.lstrip('/')
+        urls = [via or url] + self.alternates.get(url, []) + [origin + path for origin in self.origins]
+        if not self.hedge or os.path.isdir(dest) or len(urls) == 1 and self.pool.mirror_url(urls[0]) is None:
+            return fetch_file(self.pool, urls[0], dest, filename)
+        if self.pool.mirror is None:
+            urls = self.pool.stats.rank(urls, self.pool.breaker)
+        else:
+            # The mirror only knows the file by the URL in the pack.
+            urls = urls[:1] + self.pool.stats.rank(urls[1:], self.pool.breaker)
+        return Race(self.pool, urls, dest, filename, self.hedge_policy).fetch()
+
+    def _resolve_then_queue(self, task, size):
+        try:
+            with trace('probe ' + filename_from_url(str(task[-2])), 'probe'):
+                resolution = self._resolve(task)
+        except Exception:
+            # Not knowing the size isn't fatal.  If the file really can't be had, _process() will say so.
+            resolution = None
+        if size is None and resolution is not None and resolution['size']:
+            size = resolution['size']
+            progress = _progress.get()
+            if progress is not None:
+                progress.expect(size)
+        self._queue(task, size)
+
+    def _queue(self, task, size):
+        # Biggest first; unknown sizes after everything we do know about.
+        self.scheduler.submit(self._run, task, size, priority=-size if size else 0)
+
+    def start(self):
+        self.scheduler.start()
+
+    def stop(self):
+        """Wait for everything we've been given to finish downloading."""
+        with self.idle:
+            self.idle.wait_for(lambda: not self.pending)
+
+    def put(self, *task, size=None):
+        """
+        Queue task for downloading.
+
+        :param size: How big the file is going to be, if we have some idea.  If not, and probe_sizes is on, we HEAD it
+                     before anything gets downloaded, so the biggest files can be started first.  Anything whose name
+                     we have to ask for gets HEADed then too, rather than holding up a download slot for it later.
+                     Either way, what we find out is remembered in our ResolutionCache, so next time we needn't ask.
+        """
+        with self.idle:
+            self.pending += 1
+        resolution = self._lookup(task)
+        if resolution is not None:
+            self.resolved[task[:-1]] = resolution
+            size = resolution['size'] or size
+        progress = _progress.get()
+        if progress is not None:
+            progress.queued(self.tag, size)
+        if resolution is None and (size is None and self.probe_sizes or self._needs_name(task)):
+            # HEADs are tiny, so they all go ahead of the real downloads.
+            self.scheduler.submit(self._resolve_then_queue, task, size, priority=-math.inf)
+        else:
+            self._queue(task, size)
+
+class ArbitraryURLDownloader(Downloader):
+    resolve_ttl = 24 * 3600  # these can be anything, including download links that move
+
+    def __init__(self, scheduler):
+        super().__init__(scheduler, None, None, 'files')
+
+    def _url(self, item):
+        return item[0]
+
+    def _needs_name(self, item):
+        return False  # fetch_file() gets it from the download itself, if dest is a directory
+
+    def _process(self, item):
+        url, dest = item
+        self._unless_ours(url, dest)
+        if self._patch(url, dest):
+            path = dest
+        else:
+            path = self._fetch(url, dest, None, self.resolved.pop(item[:-1], None))
+        if path is None:
+            output().write('%s is already up to date.\n' % dest)
+            path = dest
+        self._installed(path, url)
+
+
+class ZipDownloader(Downloader):
+    resolve_ttl = 3600  # only the size matters here, and a new version of the pack may well change it
+
+    def __init__(self, scheduler):
+        super().__init__(scheduler, None, None, 'ZIP files')
+        self.full_extract = FULL_EXTRACT  # extract every member, not just the ones that changed; set by run()
+
+    def _url(self, item):
+        return item[0]
+
+    def _needs_name(self, item):
+        return False
+
+    def _process(self, item):
+        import tempfile
+        import zipfile
+        url, dest = item
+        self.resolved.pop(item[:-1], None)
+        if not self.full_extract:
+            # Try to get away with downloading just the central directory and whichever members changed.
+            remote = HTTPRangeFile.open(self.pool, url)
+            if remote is not None:
+                with remote, zipfile.ZipFile(remote) as zf:
+                    self.extract(zf, url, dest)
+                output().write('%s: fetched %d of %d bytes\n' % (filename_from_url(url), remote.transferred,
+                                                                    remote.size))
+                return
+        tmpdir = tempfile.mkdtemp(prefix='swordfishpds-')
+        try:
+            path = fetch_file(self.pool, url, tmpdir)
+            try:
+                with zipfile.ZipFile(path) as zf:
+                    self.extract(zf, url, dest)
+            except Exception as e:
+                self.failed_downloads[os.path.basename(path)] = e
+                return False
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def extract(self, zf, url, dest):
+        """
+        Extract the members of zf that aren't already on disk, leaving the ones that are (same size and CRC) alone.
+        Prints which files were new, which changed, and which an earlier version of the zip installed but this one
+        doesn't have any more.
+        """
+        # relative path -> [CRC, size, mtime] as of when we last extracted (or checked) it, so that we only need to
+        # read a file back to check its CRC if it has been touched since.
+        known = self.packlock.zip_members(url) if self.packlock is not None else {}
+        name = filename_from_url(url)
+        members = {}
+        new = []
+        changed = []
+        wanted = []
+        started = time.perf_counter()
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            target = member_path(dest, info.filename)
+            relpath = self.packlock.relpath(target) if self.packlock is not None else info.filename
+            try:
+                st = os.stat(target)
+            except FileNotFoundError:
+                st = None
+            if self.full_extract or st is None or st.st_size != info.file_size or (
+                    known.get(relpath) != [info.CRC, st.st_size, st.st_mtime_ns] and crc32_file(target) != info.CRC):
+                (new if st is None else changed).append(relpath)
+                wanted.append((info, target, relpath))
+            else:
+                members[relpath] = [info.CRC, st.st_size, st.st_mtime_ns]
+                if self.batch is not None:
+                    self.batch.record_member(url, info, target)
+        trace_span('compare ' + name, 'extract', started, members=len(zf.infolist()))
+        # Anything another instance has already extracted gets copied from there instead.
+        shared = {info.filename: self.batch.member(url, info) for info, target, relpath in wanted} \
+            if self.batch is not None else {}
+        if isinstance(zf.fp, HTTPRangeFile):
+            with trace('prefetch ' + name, 'extract', members=len(wanted)):
+                zf.fp.prefetch_members(zf, [info for info, target, relpath in wanted if not shared.get(info.filename)])
+        started = time.perf_counter()
+        for info, target, relpath in wanted:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if shared.get(info.filename):
+                link_or_copy(shared[info.filename], target, hardlink=False)
+            else:
+                # Same as downloads: nothing goes in place until it's all there.
+                with zf.open(info) as fin, open(target + '.part', 'wb') as fout:
+                    shutil.copyfileobj(fin, fout, COPY_BUFFER_SIZE)
+                os.replace(target + '.part', target)
+            st = os.stat(target)
+            members[relpath] = [info.CRC, st.st_size, st.st_mtime_ns]
+            if self.batch is not None:
+                self.batch.record_member(url, info, target)
+        trace_span('extract ' + name, 'extract', started, members=len(wanted))
+        stale = sorted(set(known) - set(members))
+        if self.packlock is not None:
+            self.packlock.record_zip(url, members)
+        report = '%s: %d new, %d changed, %d unchanged, %d no longer in the zip\n' % (
+            name, len(new), len(changed), len(members) - len(new) - len(changed), len(stale))
+        for relpath in stale:
+            report += ' - %s\n' % relpath
+        output().write(report)
+        return new, changed, stale
+
+
+class HTTPRangeFile:
+    # Bytes we pull in when somebody reads something we haven't got.  The end of central directory record plus the
+    # longest possible zip comment fits in the first one.
+    READAHEAD = 64 * 1024 + 22
+
+    def __init__(self, pool, url, size):
+        """
+        A read-only, seekable file object backed by HTTP range requests, so zipfile.ZipFile can read the central
+        directory and just the members we want out of an archive on a web server without downloading the rest of it.
+        Use open() rather than calling this directly.
+
+        :param url: URL of the file, past any redirects.
+        :param size: Its length.
+        """
+        self.pool = pool
+        self.url = url
+        self.size = size
+        self.pos = 0
+        self.spans = []  # sorted, non-overlapping [(start, bytes)] of everything we've fetched
+        self.transferred = 0
+
+    @classmethod
+    def open(cls, pool, url):
+        """Returns an HTTPRangeFile for url, or None if the server won't do range requests."""
+        with pool.request('GET', url, {'Range': 'bytes=-%d' % cls.READAHEAD}) as resp:
+            content_range = parse_content_range(resp)
+            if resp.status != 206 or content_range is None:
+                return None
+            self = cls(pool, resp.geturl(), content_range[2])
+            self._store(content_range[0], resp.read())
+        self._transferred(len(self.spans[0][1]))
+        return self
+
+    def _transferred(self, n):
+        self.transferred += n
+        progress = _progress.get()
+        if progress is not None:
+            progress.advance(n)
+
+    def _store(self, start, data):
+        self.spans.append((start, data))
+        self.spans.sort(key=lambda span: span[0])
+        # Merge spans that touch or overlap.
+        merged = [self.spans[0]]
+        for start, data in self.spans[1:]:
+            last_start, last_data = merged[-1]
+            if start <= last_start + len(last_data):
+                overlap = last_start + len(last_data) - start
+                merged[-1] = (last_start, last_data + data[overlap:])
+            else:
+                merged.append((start, data))
+        self.spans = merged
+
+    def fetch(self, start, end):
+        """Fetch bytes start to end (exclusive) with a single request."""
+        end = min(end, self.size)
+        with self.pool.request('GET', self.url, {'Range': 'bytes=%d-%d' % (start, end - 1)}) as resp:
+            if resp.status != 206 or parse_content_range(resp) != (start, end - 1, self.size):
+                raise DownloadError(resp)
+            data = resp.read()
+        self._transferred(len(data))
+        self._store(start, data)
+
+    def prefetch_members(self, zf, infos):
+        """Fetch everything needed to extract infos, coalescing members that sit next to each other into one request."""
+        # A member runs from its local header to the start of whatever comes after it.
+        offsets = sorted(info.header_offset for info in zf.infolist()) + [zf.start_dir]
+        ends = dict(zip(offsets, offsets[1:]))
+        wanted = sorted((info.header_offset, ends[info.header_offset]) for info in infos)
+        spans = []
+        for start, end in wanted:
+            if spans and start - spans[-1][1] <= self.READAHEAD:
+                spans[-1][1] = end
+            else:
+                spans.append([start, end])
+        for start, end in spans:
+            if not self._has(start, end):
+                self.fetch(start, end)
+
+    def _has(self, start, end):
+        for span_start, data in self.spans:
+            if span_start <= start and end <= span_start + len(data):
+                return True
+        return False
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.size - self.pos
+        n = min(n, self.size - self.pos)
+        if n <= 0:
+            return b''
+        for span_start, data in self.spans:
+            if span_start <= self.pos < span_start + len(data):
+                chunk = data[self.pos - span_start:self.pos - span_start + n]
+                break
+        else:
+            self.fetch(self.pos, self.pos + max(n, self.READAHEAD))
+            return self.read(n)
+        self.pos += len(chunk)
+        if len(chunk) < n:
+            chunk += self.read(n - len(chunk))
+        return chunk
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self.spans = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def member_path(dest, name):
+    # Where ZipFile.extract() would put the member called name: no drive letters, and no climbing out of dest.
+    name = os.path.splitdrive(name.replace('/', os.path.sep))[1]
+    parts = [part for part in name.split(os.path.sep) if part not in ('', os.path.curdir, os.path.pardir)]
+    if os.path.sep == '\\':
+        import zipfile
+        parts = [zipfile.ZipFile._sanitize_windows_name(part, os.path.sep) for part in parts]
+    return os.path.join(dest, *parts)
+
+
+def crc32_file(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+#######################################################
+#######            SHARED MOD CACHE           #########
+#######################################################
+
+def default_cache_dir():
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'SwordfishPDS')
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def link_or_copy(src, dst, hardlink=True):
+    """
+    Make dst a copy of src as cheaply as the filesystem allows: a hardlink if we can, a reflink (copy-on-write clone)
+    if we can't, and an honest-to-god copy if all else fails.  dst is replaced atomically if it already exists.
+
+    :param hardlink: False for files that might get edited in place, like configs, where a hardlink would mean
+    editing every copy at once.
+    """
+    # Named for this process and thread, since other Installers (in this process or another) sharing a mod cache may
+    # be putting the very same file in place at the very same time.
+    tmp = '%s.%d-%d.swordfishpds-tmp' % (dst, os.getpid(), threading.get_ident())
+    try:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        linked = False
+        if hardlink:
+            try:
+                os.link(src, tmp)
+                linked = True
+            except OSError:
+                pass
+        if not linked:
+            try:
+                import fcntl
+                with open(src, 'rb') as fin, open(tmp, 'wb') as fout:
+                    fcntl.ioctl(fout.fileno(), 0x40049409, fin.fileno())  # FICLONE
+            except (ImportError, OSError):
+                shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        # Gone if it failed before it was made or the rename worked -- but renaming a hardlink onto another link to
+        # the same file does nothing at all, and a failure leaves it where it is.
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+
+
+class ModCache:
+    def __init__(self, root, max_size=None):
+        """
+        Content-addressed store of every file we have ever downloaded, shared between all the instances (and server
+        installs) on this machine, so that installing the same pack twice doesn't download it twice.
+
+        Files live in root/objects/ named after their SHA-256.  root/index.json maps lookup keys (such as
+        "cf:2888880" for a CurseForge file ID) to a hash and the filename the file should be installed under, and
+        remembers when each object was last used so the least recently used ones can be evicted once the cache grows
+        past max_size bytes.
+
+        :param root: Directory to keep the cache in.  Created if it doesn't exist.
+        :param max_size: Size cap in bytes.  Default is CACHE_MAX_SIZE.
+        """
+        self.root = root
+        self.max_size = CACHE_MAX_SIZE if max_size is None else max_size
+        self.index_path = os.path.join(root, 'index.json')
+        self.lock = threading.Lock()
+        self.keys = {}  # key -> {'sha256': ..., 'filename': ...}
+        self.objects = {}  # sha256 -> {'size': ..., 'atime': ...}
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        # Another process may have been using the cache at the same time as us.  Merge rather than clobber.
+        for key, entry in index.get('keys', {}).items():
+            self.keys.setdefault(key, entry)
+        for digest, entry in index.get('objects', {}).items():
+            mine = self.objects.get(digest)
+            if mine is None or mine['atime'] < entry['atime']:
+                self.objects[digest] = entry
+
+    def object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.keys.get(key)
+            if entry is None:
+                return None
+            if entry['sha256'] not in self.objects or not os.path.exists(self.object_path(entry['sha256'])):
+                # Somebody cleaned out the cache behind our back.
+                del self.keys[key]
+                return None
+            self.objects[entry['sha256']]['atime'] = time.time()
+            return entry
+
+    def install(self, key, dest_dir):
+        """
+        If we have the file for key, link it into dest_dir and return its index entry (which says what it was installed
+        as).  Otherwise return None.
+        """
+        entry = self.lookup(key)
+        if entry is None:
+            return None
+        src = self.object_path(entry['sha256'])
+        dest = os.path.join(dest_dir, entry['filename'])
+        try:
+            st = os.stat(dest)
+        except FileNotFoundError:
+            pass
+        else:
+            if os.path.samestat(st, os.stat(src)):
+                return entry
+            # Being the right size doesn't make it the right file: whatever's there gets the cache's hash in the lock
+            # file, and lock.check() never looks at it again, so it had better actually have it.
+            if st.st_size == self.objects[entry['sha256']]['size'] and hash_file(dest) == entry['sha256']:
+                return entry
+        link_or_copy(src, dest)
+        return entry
+
+    def add(self, key, path, digest=None):
+        """
+        Store the file at path in the cache under key (and under its hash).  Returns the hash.
+
+        :param digest: The file's hash, if the caller already worked it out.
+        """
+        if digest is None:
+            digest = hash_file(path)
+        obj = self.object_path(digest)
+        if not os.path.exists(obj):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            try:
+                link_or_copy(path, obj)
+            except OSError:
+                # Another Installer sharing the cache may have got there first (and on Windows, have it open).
+                if not (os.path.exists(obj) and hash_file(obj) == digest):
+                    raise
+        with self.lock:
+            self.objects[digest] = {'size': os.path.getsize(obj), 'atime': time.time()}
+            self.keys[key] = {'sha256': digest, 'filename': os.path.basename(path)}
+        return digest
+
+    def evict(self):
+        with self.lock:
+            total = sum(entry['size'] for entry in self.objects.values())
+            for digest in sorted(self.objects, key=lambda d: self.objects[d]['atime']):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.unlink(self.object_path(digest))
+                except FileNotFoundError:
+                    pass
+                total -= self.objects.pop(digest)['size']
+            for key in [key for key, entry in self.keys.items() if entry['sha256'] not in self.objects]:
+                del self.keys[key]
+
+    def save(self):
+        self._load()
+        self.evict()
+        with self.lock:
+            tmp = self.index_path + '.tmp%d' % os.getpid()
+            with open(tmp, 'w') as f:
+                json.dump({'keys': self.keys, 'objects': self.objects}, f)
+            os.replace(tmp, self.index_path)
+
+
+class ResolutionCache:
+    MAX_AGE = 30 * 24 * 3600  # entries older than any lookup would trust are dropped when we save
+
+    def __init__(self, path):
+        """
+        What HEAD requests have told us about download URLs -- where they redirect to, what the file is called, how big
+        it is, and its ETag and Last-Modified -- kept on disk so that later runs, of this pack or any other, needn't
+        ask again.  Each lookup says how old an answer it's prepared to trust.
+
+        :param path: JSON file to keep it in.  run() uses resolved.json in the ModCache's directory.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}  # URL -> {'final_url', 'filename', 'size', 'etag', 'last_modified', 'time'}
+        self.forgotten = set()  # so _load() doesn't bring them back
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        # Another process may have been using the cache at the same time as us.  Newest answer wins.
+        with self.lock:
+            for url, entry in entries.items():
+                mine = self.entries.get(url)
+                if url not in self.forgotten and (mine is None or mine['time'] < entry['time']):
+                    self.entries[url] = entry
+
+    def get(self, url, ttl):
+        """What we know about url, if we found it out less than ttl seconds ago.  Otherwise None."""
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry is None or time.time() - entry['time'] > ttl:
+            return None
+        return entry
+
+    def record(self, url, entry):
+        with self.lock:
+            self.entries[url] = entry
+            self.forgotten.discard(url)
+
+    def forget(self, url):
+        with self.lock:
+            self.entries.pop(url, None)
+            self.forgotten.add(url)
+
+    def save(self):
+        self._load()
+        with self.lock:
+            cutoff = time.time() - self.MAX_AGE
+            self.entries = {url: entry for url, entry in self.entries.items() if entry['time'] >= cutoff}
+            tmp = self.path + '.tmp%d' % os.getpid()
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.path)
+
+
+class OriginStats:
+    MIN_SAMPLES = 10  # fewer than this and a percentile is anybody's guess
+
+    def __init__(self, path=None):
+        """
+        How quickly each origin (scheme and host) has been answering requests and sending files: the last
+        ORIGIN_SAMPLES times to first byte and transfer rates of each.  Decides which of the places a file can be had
+        from to try first, and how slow a download has to be before a Race hedges it.
+
+        :param path: JSON file to keep it in from one run to the next, or None to only keep it for this one.  run()
+        uses origins.json in the ModCache's directory.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.origins = {}  # 'scheme://host' -> {'ttfb': [seconds], 'rate': [bytes a second]}
+        if path is not None:
+            try:
+                with open(path) as f:
+                    self.origins = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def _add(self, origin, kind, value):
+        with self.lock:
+            samples = self.origins.setdefault('%s://%s' % origin, {}).setdefault(kind, [])
+            samples.append(round(value, 4))
+            del samples[:-ORIGIN_SAMPLES]
+
+    def ttfb(self, origin, seconds):
+        self._add(origin, 'ttfb', seconds)
+
+    def rate(self, origin, rate):
+        self._add(origin, 'rate', rate)
+
+    def percentile(self, origin, kind, p):
+        """The pth percentile of origin's kind ('ttfb' or 'rate') samples, or None if there aren't enough yet."""
+        with self.lock:
+            samples = sorted(self.origins.get('%s://%s' % origin, {}).get(kind, ()))
+        if len(samples) < self.MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, len(samples) * p // 100)]
+
+    def rank(self, urls, breaker=None):
+        """
+        urls, quickest origin first, going by median time to first byte.  Origins we don't know about yet go after
+        the ones we do, and ones breaker is giving a rest go last; otherwise the order is kept.
+        """
+        def cost(url):
+            origin = origin_of(url)
+            median = self.percentile(origin, 'ttfb', 50)
+            return breaker is not None and breaker.is_open(origin), math.inf if median is None else median
+        return sorted(urls, key=cost)
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            tmp = self.path + '.tmp%d' % os.getpid()
+            with open(tmp, 'w') as f:
+                json.dump(self.origins, f)
+            os.replace(tmp, self.path)
+
+
+class PackLock:
+    def __init__(self, outdir):
+        """
+        SwordfishPDS-Lock.json: a record of every file run() has installed into an instance, with the size, mtime and
+        hash it had when we put it there, and where it came from.  If a file on disk still matches its entry, we know
+        it's the file the pack asked for without asking the network.
+
+        :param outdir: The instance (or server) directory the lock file lives in.
+        """
+        self.outdir = outdir
+        self.path = os.path.join(outdir, 'SwordfishPDS-Lock.json')
+        self.lock = threading.Lock()
+        self.version = None  # the pack version the last successful run installed
+        self.files = {}  # path relative to outdir -> {'source': ..., 'size': ..., 'mtime': ..., 'sha256': ...}
+        self.zips = {}  # Zipfile URL -> {path relative to outdir: [CRC, size, mtime]} for every file it extracted
+        self.sources = {}  # source -> path relative to outdir
+        self.seen = set()  # paths recorded or verified this run
+        try:
+            with open(self.path) as f:
+                lock = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        self.version = lock.get('version')
+        self.files = lock.get('files', {})
+        self.zips = lock.get('zips', {})
+        self.sources = {entry['source']: relpath for relpath, entry in self.files.items()}
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.outdir).replace(os.path.sep, '/')
+
+    def record(self, path, source, digest=None):
+        """Note that the file at path was just installed from source."""
+        st = os.stat(path)
+        if digest is None:
+            digest = hash_file(path)
+        relpath = self.relpath(path)
+        with self.lock:
+            old = self.files.get(relpath)
+            if old is not None:
+                self.sources.pop(old['source'], None)
+            self.files[relpath] = {'source': source, 'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha256': digest}
+            self.sources[source] = relpath
+            self.seen.add(relpath)
+
+    def size_of(self, source):
+        """How big the file we last installed from source was, or None if we never have."""
+        relpath = self.sources.get(source)
+        return None if relpath is None else self.files[relpath]['size']
+
+    def sha256_of(self, source):
+        """The SHA-256 of the file we last installed from source, or None if we never have."""
+        relpath = self.sources.get(source)
+        return None if relpath is None else self.files[relpath]['sha256']
+
+    def zip_members(self, url):
+        return self.zips.get(url, {})
+
+    def record_zip(self, url, members):
+        with self.lock:
+            self.zips[url] = members
+
+    def check(self, source, scan=None):
+        """
+        If the file we installed from source is still on disk, untouched, return its path.  Otherwise return None.
 
-#######################################################
-#######          DOWNLOAD MACHINERY           #########
-#######################################################
+        :param scan: Optional Reconciler, whose directory listings save a stat() call.
+        """
+        relpath = self.sources.get(source)
+        if relpath is None:
+            return None
+        entry = self.files[relpath]
+        path = os.path.join(self.outdir, relpath.replace('/', os.path.sep))
+        if scan is not None:
+            st = scan.stat(path)
+        else:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+        if st is None:
+            return None
+        if st.st_size != entry['size'] or st.st_mtime_ns != entry['mtime']:
+            return None
+        with self.lock:
+            self.seen.add(relpath)
+        return path
 
+    def save(self, version=None):
+        """
+        Write the lock file back out, forgetting files that weren't part of this run.
 
-def extract_filename(resp, fallback=None):
-    content_disposition = resp.headers.get('Content-Disposition')
-    if content_disposition:
-        for part in content_disposition.split(';'):
-            part = part.strip()
-            if part.startswith('filename='):
-                return part[9:].strip('"')
-                break
-    return fallback or filename_from_url(resp.geturl())
+        :param version: The version string to record, if the run succeeded.
+        """
+        if version is not None:
+            self.version = version
+        with self.lock:
+            files = {relpath: self.files[relpath] for relpath in self.seen}
+            zips = dict(self.zips)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': self.version, 'files': files, 'zips': zips}, f, indent=1)
+        os.replace(tmp, self.path)
 
 
-def filename_from_url(url):
-    if '?' in url:
-        return url
-    path = urllib.parse.urlsplit(url).path
-    return path[path.rfind('/') + 1:]
 
+class Reconciler:
+    def __init__(self, outdir, mods_dir, server_mode=False):
+        """
+        Works out what run() has to do to the files already in an instance -- which ones to re-enable, which to Nuke,
+        which mods nobody asked for -- and does it all at once.  Every directory it's asked about gets listed once with
+        os.scandir() and answered from then on out of the listing, rather than with an exists() or stat() per row, so
+        it costs the same whether the pack has ten mods or ten thousand.
 
-def get_content_length(resp, default=0):
-    length = resp.getheader('Content-Length', default)
-    try:
-        return int(length)
-    except ValueError:
-        return 0
+        :param outdir: The instance (or server) directory.
+        :param mods_dir: Where MODs go.
+        :param server_mode: Whether it's a server install, for sanitize_path().
+        """
+        self.outdir = outdir
+        self.mods_dir = mods_dir
+        self.server_mode = server_mode
+        self.listings = {}  # directory -> {name: os.DirEntry, or os.stat_result for files we've moved}
+        self.mods = set()  # filenames (unquoted) of every MOD in the pack
+        self.duds = set()  # filenames of MODs somebody else installs, which had better be there by the end
+        self.enable = {}  # path -> the path.disabled to rename back to it
+        self.nuke = {}  # path -> True to delete it (there's a .disabled already), False to disable it
 
+    def listing(self, directory):
+        listing = self.listings.get(directory)
+        if listing is None:
+            try:
+                with os.scandir(directory) as it:
+                    listing = {entry.name: entry for entry in it}
+            except (FileNotFoundError, NotADirectoryError):
+                listing = {}
+            self.listings[directory] = listing
+        return listing
 
-def copyfileobj(fin, fout, filename='', sz=0):
-    buffer = bytearray(64 * 1024)
-    bufsz = 64 * 1024
-    t = time.perf_counter()
-    total = 0
-    while True:
-        n = fin.readinto(buffer)
-        if n == bufsz:
-            fout.write(buffer)
-        elif n == 0:
-            return
-        else:
-            with memoryview(buffer)[:n] as view:
-                fout.write(view)
-        total += n
-        if time.perf_counter() >= t + 1:
-            # Calls to sys.stdout.write() are atomic.  Calls to print() are not.
-            if sz:
-                sys.stdout.write('Downloading %s (%.1f%% complete)\n' % (filename, (total * 100) / sz))
-            else:
-                sys.stdout.write('Downloading %s (%d bytes transferred)\n' % (filename, total))
-            t = time.perf_counter()
+    def stat(self, path):
+        """os.stat(path), as it was when its directory was listed, or None if it wasn't there."""
+        directory, name = os.path.split(path)
+        entry = self.listing(directory).get(name)
+        if entry is None or isinstance(entry, os.stat_result):
+            return entry
+        try:
+            return entry.stat()
+        except OSError:
+            return None
 
+    def exists(self, path):
+        directory, name = os.path.split(path)
+        return name in self.listing(directory)
 
-def download(url, failed_downloads):
-    try:
-        resp = urllib.request.urlopen(url)
-    except Exception as e:
-        if isinstance(url, urllib.request.Request):
-            url = url.get_full_url()
-        failed_downloads[filename_from_url(url)] = e
-        return None
-    return resp
+    def path(self, filename):
+        """Where filename, as the pack gives it for a Download, Zipfile or Nuke, is in this instance."""
+        return os.path.join(self.outdir, sanitize_path(filename, self.server_mode))
 
+    def plan(self, rows):
+        """Work out the enables and Nukes rows call for, in one pass, without touching anything."""
+        for type, *arg in rows:
+            if type == 'MOD':
+                modid, filename = arg
+                self.mods.add(urllib.parse.unquote(filename))
+                if not modid:
+                    self.duds.add(filename)
+                # if the mod exists, but is disabled, don't download it again
+                # as that both wastes time and confuses MultiMC.
+                self._want(os.path.join(self.mods_dir, filename))
+            elif type == 'Download':
+                # if the download got far enough to be disabled, assume it's good.
+                self._want(self.path(arg[1]))
+            elif type == 'Nuke':
+                path = self.path(arg[0])
+                self.enable.pop(path, None)
+                if self.exists(path):
+                    self.nuke[path] = self.exists(path + '.disabled')
 
-def sanitize_path(filename):
-    if SERVER_MODE:
-        if filename.startswith('.minecraft'):
-            filename = filename[10:]
-            if filename.startswith('/'):
-                filename = filename[1:]
-    return filename.replace('/', os.path.sep)
+    def _want(self, path):
+        self.nuke.pop(path, None)
+        if not self.exists(path) and self.exists(path + '.disabled'):
+            self.enable[path] = path + '.disabled'
 
-class Downloader:
-    def __init__(self, host, urlformat, tag=''):
-        """
+    def _move(self, src, dst):
+        st = self.stat(src)
+        os.replace(src, dst)
+        self.listing(os.path.dirname(src)).pop(os.path.basename(src), None)
+        if st is not None:
+            self.listing(os.path.dirname(dst))[os.path.basename(dst)] = st
 
+    def apply(self):
+        """Carry out the plan.  Returns the paths that were re-enabled."""
+        for path, disabled in self.enable.items():
+            self._move(disabled, path)
+        for path, delete in self.nuke.items():
+            if delete:
+                os.unlink(path)
+                self.listing(os.path.dirname(path)).pop(os.path.basename(path), None)
+            else:
+                self._move(path, path + '.disabled')
+        return set(self.enable)
 
-        :param host: The FQDN of the host to connect to. (Everything before the first slash in the url.)
-        :param urlformat: Everything after (and including) the first slash in the URL.  Should contain str.format()
-        paramters (i.e. {0}) that will be substituted with values passed to put().
-        :param dir: Path to the local directory we should dump our files in.
-        :param tag: Human readable string of what this downloader is for.  Returned by str(downloader).
+    def finish(self, lock):
         """
-        self.host=host
-        self.urltemplate=urlformat
-        self.queue=queue.Queue()
-        # can't use a stopping boolean because of a race condition -- what if one thread is already blocked on get()
-        # when self.stopping becomes true?
-        self.threads = []
-        self.failed_downloads = {}
-        self.tag = tag
+        Once everything has been installed: (mods in mods_dir the pack doesn't list, dud mods that never turned up).
+        mods_dir gets listed again, since the downloads will have changed it.
 
-    def __str__(self):
-        return str(self.tag)
+        :param lock: The PackLock, whose record of what this run installed covers mods saved under some other name
+        than the pack gave them.
+        """
+        self.listings.pop(self.mods_dir, None)
+        present = set(self.listing(self.mods_dir))
+        prefix = lock.relpath(self.mods_dir) + '/'
+        installed = {relpath[len(prefix):] for relpath in lock.seen if relpath.startswith(prefix)}
+        surplus = sorted(name for name in present - self.mods - installed if name.endswith('.jar'))
+        return surplus, sorted(self.duds - present)
 
-    def _worker(self):
-        self.threads.append(threading.current_thread())
-        connection = http.client.HTTPSConnection(self.host)
-        while True:
-            item = self.queue.get()
-            if item is None:
-                connection.close()
-                return
-            # item will be a tuple that gets formatted into our template, except for the last element,
-            # which is the output directory.
-            # we assume that the second last element in this tuple is some sort of human readable filename,
-            # or at least one we can fall back on if the server doesn't tell us what the actual filename is.
-            output_dir = item[-1]
-            item = item[:-1]
-
-            urlpath = self.urltemplate.format(*item).replace(' ', '+')
-            maybe_filename = urllib.parse.unquote(item[-1])
-            if maybe_filename.endswith('.jar'):
-                # then it is definitely a filename
-                filename = maybe_filename
-            else:
-                # we can't be absolutely certain that it's a filename.  Best to double check.
-                connection.request('HEAD', urlpath, headers={'User-Agent': 'SwordfishPDS-1.0'})
-                with connection.getresponse() as resp:
-                    if resp.code != 200:
-                        # Single writes to sys.stdout are atomic.  Calls to print(), which make multiple writes to
-                        # sys.stdout, are not.
-                        sys.stdout.write(f'Error {resp.code} on {maybe_filename}')
-                        self.failed_downloads[maybe_filename] = '%d %s' % (resp.code, resp.reason)
-                        if resp.headers['Connection'] == 'keep-alive':
-                            resp.read()  # known bug in http library.
-                        continue
-                    filename = extract_filename(resp) or maybe_filename
-            # Now we know for certain what the filename is.
-            # Why do we need to know what the local filename is before we make the request? To resume downloads,
-            # of course!
-            output_path = os.path.join(output_dir, filename)
-            if os.path.exists(output_path):
-                fout = open(output_path, 'ab')
-                my_length=fout.tell()
-                connection.request('GET', urlpath, headers={
-                    'User-Agent': 'SwordfishPDS-1.0',
-                    'Range': f'bytes={my_length}-'
-                })
-            else:
-                fout=open(output_path, 'wb')
-                connection.request('GET', urlpath, headers={'User-Agent': 'SwordfishPDS-1.0'})
-            with fout, connection.getresponse() as resp:
-                if resp.code == 416:  # 416 Range Not Satisfiable
-                    # We've already got the whole file.
-                    sys.stdout.write('%s is already up to date.\n'%filename)
-                    if resp.headers.get('Connection') == 'keep-alive':
-                        resp.read()  # work around bug in http.client.
-                    continue
-                elif resp.code != 200 and resp.code != 206:  # 200 OK, or 206 Partial Response for Range header
-                    self.failed_downloads[filename] = '%d %s' % (resp.code, resp.reason)
-                    print(resp.headers['Connection'])
-                    if resp.headers['Connection'] == 'keep-alive':
-                        resp.read()
-                    continue
-                copyfileobj(resp, fout, filename, get_content_length(resp))
-
-    def start(self, nthreads):
-        if self.threads:
-            # No-op if we're already running.
-            return
-        for _ in range(nthreads):
-            threading.Thread(target=self._worker).start()
+    def disable(self, names):
+        for name in names:
+            path = os.path.join(self.mods_dir, name)
+            try:
+                os.rename(path, path + '.disabled')
+            except FileExistsError:
+                os.unlink(path)
 
-    def stop(self):
-        if not self.threads:
-            return
-        for _ in self.threads:
-            self.queue.put(None)
-        for thread in self.threads:
-            thread.join()
-        # Clear out the queue.
-        while not self.queue.empty():
-            item = self.queue.get_nowait()
-            assert item is None, "Entry %s still in queue when join() was called!" % (item,)
-        self.threads.clear()
+    def delete(self, names):
+        for name in names:
+            os.unlink(os.path.join(self.mods_dir, name))
 
-    def put(self, *task):
-        assert self.threads, "attempt to put a task in the queue while the thread pool was halted"
-        self.queue.put(task)
 
-class ArbitraryURLDownloader(Downloader):
-    def __init__(self):
-        super().__init__(None, None, 'files')
-    def _worker(self):
-        self.threads.append(threading.current_thread())
-        while True:
-            item = self.queue.get()
-            if item is None:
-                return
-            url, dest = item
-            if os.path.isfile(dest):
-                # the path we have been passed is a file path, not a directory path,
-                # and it points to a file that already exists on disk.
-                # Resume download if possible.
-                fout = open(dest, 'ab')
-                filename = dest
-                req = urllib.request.Request(url, headers={'User-Agent': 'SwordfishPDS-1.0',
-                                                           'Range': 'bytes=%d-' % fout.tell()})
-            else:
-                # Don't trust that the last part of the URL is the filename.  It almost never is.
-                fout = None
-                filename = None
-                req = urllib.request.Request(url, headers={'User-Agent': 'SwordfishPDS-1.0'})
-            resp = download(req, self.failed_downloads)
-            if resp is None:
-                continue
-            with resp:
-                if os.path.isdir(dest):
-                    filename = extract_filename(resp)
-                    fout = open(os.path.join(dest, filename), 'wb')
-                elif fout is None:
-                    os.makedirs(os.path.dirname(dest), exist_ok=True)
-                    fout = open(dest, 'wb')
-                with fout:
-                    copyfileobj(resp, fout, filename, get_content_length(resp))
+class Batch:
+    def __init__(self, installer):
+        """
+        What every instance run_batch() installs into has in common: one scheduler (and so one pool of connections to
+        keep alive), one mod cache, and a note of where each file ended up once it was installed.  The first instance
+        to need a file downloads it; the rest link or copy it from wherever that put it.
 
+        :param installer: The Installer doing the run, whose settings we go by.
+        """
+        self.installer = installer
+        self.scheduler = TransferScheduler(installer.max_transfers, installer.max_per_host, installer.mirror)
+        pool = self.scheduler.pool
+        pool.breaker = CircuitBreaker(installer.breaker_threshold, installer.breaker_cooldown,
+                                      installer.breaker_give_up)
+        pool.timeout = installer.socket_timeout
+        pool.cookies = installer.cookies
+        pool.chunk_threshold = installer.chunk_threshold
+        pool.chunks = installer.chunks
+        pool.zero_copy = installer.zero_copy
+        self.cache = installer.open_cache()
+        self.resolutions = None
+        if self.cache is not None:
+            self.resolutions = ResolutionCache(os.path.join(self.cache.root, 'resolved.json'))
+            self.scheduler.pool.stats = OriginStats(os.path.join(self.cache.root, 'origins.json'))
+        self.lock = threading.Lock()
+        self.installed = {}  # source -> (path, sha256) of the file an instance installed from it
+        self.members = {}  # (Zipfile URL, member name, CRC) -> path an instance extracted it to
+        self.deltas_url = installer.deltas and installer.deltas.rstrip('/') + '/'
+        self.deltas = None  # make_delta.py's index.json, once delta_index() has fetched it
+        self.deltas_wanted = False  # whether some thread has set about fetching it
+        self.deltas_fetched = threading.Event()
 
-class ZipDownloader(Downloader):
-    def __init__(self):
-        super().__init__(None, None, 'ZIP files')
+    def record(self, source, path, digest):
+        with self.lock:
+            self.installed[source] = (path, digest)
 
-    def _worker(self):
-        self.threads.append(threading.current_thread())
-        while True:
-            item = self.queue.get()
-            if item is None:
-                return
-            url, dest = item
-            with tempfile.TemporaryFile() as f:
-                resp = download(urllib.request.Request(url, headers={'User-Agent': 'SwordfishPDS-1.0'}),
-                                self.failed_downloads)
-                if not resp:
-                    continue
-                copyfileobj(resp, f, extract_filename(resp), get_content_length(resp))
-                try:
-                    with zipfile.ZipFile(f) as zf:
-                        zf.extractall(dest)
-                except Exception as e:
-                    self.failed_downloads[extract_filename(resp)] = e
+    def share(self, source, dest):
+        """
+        If an instance has already installed the file from source, copy it to dest (or into it, if that's a directory)
+        and return (path, sha256).  Otherwise None.
+        """
+        with self.lock:
+            installed = self.installed.get(source)
+        if installed is None or not os.path.exists(installed[0]):
+            return None
+        src, digest = installed
+        if os.path.isdir(dest):
+            dest = os.path.join(dest, os.path.basename(src))
+        if os.path.abspath(src) != os.path.abspath(dest):
+            link_or_copy(src, dest)
+        return dest, digest
 
+    def record_member(self, url, info, path):
+        with self.lock:
+            self.members[url, info.filename, info.CRC] = path
 
+    def member(self, url, info):
+        """Where an instance extracted the zip member info from url, or None if none has."""
+        with self.lock:
+            path = self.members.get((url, info.filename, info.CRC))
+        return path if path is not None and os.path.exists(path) else None
 
-# Necessary because Python, unlike Java, does not allow manual synchronization of I/O descriptors.
-# Single calls to write() are atomic but print() makes multiple calls!
-def print_thread(q):
-    while True:
-        item=q.get()
-        if item is None: return
-        print(item)
+    def delta_index(self):
+        """
+        {source: {SHA-256 of an earlier version: delta filename}} for every file there's a delta to, fetched from
+        deltas_url the first time anybody asks.  Empty if there's no deltas_url or it can't be had.
+        """
+        if self.deltas_url is None:
+            return {}
+        with self.lock:
+            fetching = not self.deltas_wanted
+            self.deltas_wanted = True
+        if not fetching:
+            # Somebody else is on it.  Only they wait on the network; everybody else just waits for them, not for
+            # self.lock, which record(), share() and member() need in the meantime.
+            self.deltas_fetched.wait()
+            return self.deltas
+        deltas = {}
+        try:
+            with self.scheduler.pool.request('GET', self.deltas_url + 'index.json', mirror=False) as resp:
+                if resp.status == 200:
+                    deltas = json.loads(resp.read())
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            output().write('Could not get the list of deltas (%s), downloading updates whole\n' % e)
+        finally:
+            # Even if something we didn't expect went wrong, so nobody waits forever.
+            with self.lock:
+                self.deltas = deltas
+            self.deltas_fetched.set()
+        return deltas
+
+    def save(self):
+        if self.cache is not None:
+            try:
+                with trace('save cache index', 'run'):
+                    self.cache.save()
+                    self.resolutions.save()
+                    self.scheduler.pool.stats.save()
+            except OSError as e:
+                print('Could not save the mod cache index:', e, file=output())
 
-printq=queue.Queue()
-threading.Thread(target=print_thread, args=(printq,), daemon=True).start()
+
+InstallResult = collections.namedtuple('InstallResult', 'outdir up_to_date failed duds surplus reconciler')
 
 
 ##################################################
 ############ FILE FORMAT #########################
 ##################################################
 
-def run(f, outdir, created_modpack=True, ignore_version_cookie=False):
-    mod_downloader = Downloader('media.forgecdn.net', '/files/{0}/{1}/{2}', 'mods')
-    mods_dir = os.path.join(outdir, 'mods') if SERVER_MODE else os.path.join(outdir, '.minecraft', 'mods')
-    all_mods = []
-    dud_mods = []
+MANIFEST_MAGIC = b'SWORDFISHPDS-MANIFEST/1\n'  # what a pack compiled by compile_pack.py starts with
+# How many fields each type of row takes.  None: any number.
+PACK_ARGS = {'MOD': 2, 'Zipfile': 3, 'Download': 2, 'Version': 1, 'Nuke': 1, 'ICON': None, 'Origin': 1}
+PACK_MORE = {'Download'}  # rows that can have more fields than PACK_ARGS says: other URLs the same file is at
+
+
+class PackError(Exception):
+    def __init__(self, problems):
+        super().__init__('\n'.join(problems))
+        self.problems = problems
+
+
+def parse_pack(text):
+    """
+    The rows of a pack CSV, as lists of fields with the padding people line their columns up with stripped off.
+    Comments and blank lines are dropped.
+    """
+    import csv
+    # ugly (or beautiful depending on how you look at it) python 3 hack for comment characters
+    lines = filter(lambda line: line.strip() and not line.startswith('#'), text.splitlines())
+    return [[field.strip() for field in row] for row in csv.reader(lines)]
+
+
+def mod_source(modid):
+    """The source of the CurseForge file with ID modid (an int or a string of digits), e.g. cf:2888880."""
+    return 'cf:%d' % int(modid)
+
+
+def row_source(row):
+    """What the lock file, the mod cache and a manifest's sizes and hashes know the file a row installs by, if any."""
+    if row[0] == 'MOD':
+        return mod_source(row[1]) if row[1] and int(row[1]) else None
+    if row[0] in ('Download', 'Zipfile'):
+        return row[1]
+    return None
+
+
+def dedupe_rows(rows):
+    """rows without any MOD or Download that repeats an earlier one exactly.  Returns (rows, the ones dropped)."""
+    seen = set()
+    kept = []
+    dropped = []
+    for row in rows:
+        if row[0] in ('MOD', 'Download'):
+            if tuple(row) in seen:
+                dropped.append(row)
+                continue
+            seen.add(tuple(row))
+        kept.append(row)
+    return kept, dropped
+
+
+def check_rows(rows):
+    """Everything wrong with rows that would otherwise only come to light halfway through an install, as a list."""
+    problems = []
+    ids = {}  # file ID -> filename
+    names = {}  # filename -> file ID
+    for row in rows:
+        type, *arg = row
+        where = ','.join(row)
+        if type not in PACK_ARGS:
+            problems.append('%s: unknown row type %r' % (where, type))
+            continue
+        if PACK_ARGS[type] is not None and len(arg) != PACK_ARGS[type] \
+                and not (type in PACK_MORE and len(arg) > PACK_ARGS[type]):
+            problems.append('%s: %s takes %d fields, not %d' % (where, type, PACK_ARGS[type], len(arg)))
+            continue
+        if type == 'MOD':
+            modid, filename = arg
+            if not filename:
+                problems.append('%s: no filename' % where)
+            if not modid:
+                continue  # dud mod, installed by other means
+            if not (modid.isdigit() and len(modid) <= 7):
+                problems.append('%s: %r is not a CurseForge file ID' % (where, modid))
+                continue
+            modid = int(modid)
+            if modid and ids.setdefault(modid, filename) != filename:
+                problems.append('%s: file %d is already in the pack as %s' % (where, modid, ids[modid]))
+            if names.setdefault(filename, modid) != modid:
+                problems.append('%s: %s is already in the pack as file %d' % (where, filename, names[filename]))
+        elif type in ('Zipfile', 'Version'):
+            try:
+                parse_version(arg[-1])
+            except (AssertionError, ValueError):
+                problems.append('%s: %r is not a version number' % (where, arg[-1]))
+        elif type in ('Download', 'Nuke') and not all(arg):
+            problems.append('%s: empty field' % where)
+        elif type == 'Origin' and urllib.parse.urlsplit(arg[0]).scheme not in ('http', 'https'):
+            problems.append('%s: %r is not an http(s) URL' % (where, arg[0]))
+    return problems
+
+
+class Pack:
+    def __init__(self, rows, sizes=None, hashes=None):
+        """
+        A pack that has been checked over, with everything run() needs to know up front worked out ahead of time.
+
+        :param rows: The pack's rows, as from parse_pack().  Exact repeats of a MOD or Download are dropped.
+        :param sizes: {source: size in bytes} for the files rows install, keyed as row_source() says.  A compiled
+        manifest carries these, so that nothing needs HEADing to find out which downloads are the big ones.
+        :param hashes: {source: SHA-256}, likewise.  Downloads that don't match are failed.
+        :raises PackError: if anything is wrong with rows, listing all of it.
+        """
+        self.rows, _ = dedupe_rows(rows)
+        self.sizes = sizes or {}
+        self.hashes = hashes or {}
+        problems = check_rows(self.rows)
+        if problems:
+            raise PackError(problems)
+        self.version = pack_version(self.rows)
+        self.payload = json.dumps({'rows': self.rows, 'sizes': self.sizes, 'sha256': self.hashes},
+                                  sort_keys=True, separators=(',', ':')).encode('utf-8')
+        self.digest = hashlib.sha256(self.payload).hexdigest()
+
+    def dump(self):
+        """The pack as a compiled manifest: MANIFEST_MAGIC, then the rows, sizes and hashes as zlib'd JSON."""
+        return MANIFEST_MAGIC + zlib.compress(self.payload, 9)
+
+    @classmethod
+    def load(cls, data):
+        """A Pack from the contents of a pack file, either a CSV or a compiled manifest (bytes, or a CSV as text)."""
+        if isinstance(data, str):
+            return cls(parse_pack(data))
+        if data.startswith(MANIFEST_MAGIC):
+            try:
+                manifest = json.loads(zlib.decompress(data[len(MANIFEST_MAGIC):]))
+            except (zlib.error, ValueError) as e:
+                raise PackError(['corrupt manifest: %s' % e])
+            return cls(manifest['rows'], manifest['sizes'], manifest['sha256'])
+        return cls(parse_pack(data.decode('utf-8-sig')))
+
+    def diff(self, old):
+        """
+        (rows added, rows removed) going from the pack old to this one.  The same pack twice is spotted by its digest
+        without looking at any rows.
+        """
+        if old.digest == self.digest:
+            return [], []
+        mine = set(map(tuple, self.rows))
+        theirs = set(map(tuple, old.rows))
+        added = [row for row in self.rows if tuple(row) not in theirs]
+        return added, [row for row in old.rows if tuple(row) not in mine]
+
+
+DELTA_MAGIC = b'SWORDFISHPDS-DELTA/1\n'  # what a delta made by make_delta.py starts with
+
+
+class DeltaError(Exception):
+    pass
+
+
+def apply_delta(delta, old_path, path):
+    """
+    Rebuild a file from a delta made by make_delta.py and the earlier version of it at old_path, and save it at path.
+    A delta is DELTA_MAGIC, then zlib'd: a line of JSON with the new file's size and SHA-256 and the list of ops that
+    make it, each [offset, length] to copy from the old file or [null, length] for the next bytes after the JSON, and
+    then those bytes.  Returns the SHA-256.
+
+    :raises DeltaError: if the delta is corrupt or what it makes isn't the file it was made from.  Nothing is left at
+    path.
+    """
+    if not delta.startswith(DELTA_MAGIC):
+        raise DeltaError('not a delta')
+    try:
+        header, _, inserts = zlib.decompress(delta[len(DELTA_MAGIC):]).partition(b'\n')
+        header = json.loads(header)
+    except (zlib.error, ValueError) as e:
+        raise DeltaError('corrupt delta: %s' % e)
+    h = hashlib.sha256()
+    size = 0
+    pos = 0
+    tmp = path + '.delta'
+    try:
+        with open(old_path, 'rb') as old, open(tmp, 'wb') as out:
+            for offset, length in header['ops']:
+                if offset is None:
+                    block = inserts[pos:pos + length]
+                    pos += length
+                else:
+                    old.seek(offset)
+                    block = old.read(length)
+                if len(block) != length:
+                    raise DeltaError('delta runs past the end of %s' % ('itself' if offset is None else old_path))
+                h.update(block)
+                out.write(block)
+                size += length
+        digest = h.hexdigest()
+        if size != header['size'] or digest != header['sha256']:
+            raise DeltaError("doesn't make the file it was made from (was %s patched since?)" % old_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+    os.replace(tmp, path)
+    return digest
+
+
+class Installer:
+    def __init__(self, server_mode=None, use_cache=None, cache_dir=None, cookies=None, mirror=None, deltas=None,
+                 hedge=None, retries=None, full_extract=None, surplus=None, trace_file=None, progress_json=None,
+                 max_transfers=None, probe_sizes=None, chunk_threshold=None, chunks=None, zero_copy=None, stream=None,
+                 max_per_host=None, socket_timeout=None, cache_max_size=None, retry_delay=None, retry_max_delay=None,
+                 breaker_threshold=None, breaker_cooldown=None, breaker_give_up=None, hedge_percentile=None,
+                 hedge_delay=None, hedge_min_delay=None, hedge_grace=None):
+        """
+        Installs packs, going by its own settings rather than this module's globals, so that a launcher can import
+        SwordfishPDS and run as many installs as it likes at once, from as many threads, each Installer with settings
+        of its own.  Nothing is left running between runs.
+
+        Every setting left as None is taken from the module global of the same name (what the command line sets) when
+        the Installer is made.  False turns off the ones that are off when they're None.
+
+        :param server_mode: Whether targets are servers rather than MultiMC instances, unless they say.  SERVER_MODE.
+        :param use_cache: Whether to use the mod cache.  Not NO_CACHE, and not NO_COOKIE either.
+        :param cache_dir: Where the mod cache is.  CACHE_DIR, or default_cache_dir().
+        :param cookies: http.cookiejar.CookieJar for downloads to keep their cookies in.  COOKIE_JAR.
+        :param mirror: Base URL of a LAN mirror (server.py --mirror).  MIRROR.
+        :param deltas: Base URL of make_delta.py's deltas.  DELTAS, unless NO_DELTAS.
+        :param hedge: Whether to race slow downloads against the other places they can be had.  HEDGE.
+        :param retries: How many times to retry downloads that fail for reasons that might go away.  RETRIES.
+        :param full_extract: Whether to extract every file from Zipfiles, not just the ones that changed.  FULL_EXTRACT.
+        :param surplus: One of SURPLUS_CHOICES, to do that with mods the pack doesn't list instead of asking.  SURPLUS.
+        :param trace_file: Where to save a Chrome trace of each run.  TRACE_FILE.
+        :param progress_json: Where to write progress events, one JSON object per line.  PROGRESS_JSON.
+        :param max_transfers: Most downloads to have in flight at once.  MAX_TRANSFERS.
+        :param probe_sizes: Whether to HEAD files we don't know the size of before downloading any.  PROBE_SIZES.
+        :param chunk_threshold: Size in bytes from which files are downloaded in parallel chunks.  CHUNK_THRESHOLD.
+        :param chunks: How many chunks.  CHUNKS.
+        :param zero_copy: Whether to splice plain HTTP downloads straight to disk, where the OS can.  ZERO_COPY.
+        :param stream: Where runs print to (see output()), with their status line if it's a terminal.  sys.stdout.
+        :param max_per_host: Most connections to have open to any one host.  MAX_PER_HOST.
+        :param socket_timeout: Seconds to wait on a connection before giving up on it.  SOCKET_TIMEOUT.
+        :param cache_max_size: Size in bytes the mod cache is trimmed back to.  CACHE_MAX_SIZE.
+        :param retry_delay: Seconds before the first retry, doubling after.  RETRY_DELAY.
+        :param retry_max_delay: Most seconds between retries.  RETRY_MAX_DELAY.
+        :param breaker_threshold: Failures in a row before a host is left alone for a while.  BREAKER_THRESHOLD.
+        :param breaker_cooldown: Seconds a host is left alone for.  BREAKER_COOLDOWN.
+        :param breaker_give_up: Times in a row a host can still be down after that before it's given up on.
+        BREAKER_GIVE_UP.
+        :param hedge_percentile: See HedgePolicy.  HEDGE_PERCENTILE.
+        :param hedge_delay: See HedgePolicy.  HEDGE_DELAY.
+        :param hedge_min_delay: See HedgePolicy.  HEDGE_MIN_DELAY.
+        :param hedge_grace: See HedgePolicy.  HEDGE_GRACE.
+        """
+        self.server_mode = SERVER_MODE if server_mode is None else server_mode
+        # --no-cookies promises not to touch anything outside the MultiMC folder.
+        self.use_cache = not (NO_CACHE or NO_COOKIE) if use_cache is None else use_cache
+        self.cache_dir = cache_dir or CACHE_DIR or default_cache_dir()
+        self.cookies = COOKIE_JAR if cookies is None else cookies or None
+        self.mirror = MIRROR if mirror is None else mirror or None
+        self.deltas = (None if NO_DELTAS else DELTAS) if deltas is None else deltas or None
+        # Whether take_extras() may use the pack server's: if we haven't got our own, and haven't been told not to.
+        self.offered_mirror = self.mirror is None and (not NO_MIRROR if mirror is None else mirror is not False)
+        self.offered_deltas = self.deltas is None and (not NO_DELTAS if deltas is None else deltas is not False)
+        self.hedge = HEDGE if hedge is None else hedge
+        self.retries = RETRIES if retries is None else retries
+        self.full_extract = FULL_EXTRACT if full_extract is None else full_extract
+        self.surplus = SURPLUS if surplus is None else surplus or None
+        self.trace_file = TRACE_FILE if trace_file is None else trace_file or None
+        self.progress_json = PROGRESS_JSON if progress_json is None else progress_json or None
+        self.max_transfers = MAX_TRANSFERS if max_transfers is None else max_transfers
+        self.probe_sizes = PROBE_SIZES if probe_sizes is None else probe_sizes
+        self.chunk_threshold = CHUNK_THRESHOLD if chunk_threshold is None else chunk_threshold
+        self.chunks = CHUNKS if chunks is None else chunks
+        self.zero_copy = ZERO_COPY if zero_copy is None else zero_copy
+        self.stream = sys.stdout if stream is None else stream
+        self.max_per_host = MAX_PER_HOST if max_per_host is None else max_per_host
+        self.socket_timeout = SOCKET_TIMEOUT if socket_timeout is None else socket_timeout
+        self.cache_max_size = CACHE_MAX_SIZE if cache_max_size is None else cache_max_size
+        self.retry_delay = RETRY_DELAY if retry_delay is None else retry_delay
+        self.retry_max_delay = RETRY_MAX_DELAY if retry_max_delay is None else retry_max_delay
+        self.breaker_threshold = BREAKER_THRESHOLD if breaker_threshold is None else breaker_threshold
+        self.breaker_cooldown = BREAKER_COOLDOWN if breaker_cooldown is None else breaker_cooldown
+        self.breaker_give_up = BREAKER_GIVE_UP if breaker_give_up is None else breaker_give_up
+        self.hedge_policy = HedgePolicy(hedge_percentile, hedge_delay, hedge_min_delay, hedge_grace)
+
+    def take_extras(self, extras):
+        """
+        Use the mirror and the deltas a pack server offers in its extras (see read_pack()), where we haven't got our
+        own and haven't been told not to.  Each answer's extras replace the last's, so that a server which moves its
+        mirror (or stops offering one) while watch() is connected gets listened to.  Returns self.
+        """
+        if self.offered_mirror:
+            self.mirror = extras.get('mirror')
+        if self.offered_deltas:
+            self.deltas = extras.get('deltas')
+        return self
+
+    def open_cache(self):
+        """Returns the ModCache to use, or None if the cache is disabled."""
+        if not self.use_cache:
+            return None
+        try:
+            return ModCache(self.cache_dir, self.cache_max_size)
+        except OSError as e:
+            print('Could not open the mod cache, carrying on without it:', e, file=output())
+            return None
+
+    def run(self, f, outdir, created_modpack=True, ignore_version_cookie=False, server_mode=None):
+        """
+        Install the pack in f into outdir.  Returns True if it all worked.
+
+        :param server_mode: Whether outdir is a server rather than a MultiMC instance.  None means ours.
+        """
+        return self.run_batch(f, [(outdir, server_mode)], created_modpack, ignore_version_cookie)
+
+    def run_batch(self, f, targets, created_modpack=True, ignore_version_cookie=False):
+        """
+        Install the pack in f into every one of targets, one after the other, parsing it once and downloading each
+        file once: later targets get their copies from the first one that installed it.  Everything that went wrong,
+        anywhere, is reported at the end.  Returns True if it all worked.
+
+        :param targets: List of (directory, server mode), with server mode as for run().
+        """
+        tracer = Tracer() if self.trace_file is not None else None
+        events = open(self.progress_json, 'w', buffering=1) if self.progress_json is not None else None
+        progress = Progress(self.stream, events)
+        progress.start()
+        tokens = _tracer.set(tracer), _progress.set(progress), _output.set(progress.output)
+        try:
+            return _run_batch(self, f, targets, created_modpack, ignore_version_cookie)
+        finally:
+            progress.stop()
+            for var, token in zip((_tracer, _progress, _output), tokens):
+                var.reset(token)
+            if events is not None:
+                events.close()
+            if tracer is not None:
+                tracer.save(self.trace_file)
+                print('Trace saved to', self.trace_file, file=self.stream)
+                for line in tracer.summary():
+                    print(line, file=self.stream)
+
+
+def run(f, outdir, created_modpack=True, ignore_version_cookie=False, server_mode=None):
+    """Installer.run() with the settings the module globals say."""
+    return Installer().run(f, outdir, created_modpack, ignore_version_cookie, server_mode)
+
+
+def run_batch(f, targets, created_modpack=True, ignore_version_cookie=False):
+    """Installer.run_batch() with the settings the module globals say."""
+    return Installer().run_batch(f, targets, created_modpack, ignore_version_cookie)
+
+
+def _run_batch(installer, f, targets, created_modpack, ignore_version_cookie):
+    started = time.perf_counter()
+    with f:
+        data = f.read()
+    try:
+        pack = Pack.load(data)
+    except PackError as e:
+        # Better to find out now than with half the mods downloaded.
+        print('There is something wrong with the pack, so nothing has been installed:', file=output())
+        for problem in e.problems:
+            print(' -', problem, file=output())
+        print("========= D O W N L O A D   F A I L E D ========", file=output())
+        return False
+    trace_span('parse', 'run', started, rows=len(pack.rows))
+    batch = Batch(installer)
+    results = []
+    try:
+        for outdir, server_mode in targets:
+            if len(targets) > 1:
+                print('Installing into', outdir, file=output())
+            results.append(_run(pack, outdir, ignore_version_cookie, batch,
+                                installer.server_mode if server_mode is None else server_mode))
+    finally:
+        batch.scheduler.stop()
+    # Everything from here on is either a report or a question, neither of which wants a status line under it.
+    _progress.get().stop()
+    batch.save()
+    return report(results, created_modpack, installer.surplus)
+
+
+def _run(pack, outdir, ignore_version_cookie, batch, server_mode):
+    # Install pack into one target.  Returns an InstallResult for report().
+    started = time.perf_counter()
+    cache = batch.cache
+    lock = PackLock(outdir)
+    scheduler = batch.scheduler
+    mod_downloader = Downloader(scheduler, 'media.forgecdn.net', '/files/{0}/{1}/{2}', 'mods', cache,
+                                lambda a, b, filename: mod_source(a * 1000 + b))
+    mods_dir = os.path.join(outdir, 'mods') if server_mode else os.path.join(outdir, '.minecraft', 'mods')
     os.makedirs(mods_dir, exist_ok=True)
-    zip_downloader = ZipDownloader()
-    other_stuff_downloader = ArbitraryURLDownloader()
+    zip_downloader = ZipDownloader(scheduler)
+    other_stuff_downloader = ArbitraryURLDownloader(scheduler)
+    for _dl in (mod_downloader, zip_downloader, other_stuff_downloader):
+        _dl.packlock = lock
+        _dl.resolutions = batch.resolutions
+        _dl.batch = batch
+        _dl.retry_policy = RetryPolicy(batch.installer.retries, batch.installer.retry_delay,
+                                       batch.installer.retry_max_delay)
+        _dl.hedge = batch.installer.hedge
+        _dl.hedge_policy = batch.installer.hedge_policy
+        _dl.probe_sizes = batch.installer.probe_sizes
+    zip_downloader.full_extract = batch.installer.full_extract
+    for _dl in (mod_downloader, other_stuff_downloader):
+        _dl.hashes = pack.hashes
+    # Where else the pack says its files can be had, for when the usual place is slow.
+    mod_downloader.origins = [row[1].rstrip('/') + '/' for row in pack.rows if row[0] == 'Origin']
+    other_stuff_downloader.alternates = {row[1]: row[3:] for row in pack.rows if row[0] == 'Download' and row[3:]}
     if ignore_version_cookie:
         version = (0, 0, 0)
         buildinfo = None
@@ -312,140 +3337,213 @@ def run(f, outdir, created_modpack=True, ignore_version_cookie=False):
         try:
             with open(os.path.join(outdir, 'SwordfishPDS-PackVersion.txt')) as vfile:
                 version = vfile.read().strip()
-            print('read version', version, 'from file')
+            print('read version', version, 'from file', file=output())
             version, buildinfo = parse_version(version)
         except Exception as e:
             version = (0, 0, 0)
             buildinfo = None
-            print('Could not load version from file!', e)
-        print(version, buildinfo)
+            print('Could not load version from file!', e, file=output())
+        print(version, buildinfo, file=output())
     # current_version = the version of the pack we have on disk at the start of the script.
     # version starts out the same as current_version, but gets advanced every time we see a Version directive,
     # and is what ultimately gets written to the cookie when the script hits EOF.
     version_on_disk = version
-    with f:
-        # ugly (or beautiful depending on how you look at it) python 3 hack for comment characters
-        for type, *arg in csv.reader(filter(lambda line: not line.startswith('#'), f)):
-            if type == 'MOD':
-                mod_downloader.start(THREADS)
-                modid, filename = arg
-                all_mods.append(urllib.parse.unquote(filename))
-                # if the mod exists, but is disabled, don't download it again
-                # as that both wastes time and confuses MultiMC.
-                mod_path = os.path.join(mods_dir, filename)
-                if os.path.exists(mod_path + '.disabled'):
-                    os.rename(mod_path + '.disabled', mod_path)
-                if not modid.strip():
-                    # dud mod, will be downloaded by other means.  just add it to the mod list and move on
-                    print('encountered dud mod', filename)
-                    dud_mods.append(filename)
-                    continue
-                assert modid.isdigit() and len(modid) <= 7
-                a = int(modid[:-3])
-                b = int(modid[-3:])
-                if a == b == 0:
-                    continue  # ditto
-                mod_downloader.put(a, b, filename, mods_dir)
-            elif type == 'Zipfile':
-                # Make each zip download its own thread for parallel extraction.
-                url, dest_dir, max_version = arg
-                max_version, max_buildinfo = parse_version(max_version)
-                # If one or more downloads have already failed, fail fast and don't bother downloading the zip file,
-                # since we're not going to update the version number anyway.
-                if version < max_version and not zip_downloader.failed_downloads \
-                        and not mod_downloader.failed_downloads and not other_stuff_downloader.failed_downloads:
-                    zip_downloader.start(ZIP_THREADS)
-                    dest_dir = os.path.join(outdir, sanitize_path(dest_dir))
-                    os.makedirs(dest_dir, exist_ok=True)
-                    zip_downloader.put(url, dest_dir)
-                if version > max_version:
-                    sys.stdout.write('Skipping downloading %s because we are already up to date.\n'%url)
-            elif type == 'Download':
-                url, filename = arg
-                other_stuff_downloader.start(THREADS)
-                filename = sanitize_path(filename)
-                if os.path.exists(filename + '.disabled'):
-                    os.rename(filename + '.disabled', filename)
-                    # if the download got far enough to be disabled, assume it's good.
-                    continue
-                other_stuff_downloader.put(url, os.path.join(outdir, filename))
-            elif type == 'Version':
-                new_version, = arg
-                version, buildinfo = parse_version(new_version)
-                # if version_on_disk >= version:
-                #    break
-            elif type == 'Nuke':
-                filename, = arg
-                filename = os.path.join(outdir, sanitize_path(filename))
-                if os.path.exists(filename):
-                    if os.path.exists(filename + '.disabled'):
-                        os.unlink(filename)
-                    else:
-                        os.rename(filename, filename + '.disabled')
+    rows = pack.rows
+    # One directory listing up front instead of a stat() -- or worse, a ranged GET -- per mod.
+    reconciler = Reconciler(outdir, mods_dir, server_mode)
+    # If the version cookie says we're up to date, and the lock file agrees that every file the pack wants is where we
+    # left it, there's nothing to do.
+    new_version = pack.version
+    if not ignore_version_cookie and new_version is not None and version_on_disk >= new_version \
+            and lock.version == format_version(version_on_disk, buildinfo) \
+            and is_installed(rows, outdir, mods_dir, lock, reconciler):
+        trace_span('check installed', 'run', started)
+        return InstallResult(outdir, True, [], [], [], reconciler)
+    trace_span('check installed', 'run', started)
+    started = time.perf_counter()
+    reconciler.plan(rows)
+    enabled = reconciler.apply()
+    trace_span('reconcile', 'run', started, enabled=len(enabled), nuked=len(reconciler.nuke))
+    started = time.perf_counter()
+    for type, *arg in rows:
+        if type == 'MOD':
+            mod_downloader.start()
+            modid, filename = arg
+            if not modid:
+                # dud mod, will be downloaded by other means.  just add it to the mod list and move on
+                print('encountered dud mod', filename, file=output())
+                continue
+            a = int(modid[:-3] or 0)
+            b = int(modid[-3:])
+            if a == b == 0:
+                continue  # ditto
+            source = mod_source(modid)
+            if lock.check(source, reconciler):
+                # Still exactly what we installed last time.
+                continue
+            with trace('cache ' + filename, 'cache'):
+                cached = cache.install(source, mods_dir) if cache is not None else None
+            if cached is not None:
+                # Another instance (or an earlier version of this one) already downloaded it.
+                lock.record(os.path.join(mods_dir, cached['filename']), source, cached['sha256'])
+                continue
+            shared = batch.share(source, mods_dir)
+            if shared is not None:
+                lock.record(shared[0], source, shared[1])
+                continue
+            mod_downloader.put(a, b, filename, mods_dir, size=lock.size_of(source) or pack.sizes.get(source))
+        elif type == 'Zipfile':
+            # Make each zip download its own thread for parallel extraction.
+            url, dest_dir, max_version = arg
+            max_version, max_buildinfo = parse_version(max_version)
+            # If one or more downloads have already failed, fail fast and don't bother downloading the zip file,
+            # since we're not going to update the version number anyway.
+            if version < max_version and not zip_downloader.failed_downloads \
+                    and not mod_downloader.failed_downloads and not other_stuff_downloader.failed_downloads:
+                zip_downloader.start()
+                dest_dir = reconciler.path(dest_dir)
+                os.makedirs(dest_dir, exist_ok=True)
+                zip_downloader.put(url, dest_dir)
+            if version > max_version:
+                output().write('Skipping downloading %s because we are already up to date.\n'%url)
+        elif type == 'Download':
+            url, filename, *_ = arg
+            other_stuff_downloader.start()
+            path = reconciler.path(filename)
+            if path in enabled or lock.check(url, reconciler):
+                continue
+            shared = batch.share(url, path)
+            if shared is not None:
+                lock.record(shared[0], url, shared[1])
+                continue
+            other_stuff_downloader.put(url, path,
+                                       size=lock.size_of(url) or pack.sizes.get(url))
+        elif type == 'Version':
+            new_version, = arg
+            version, buildinfo = parse_version(new_version)
+    trace_span('queue downloads', 'run', started)
 
+    started = time.perf_counter()
     for _dl in (mod_downloader, zip_downloader, other_stuff_downloader):
         _dl.stop()
+    trace_span('wait for downloads', 'run', started)
 
-    surplus_mods = []
-    installed_mods = os.listdir(mods_dir)
-    for mod in installed_mods:
-        if mod.endswith('.jar') and mod not in all_mods:
-            surplus_mods.append(mod)
-        elif mod in dud_mods:
-            dud_mods.remove(mod)
+    surplus_mods, dud_mods = reconciler.finish(lock)
+    failed = [(_dl, _dl.failed_downloads) for _dl in (mod_downloader, zip_downloader, other_stuff_downloader)
+              if _dl.failed_downloads]
+    if failed or dud_mods:
+        lock.save()
+    else:
+        with open(os.path.join(outdir, 'SwordfishPDS-PackVersion.txt'), 'w') as vfile:
+            vfile.write(format_version(version, buildinfo))
+        lock.save(format_version(version, buildinfo))
+    return InstallResult(outdir, False, failed, dud_mods, surplus_mods, reconciler)
 
+
+def report(results, created_modpack=True, surplus_choice=None):
+    """
+    Tell the user how the installs in results (InstallResults) went, and if they all worked, ask what to do about any
+    mods they turned up that the pack doesn't list -- unless surplus_choice (one of SURPLUS_CHOICES) already says.
+    Returns True if they all worked.
+    """
+    out = output()
+    many = len(results) > 1
     any_ = False
-    for _dl in (mod_downloader, zip_downloader, other_stuff_downloader):
-        if _dl.failed_downloads:
-            print('Some', _dl, 'failed to download:')
-            for file, reason in _dl.failed_downloads.items():
-                print(' - %s: %s'%(file, reason))
+    for result in results:
+        where = ' in %s' % result.outdir if many else ''
+        for _dl, failed_downloads in result.failed:
+            print('Some %s failed to download%s:' % (_dl, where), file=out)
+            for file, reason in failed_downloads.items():
+                print(' - %s: %s'%(file, reason), file=out)
             any_ = True
+        if result.duds:
+            any_ = True
+            print('Some mods were listed as required but were not installed%s:' % where, file=out)
+            for mod in result.duds:
+                print(' -', mod, file=out)
 
-    if dud_mods:
-        any_ = True
-        print('Some mods were listed as required but were not installed:')
-        for mod in dud_mods:
-            print(' -', mod)
-
-    print('================================================')
+    print('================================================', file=out)
     if any_:
-        print('Please go yell at @Snek or @some dude 2000 miles away in Discord because')
-        print('this is probably their fault.')
-        print("========= D O W N L O A D   F A I L E D ========")
+        print('Please go yell at @Snek or @some dude 2000 miles away in Discord because', file=out)
+        print('this is probably their fault.', file=out)
+        print("========= D O W N L O A D   F A I L E D ========", file=out)
+        return False
+    if all(result.up_to_date for result in results):
+        print('Modpack is already up to date.' if not many else 'Every instance is already up to date.', file=out)
+        print('===============  S U C C E S S  ================', file=out)
+        return True
+    if many:
+        for result in results:
+            print('%s: %s' % (result.outdir, 'already up to date' if result.up_to_date else 'done'), file=out)
+    if created_modpack:
+        print('All done!  Modpack successfully installed.', file=out)
+        print('You may need to restart MultiMC before the modpack appears.', file=out)
     else:
-        if created_modpack:
-            print('All done!  Modpack successfully installed.')
-            print('You may need to restart MultiMC before the modpack appears.')
-        else:
-            print('All done!  Modpack successfully updated.')
+        print('All done!  Modpack successfully updated.', file=out)
 
-        with open(os.path.join(outdir, 'SwordfishPDS-PackVersion.txt'), 'w') as vfile:
-            vfile.write('%d.%d.%d' % version)
-            if buildinfo:
-                vfile.write('+')
-                vfile.write(buildinfo)
-
-        if surplus_mods:
-            print('These mods are installed in your client but are not in the pack description:')
-            for mod in surplus_mods:
-                print('-', mod)
+    surplus = [result for result in results if result.surplus]
+    if surplus:
+        print('These mods are installed in your client but are not in the pack description:', file=out)
+        for result in surplus:
+            for mod in result.surplus:
+                print('-', os.path.join(result.reconciler.mods_dir, mod) if many else mod, file=out)
+        if surplus_choice is None:
             choice = ask_user(["Leave them in (they won't get activated when you connect to the server)",
                                'Disable them (can be re-enabled in the Loader Mods tab in MultiMC)',
                                'Delete them'], 'What would you like to do?')
+        else:
+            choice = SURPLUS_CHOICES.index(surplus_choice)
+            print('%s them, as --surplus says.' % ('Leaving', 'Disabling', 'Deleting')[choice], file=out)
+        for result in surplus:
             if choice == 1:
-                for mod in surplus_mods:
-                    path_to_mod = os.path.join(mods_dir, mod)
-                    try:
-                        os.rename(path_to_mod, path_to_mod + '.disabled')
-                    except FileExistsError:
-                        os.unlink(path_to_mod)
+                result.reconciler.disable(result.surplus)
             elif choice == 2:
-                for mod in surplus_mods:
-                    os.unlink(os.path.join(mods_dir, mod))
+                result.reconciler.delete(result.surplus)
+
+    print('===============  S U C C E S S  ================', file=out)
+    print('Go launch your game.', file=out)
+    return True
+
+
+def pack_version(rows):
+    """The version the pack will be at once all of rows have been applied, or None if it has no Version line."""
+    version = None
+    for type, *arg in rows:
+        if type == 'Version':
+            version, _ = parse_version(arg[0])
+    return version
+
+
+def is_installed(rows, outdir, mods_dir, lock, scan):
+    """
+    True if every file the pack asks for is on disk exactly as the lock file says we left it, so there is nothing for
+    run() to do.  Touches the disk only to list the directories the pack installs into (via scan, a Reconciler) and
+    the network not at all.
+    """
+    for type, *arg in rows:
+        if type == 'MOD':
+            modid, filename = arg
+            if not modid:
+                # dud mod, somebody else's job to install, but it does need to be there.
+                if not scan.exists(os.path.join(mods_dir, filename)):
+                    return False
+            elif int(modid) and not lock.check(mod_source(modid), scan):
+                return False
+        elif type == 'Download':
+            url = arg[0]
+            if not lock.check(url, scan):
+                return False
+        elif type == 'Nuke':
+            filename, = arg
+            if scan.exists(scan.path(filename)):
+                return False
+    return True
+
 
-        print('===============  S U C C E S S  ================')
-        print('Go launch your game.')
+def format_version(version, buildinfo=None):
+    if buildinfo:
+        return '%d.%d.%d+%s' % (version + (buildinfo,))
+    return '%d.%d.%d' % version
 
 
 def parse_version(version):
@@ -654,29 +3752,288 @@ notes=
     return instance_dir
 
 
-def connect(server):
+def _list_packs(server, timeout=None):
+    s = socket.create_connection(server, timeout)
+    f = s.makefile('rwb')
+    # sockets are IO ref counted and don't actually close until all socket.makefile()s on them close,
+    # so we can safely do this.
+    s.close()
+    available_packs=[]
+    for line in f:
+        line=line.decode('ascii').strip()
+        if not line:
+            break
+        available_packs.append(line)
+    return f, available_packs
+
+
+def connect(server, outdir_for=None):
+    """
+    Ask the server which packs it has, ask the user which one they want, and get it.  Returns (pack file, pack name,
+    extras as read_pack() says).
+
+    :param outdir_for: Function from a pack name to the directory it is (or will be) installed in.  If given, and the
+    server is new enough, we only get sent the pack if it has changed since the copy we kept there last time.
+    """
     print('Connecting to', server[0], '...')
-    with socket.create_connection(server) as s:
-        s.setblocking(True)
-        available_packs=[]
-        f = s.makefile('rw')
-        print('Retrieving modpack list...')
-        for line in f:
-            line=line.strip()
-            if not line:
-                break
-            available_packs.append(line)
-        if not available_packs:
-            print('There are no packs available for download right now.  Please try again later.')
-            input('Press Enter to quit.')
-            exit()
-        choice = ask_user(available_packs, 'Which pack do you want to download? ')
-        f.write(available_packs[choice])
-        f.write('\n')
-        f.flush()
-        # sockets are IO ref counted and don't actually close until all socket.makefile()s on them close,
-        # so we can safely do this.
-        return f, available_packs[choice]
+    print('Retrieving modpack list...')
+    f, available_packs = _list_packs(server)
+    if not available_packs:
+        print('There are no packs available for download right now.  Please try again later.')
+        input('Press Enter to quit.')
+        exit()
+    choice = ask_user(available_packs, 'Which pack do you want to download? ')
+    pack_name = available_packs[choice]
+    if outdir_for is not None:
+        fetched = fetch_pack(f, pack_name, outdir_for(pack_name))
+        if fetched is not None:
+            return fetched[0], pack_name, fetched[1]
+        # The server predates PROTOCOL and hung up on us.  Ask again the old-fashioned way.
+        f.close()
+        f, available_packs = _list_packs(server)
+    f.write(pack_name.encode('ascii'))
+    f.write(b'\n')
+    f.flush()
+    return f, pack_name, {}
+
+
+def fetch_pack(f, pack_name, outdir):
+    """
+    Ask for pack_name with a PROTOCOL request, telling the server the version we have installed in outdir and the
+    hash of the copy of the pack we saved there last time.  Returns (pack file, extras as read_pack() says), or None
+    if the server doesn't speak PROTOCOL.
+    """
+    request_pack(f, pack_name, outdir)
+    with f:
+        status, extras = read_pack(f, outdir)
+    if status is None:
+        return None
+    if status == 'UNCHANGED':
+        print('The pack has not changed since last time.')
+    elif status == 'NOTFOUND':
+        print('The server no longer has that pack.  Please try again later.')
+        input('Press Enter to quit.')
+        exit()
+    return open(os.path.join(outdir, 'SwordfishPDS-Pack.csv'), 'rb'), extras
+
+
+def request_pack(f, pack_name, outdir, watch=False):
+    """
+    Send the PROTOCOL request for pack_name fetch_pack() describes.
+
+    :param watch: Ask the server to send the pack again whenever it changes, as well as now.
+    """
+    local_copy = os.path.join(outdir, 'SwordfishPDS-Pack.csv')  # or a compiled manifest, if that's what we were sent
+    try:
+        digest = hash_file(local_copy)
+    except FileNotFoundError:
+        digest = '-'
+    try:
+        with open(os.path.join(outdir, 'SwordfishPDS-PackVersion.txt')) as vfile:
+            version = vfile.read().strip() or '-'
+    except FileNotFoundError:
+        version = '-'
+    # The fifth field says we can take a compiled manifest (compile_pack.py) as well as a CSV.  Servers that don't know
+    # about watching ignore the sixth, answer once and hang up.
+    f.write(('%s\t%s\t%s\t%s\tcsv,manifest%s\n' % (PROTOCOL, pack_name, version, digest, '\twatch' if watch else ''))
+            .encode('ascii'))
+    f.flush()
+
+
+def read_pack(f, outdir):
+    """
+    Read one answer to request_pack() from f, saving the pack to outdir if it came with one.  Returns (status, extras):
+    the status is OK, UNCHANGED or NOTFOUND, or None if the server hung up or doesn't speak PROTOCOL, and the extras
+    are what else the server said, e.g. {'mirror': its mirror's URL}, for Installer.take_extras().
+
+    :raises ConnectionError: if the connection drops partway through the pack.
+    :raises PackError: if what the server sent makes no sense.
+    """
+    status = f.readline().decode('ascii', 'replace').split()
+    if not status or status[0] != PROTOCOL:
+        return None, {}
+    if len(status) < 2 or status[1] == 'OK' and (len(status) < 3 or not status[2].isdigit()):
+        raise PackError(['The pack server sent a status line we cannot make sense of: %s' % ' '.join(status)])
+    # Anything after the positional fields is key=value extras, e.g. the address of the server's mirror.
+    extras = dict(item.split('=', 1) for item in status[1:] if '=' in item)
+    if status[1] != 'OK':
+        return status[1], extras
+    length = int(status[2])
+    data = f.read(length)
+    if len(data) < length:
+        raise ConnectionError('the pack server hung up %d bytes into a %d byte pack' % (len(data), length))
+    try:
+        body = zlib.decompress(data)
+    except zlib.error as e:
+        raise PackError(['The pack server sent a corrupt pack: %s' % e])
+    local_copy = os.path.join(outdir, 'SwordfishPDS-Pack.csv')
+    try:
+        with open(local_copy, 'rb') as fold:
+            added, removed = Pack.load(body).diff(Pack.load(fold.read()))
+        print('The pack has changed since last time: %d lines added, %d removed.' % (len(added), len(removed)))
+    except (OSError, PackError):
+        pass  # first time, or one of them is broken, which run() will have something to say about
+    os.makedirs(outdir, exist_ok=True)
+    with open(local_copy + '.tmp', 'wb') as fout:
+        fout.write(body)
+    os.replace(local_copy + '.tmp', local_copy)
+    return 'OK', extras
+
+
+def watch(server, pack_name, outdir, stage=None, server_mode=None, installer=None):
+    """
+    Keep outdir up to date with pack_name from server, without asking anybody anything, for as long as we're left
+    running.  The server sends the pack again every time it changes, and each new version is installed the moment it
+    arrives -- incrementally, like any other run().  If the connection drops, or the server is too old to send
+    anything unasked, we reconnect every RECONNECT_DELAY seconds, which makes it polling.
+
+    :param stage: Directory to install new versions into rather than outdir, which is never touched: see seed_stage()
+    and apply_stage().  For servers, where the game has the live files open.
+    :param server_mode: As for run().
+    :param installer: The Installer to install every version with.  One with the settings the module globals say, and
+    the mirror and deltas the server offers, if not given.
+    """
+    installer = installer or Installer()
+    target = stage or outdir
+    while True:
+        try:
+            f, available_packs = _list_packs(server, WATCH_TIMEOUT)
+        except OSError as e:
+            print('Could not connect to the pack server (%s).  Trying again in %ds.' % (e, RECONNECT_DELAY))
+            time.sleep(RECONNECT_DELAY)
+            continue
+        try:
+            if pack_name not in available_packs:
+                print('The server does not have a pack called %s.' % pack_name)
+                status = None
+            else:
+                if stage is not None:
+                    seed_stage(outdir, stage)
+                os.makedirs(target, exist_ok=True)
+                request_pack(f, pack_name, target, watch=True)
+                status, extras = read_pack(f, target)
+            first = True
+            while status is not None:
+                if status == 'NOTFOUND':
+                    print('The server no longer has %s; keeping what we have.' % pack_name)
+                elif status == 'OK' or first:
+                    # The first answer gets installed even if it's UNCHANGED, in case the last install didn't finish.
+                    # After that, UNCHANGED is just the server saying it's still there.
+                    if stage is not None:
+                        seed_stage(outdir, stage)
+                    with open(os.path.join(target, 'SwordfishPDS-Pack.csv'), 'rb') as pack:
+                        ok = installer.take_extras(extras).run(pack, target, created_modpack=False,
+                                                               server_mode=server_mode)
+                    if ok and stage is not None:
+                        print('Staged in %s.  Run SwordfishPDS.py --apply-staged while the server is stopped to '
+                              'make it live.' % stage)
+                first = False
+                status, extras = read_pack(f, target)
+        except OSError as e:
+            print('Lost the connection to the pack server (%s).' % e)
+        except PackError as e:
+            # Garbled on the way, or a server with a broken pack.  Either way, ask again.
+            print('Could not read what the pack server sent (%s).' % e)
+        finally:
+            f.close()
+        print('Reconnecting in %ds.' % RECONNECT_DELAY)
+        time.sleep(RECONNECT_DELAY)
+
+
+#####################################################
+############ STAGING ################################
+#####################################################
+
+STAGE_FILES = ('SwordfishPDS-Pack.csv', 'SwordfishPDS-PackVersion.txt')  # besides the lock file, which goes last
+
+
+def _copy_over(src_dir, dst_dir, relpath, hardlink=True):
+    # Make dst_dir/relpath the file at src_dir/relpath, mtime and all, so that lock files stay true of it.  Returns
+    # False if there was nothing to copy or it's already the same file.
+    src = os.path.join(src_dir, relpath.replace('/', os.path.sep))
+    dst = os.path.join(dst_dir, relpath.replace('/', os.path.sep))
+    try:
+        st = os.stat(src)
+    except FileNotFoundError:
+        return False
+    try:
+        if os.path.samefile(src, dst):
+            return False
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    link_or_copy(src, dst, hardlink)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return True
+
+
+def _zip_members(lock):
+    return {relpath for members in lock.zips.values() for relpath in members}
+
+
+def seed_stage(outdir, stage):
+    """
+    Make stage a copy of everything run() has installed into outdir, going by its lock file, so that installing the
+    next version of the pack into stage only downloads what changed.  Mods and Downloads are hardlinked, which costs
+    no space; what came out of Zipfiles (configs, mostly, which get edited in place) is copied.  Does nothing if stage
+    already has something staged, which the next version carries on from.
+    """
+    if os.path.exists(os.path.join(stage, 'SwordfishPDS-Lock.json')):
+        return
+    lock = PackLock(outdir)
+    for relpath in lock.files:
+        _copy_over(outdir, stage, relpath)
+    for relpath in _zip_members(lock):
+        _copy_over(outdir, stage, relpath, hardlink=False)
+    for name in STAGE_FILES + ('SwordfishPDS-Lock.json',):
+        _copy_over(outdir, stage, name, hardlink=False)
+
+
+def apply_stage(outdir, stage, server_mode=False):
+    """
+    Swap what has been installed into stage into outdir, without downloading anything: every file the staged lock
+    file lists goes in (mostly by hardlink, so it's a rename), whatever the staged install got rid of (Nukes, mods
+    dropped from the pack) goes from outdir too, and the lock file, version and pack go last.  stage is removed
+    afterwards.  Returns False if nothing was staged.
+
+    :param server_mode: Whether outdir is a server rather than a MultiMC instance.
+    """
+    staged = PackLock(stage)
+    if not os.path.exists(staged.path):
+        return False
+    live = PackLock(outdir)
+    for relpath in staged.files:
+        _copy_over(stage, outdir, relpath)
+    for relpath in _zip_members(staged):
+        _copy_over(stage, outdir, relpath, hardlink=False)
+    # Whatever the staged install started out with from outdir and no longer has, it deleted or disabled.
+    for relpath in (set(live.files) | _zip_members(live)) - set(staged.files) - _zip_members(staged):
+        staged_path = os.path.join(stage, relpath.replace('/', os.path.sep))
+        if os.path.exists(staged_path):
+            continue
+        path = os.path.join(outdir, relpath.replace('/', os.path.sep))
+        try:
+            if os.path.exists(staged_path + '.disabled'):
+                os.replace(path, path + '.disabled')
+            else:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+    # Nukes of files we never installed, which seed_stage() had no reason to copy.
+    try:
+        with open(os.path.join(stage, 'SwordfishPDS-Pack.csv'), 'rb') as f:
+            rows = Pack.load(f.read()).rows
+    except (OSError, PackError):
+        rows = []
+    mods_dir = os.path.join(outdir, 'mods') if server_mode else os.path.join(outdir, '.minecraft', 'mods')
+    reconciler = Reconciler(outdir, mods_dir, server_mode)
+    reconciler.plan(rows)
+    reconciler.apply()
+    for name in STAGE_FILES + ('SwordfishPDS-Lock.json',):
+        _copy_over(stage, outdir, name, hardlink=False)
+    shutil.rmtree(stage)
+    return True
+
 
 def ask_user(options, prompt='Choose an option: '):
     print('===========================================')
@@ -698,14 +4055,57 @@ def ask_user(options, prompt='Choose an option: '):
 
 if __name__=='__main__':
     output_dir = None
+    targets = []  # (directory, server mode) from --target= and --server-target=
     file = None
     connect_ip = '98.37.182.117'
     connect_port = 21617
+    daemon = False
+    daemon_pack = None
+    stage = None
+    apply_staged = False
     for arg in sys.argv[1:]:
         if arg == '--server-mode':
             SERVER_MODE = True
         elif arg == '--no-cookies':
             NO_COOKIE = True
+        elif arg == '--no-cache':
+            NO_CACHE = True
+        elif arg.startswith('--cache-dir='):
+            CACHE_DIR = arg[12:]
+        elif arg == '--full-extract':
+            FULL_EXTRACT = True
+        elif arg.startswith('--chunk-threshold='):
+            CHUNK_THRESHOLD = int(arg[18:]) * 1024 ** 2
+        elif arg.startswith('--mirror='):
+            MIRROR = arg[9:]
+        elif arg == '--no-mirror':
+            NO_MIRROR = True
+        elif arg.startswith('--trace='):
+            TRACE_FILE = arg[8:]
+        elif arg == '--no-zero-copy':
+            ZERO_COPY = False
+        elif arg.startswith('--progress-json='):
+            PROGRESS_JSON = arg[16:]
+        elif arg.startswith('--retries='):
+            RETRIES = int(arg[10:])
+        elif arg == '--no-hedge':
+            HEDGE = False
+        elif arg == '--no-deltas':
+            NO_DELTAS = True
+        elif arg == '--daemon':
+            daemon = True
+        elif arg.startswith('--pack='):
+            daemon_pack = arg[7:]
+        elif arg.startswith('--stage='):
+            stage = arg[8:]
+        elif arg == '--apply-staged':
+            apply_staged = True
+        elif arg.startswith('--surplus=') and arg[10:] in SURPLUS_CHOICES:
+            SURPLUS = arg[10:]
+        elif arg.startswith('--target='):
+            targets.append((arg[9:], False))
+        elif arg.startswith('--server-target='):
+            targets.append((arg[16:], True))
         elif os.path.isdir(arg):
             output_dir = arg
         elif os.path.isfile(arg):
@@ -719,8 +4119,9 @@ if __name__=='__main__':
         else:
             print('Usage:')
             print(
-                'SwordfishPDS.py [--server-mode] [--no-cookies] [{path to csv file|server_ip[:server_port]] [output_directory]')
-            print('If no CSV file is provided, the script will connect to the specified server,')
+                'SwordfishPDS.py [--server-mode] [--no-cookies] [--no-cache] [--cache-dir=DIR] [--chunk-threshold=MB] [--full-extract] [--mirror=URL|--no-mirror] [--trace=FILE] [--progress-json=PATH] [--no-zero-copy] [--retries=N] [--no-hedge] [--no-deltas] [--surplus=leave|disable|delete] [--target=DIR|--server-target=DIR ...] [{path to pack file|server_ip[:server_port]] [output_directory]')
+            print('The pack file can be a CSV or a manifest compiled from one by compile_pack.py.')
+            print('If no pack file is provided, the script will connect to the specified server,')
             print('download a list of CSV files, and ask you to choose one.  If no server is')
             print('specified, the hardcoded default is 73.71.247.208 (the default server IP for')
             print('all SFE modpacks).  Port, if omitted, defaults to 21617.')
@@ -733,23 +4134,101 @@ if __name__=='__main__':
             print('which stores the path to the MultiMC folder.  If --no-cookies is specified,')
             print('these files will be neither read nor written, and no disk files outside the')
             print('MultiMC folder will be touched.')
+            print('Every mod downloaded is also kept in a cache shared by all your instances')
+            print('(%s by default, or --cache-dir) so the next pack that needs it' % default_cache_dir())
+            print("doesn't have to download it again.  --no-cache (or --no-cookies) turns that off.")
+            print('Files bigger than --chunk-threshold megabytes (default %d) are downloaded over'
+                  % (CHUNK_THRESHOLD // 1024 ** 2))
+            print('%d connections at once.' % CHUNKS)
+            print('Updates to the base pack only extract the files that changed, unless --full-extract')
+            print('is given.')
+            print('If the pack server runs a LAN mirror (server.py --mirror), files are fetched through')
+            print('it, falling back to the internet if the mirror fails.  --mirror=URL uses a mirror')
+            print("the server didn't tell us about; --no-mirror ignores the one it did.")
+            print('--trace=FILE records how long every request (DNS, connect, TLS, first byte, body),')
+            print('download and extraction took, saves it as a Chrome trace (chrome://tracing or')
+            print('ui.perfetto.dev) and prints the slowest hosts and files.')
+            print('--progress-json=PATH writes progress as it happens (files starting and finishing,')
+            print('bytes done and planned, rate, ETA) to PATH, one JSON object per line, for launchers')
+            print('and other tools to follow along.')
+            print('On Linux, plain HTTP downloads go straight from the network to disk without being')
+            print('copied through Python; --no-zero-copy turns that off.')
+            print('Downloads that fail for a reason that might go away (dropped connections, timeouts,')
+            print('overloaded servers) are tried again up to --retries times (default %d), picking up' % RETRIES)
+            print('where they left off, and a host that keeps failing is left alone for a few seconds.')
+            print('Packs can list other places their files can be had (Origin rows for mods, more URLs')
+            print('after the filename of a Download).  A download that is going much slower than the')
+            print('place it comes from usually does gets a second copy started from the next one, and')
+            print('whichever finishes first is kept.  --no-hedge turns that off.')
+            print('If the pack server has deltas (make_delta.py) from a version of a file we already')
+            print('have to the one the pack wants, only the delta is downloaded, and the file is patched')
+            print('together from it and the old one.  --no-deltas turns that off.')
+            print('--target=DIR (a MultiMC instance) and --server-target=DIR (a server), each as many')
+            print('times as you like, install the pack into all of them in one go instead of into')
+            print('output_directory.  Each file is downloaded once and copied (or hardlinked) to the')
+            print('rest, and there is one report at the end for all of them.')
+            print('--surplus=leave|disable|delete says what to do about mods the pack does not list')
+            print('instead of asking.')
+            print()
+            print('SwordfishPDS.py --daemon --pack=NAME [--stage=DIR] [options] [server_ip[:server_port]]')
+            print('                output_directory')
+            print('keeps output_directory up to date with the pack NAME for as long as it runs, without')
+            print('asking anything (surplus mods are left alone unless --surplus says otherwise).  The')
+            print('server sends the pack again whenever it changes, and it is installed straight away;')
+            print('if the connection drops, it reconnects every %d seconds.  With --stage=DIR,'
+                  % RECONNECT_DELAY)
+            print('updates are installed into DIR instead, starting from a hardlinked copy of what')
+            print('output_directory has, so that a running game server is left alone.  Once it is')
+            print('stopped, SwordfishPDS.py --apply-staged --stage=DIR output_directory swaps the staged')
+            print('update in, which takes seconds.')
             exit()
 
+    if apply_staged:
+        if stage is None or output_dir is None:
+            print('--apply-staged needs --stage=DIR and the output directory.')
+            exit(2)
+        if not apply_stage(output_dir, stage, SERVER_MODE):
+            print('Nothing is staged in %s.' % stage)
+            exit(1)
+        print('Applied the update staged in %s to %s.' % (stage, output_dir))
+        exit()
+
     if not NO_COOKIE:
         init_cookies()
 
+    if daemon:
+        if daemon_pack is None or output_dir is None:
+            print('--daemon needs --pack=NAME and the output directory.')
+            exit(2)
+        if SURPLUS is None:
+            SURPLUS = 'leave'  # nobody to ask
+        try:
+            watch((connect_ip, connect_port), daemon_pack, output_dir, stage)
+        except KeyboardInterrupt:
+            pass
+        exit()
+
     # locate_multimc_dir() sometimes requires user intervention, so for the sake of seamlessness, skip it
     # if an output dir is specified.  Also do it before potentially connecting to the server.
-    if output_dir is None:
+    if output_dir is None and not targets:
         multimc_dir = locate_multimc_dir()
+    if output_dir is None and targets:
+        output_dir = targets[0][0]
 
     pack_name = None
+    extras = {}
     if file is not None:
-        f = open(file)
+        f = open(file, 'rb')
         pack_name = os.path.splitext(os.path.basename(file))[0]
     else:
-        f, pack_name = connect((connect_ip, connect_port))
+        f, pack_name, extras = connect((connect_ip, connect_port),
+                                       lambda name: output_dir if output_dir is not None
+                                       else os.path.join(multimc_dir, 'instances', name))
     if output_dir is None:
         output_dir = createMinecraftFolder(multimc_dir, pack_name)
-    run(f, output_dir)
+    installer = Installer().take_extras(extras)
+    if targets:
+        installer.run_batch(f, targets)
+    else:
+        installer.run(f, output_dir)
     input('Press Enter to close this window...')
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""
+End to end benchmark for SwordfishPDS.py.  Runs a local stand-in for media.forgecdn.net and a local server.py, then
+installs generated packs of various sizes through the real client, the same way a user would, and reports how long
+each install took and what it cost, in requests, bytes, CPU time and memory.
+
+Every pack size gets four installs:
+    cold         empty instance, empty cache
+    warm         the same pack again on top of it (should do nothing)
+    incremental  the next version of the pack: a twentieth of the mods and a tenth of the config zip changed
+    cached       that version into a new, empty instance, with the cache from the runs before it
+
+Results are printed as a table, and with --json=FILE written out so a later run can --compare=FILE against them.
+"""
+import hashlib
+import http.server
+import io
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CLIENT = os.path.join(HERE, 'SwordfishPDS.py')
+SERVER = os.path.join(HERE, 'server.py')
+
+PACK_SIZES = [150, 1000, 5000]  # --mods=
+MEAN_SIZE = 64 * 1024  # average size of a mod jar; sizes are exponentially distributed around this.  --mean-size=KB
+BIG_DOWNLOAD = 24 * 1024 ** 2  # one Download line per pack is this big, to exercise chunked downloads
+LATENCY = 0.0  # seconds the stand-in CDN waits before answering each request.  --latency=MS
+BANDWIDTH = 0  # bytes per second per connection the stand-in CDN sends at, 0 for flat out.  --bandwidth=KB
+FAIL_RATE = 0.0  # chance of a request failing, half with a 503 and half by hanging up partway through.  --fail-rate=
+SERVER_MIRROR = False  # download through server.py --mirror instead of straight from the stand-in.  --server-mirror
+SCENARIOS = ['cold', 'warm', 'incremental', 'cached']
+CLIENT_ARGS = []  # extra arguments for every client run, to compare options with.  --client-arg=
+
+
+#####################################################
+############ STAND-IN CDN ###########################
+#####################################################
+
+def file_size(path):
+    # Deterministic but exponentially distributed, so every pack has a few jars much bigger than the rest, like the
+    # real thing.
+    u = int.from_bytes(hashlib.sha256(path.encode('utf-8')).digest()[:8], 'big') / 2 ** 64
+    return max(1024, int(-math.log(1 - u) * MEAN_SIZE))
+
+
+def file_block(path):
+    # Generated files are this 64K repeated, twice over so any 64K slice of the file is one slice of it.  Never
+    # building the whole file keeps our own RSS down, which matters because Linux hands a process's peak RSS on to
+    # the children it starts.
+    return hashlib.sha256(path.encode('utf-8')).digest() * 2048 * 2
+
+
+class CDNHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Mimics media.forgecdn.net closely enough for SwordfishPDS.py: keep-alive, HEAD, Range (including suffix ranges and
+    416s), Accept-Ranges and Content-Disposition.  Also answers /fetch?url= like server.py's mirror does, so the client
+    can be pointed straight at it with --mirror= and still find the Download and Zipfile URLs.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, a small body sits waiting for the client to ACK
+    # the headers, which it takes its time over.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(head=True)
+
+    def do_GET(self):
+        self.respond()
+
+    def respond(self, head=False):
+        server = self.server
+        server.count(requests=1)
+        if LATENCY:
+            time.sleep(LATENCY)
+        parts = urllib.parse.urlsplit(self.path)
+        path = parts.path
+        if path == '/fetch':
+            path = urllib.parse.urlsplit(urllib.parse.parse_qs(parts.query).get('url', [''])[0]).path
+        body = server.files.get(path)
+        if body is not None:
+            size = len(body)
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+        elif path.startswith('/files/') or path.startswith('/dl/'):
+            size = server.sizes.get(path) or file_size(path)
+            block = file_block(path)
+            etag = '"%s"' % hashlib.md5(b'%s %d' % (path.encode(), size)).hexdigest()
+        else:
+            self.send_error(404)
+            return
+        failure = random.random() < FAIL_RATE and random.choice(['503', 'hangup'])
+        if failure == '503':
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start, end, status = 0, size, 200
+        header = self.headers.get('Range')
+        if self.headers.get('If-Range', etag) != etag:
+            header = None
+        if header and header.startswith('bytes=') and ',' not in header:
+            first, _, last = header[6:].partition('-')
+            if first:
+                start, end = int(first), min(int(last) + 1, size) if last else size
+            else:
+                start = max(0, size - int(last))
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size))
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/java-archive')
+        self.send_header('Content-Disposition', 'attachment; filename="%s"' % path.rsplit('/', 1)[-1])
+        self.end_headers()
+        if head:
+            return
+        if failure == 'hangup':
+            end = start + (end - start) // 2
+            self.close_connection = True
+        view = memoryview(body if body is not None else block)
+        began = time.perf_counter()
+        sent = 0
+        for offset in range(start, end, 64 * 1024):
+            length = min(64 * 1024, end - offset)
+            if body is None:
+                offset %= 64 * 1024
+            try:
+                self.wfile.write(view[offset:offset + length])
+            except ConnectionError:
+                # The client got what it wanted (or gave up), e.g. a chunked download's first stream reaching a
+                # range somebody else is fetching.
+                self.close_connection = True
+                return
+            sent += length
+            server.count(bytes=length)
+            if BANDWIDTH:
+                ahead = sent / BANDWIDTH - (time.perf_counter() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+class StandInCDN(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        self.files = {}  # path -> body, for the ones that aren't generated from the path
+        self.sizes = {}  # path -> size, for generated ones that need to be a particular size
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'bytes': 0}
+        super().__init__(address, CDNHandler)
+
+    @property
+    def url(self):
+        return 'http://%s:%d/' % self.server_address[:2]
+
+    def count(self, **stats):
+        with self.lock:
+            for key, value in stats.items():
+                self.stats[key] += value
+
+    def take_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            self.stats = dict.fromkeys(stats, 0)
+        return stats
+
+
+#####################################################
+############ PACKS ##################################
+#####################################################
+
+def make_pack(cdn, mods, generation):
+    """
+    Returns the CSV of a pack with mods mods, registering the files it needs with cdn.  Each generation after the first
+    updates a twentieth of the mods and a tenth of the config zip.
+    """
+    version = '1.0.%d' % (generation + 1)
+    rows = []
+    for i in range(mods):
+        fileid = 1000000 + i * 10 + (generation if i % 20 == 0 else 0)
+        rows.append('MOD,%d,mod%d-%d.jar' % (fileid, i, fileid))
+    members = {}
+    for i in range(max(20, mods // 5)):
+        changed = generation if i % 10 == 0 else 0
+        members['config/mod%d.cfg' % i] = ('# mod %d, revision %d\n' % (i, changed)).encode('ascii') * 50
+    zipped = io.BytesIO()
+    with zipfile.ZipFile(zipped, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    cdn.files['/zips/config.zip'] = zipped.getvalue()
+    cdn.sizes['/dl/big.bin'] = BIG_DOWNLOAD
+    rows.append('Zipfile,%szips/config.zip,.minecraft,%s' % (cdn.url, version))
+    rows.append('Download,%sdl/big.bin,.minecraft/big.bin' % cdn.url)
+    rows.append('Download,%sdl/options.txt,.minecraft/options.txt' % cdn.url)
+    rows.append('Version,%s' % version)
+    return '\n'.join(rows) + '\n'
+
+
+#####################################################
+############ RUNNING IT #############################
+#####################################################
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(packdir, workdir, cdn):
+    port = free_port()
+    cmd = [sys.executable, SERVER, '--port=%d' % port]
+    if SERVER_MIRROR:
+        cmd += ['--mirror=%d' % free_port(), '--mirror-dir=' + os.path.join(workdir, 'mirror'),
+                '--upstream=' + cdn.url]
+    proc = subprocess.Popen(cmd, cwd=packdir, stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    return proc, port
+
+
+def install(port, instance, cache_dir, cdn, workdir, log):
+    """
+    Run the client once, and return (wall time, CPU time or None, peak RSS in KB or None, whether it says it
+    succeeded).
+    """
+    os.makedirs(instance, exist_ok=True)
+    cmd = [sys.executable, CLIENT, '127.0.0.1:%d' % port, instance, '--cache-dir=' + cache_dir] + CLIENT_ARGS
+    if not SERVER_MIRROR:
+        cmd.append('--mirror=' + cdn.url)
+    with open(log, 'w') as out:
+        start = time.perf_counter()
+        # Pick the first (only) pack, delete surplus mods if asked, then press Enter to close.
+        proc = subprocess.Popen(cmd, cwd=workdir, stdin=subprocess.PIPE, stdout=out, stderr=subprocess.STDOUT)
+        proc.stdin.write(b'1\n3\n\n\n')
+        proc.stdin.close()
+        if hasattr(os, 'wait4'):
+            _, status, rusage = os.wait4(proc.pid, 0)
+            proc.returncode = status
+            # ru_maxrss is kilobytes on Linux, bytes on macOS.
+            rss = rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss
+            cpu = rusage.ru_utime + rusage.ru_stime
+        else:
+            proc.wait()
+            rss = cpu = None
+        wall = time.perf_counter() - start
+    with open(log) as f:
+        ok = 'S U C C E S S' in f.read()
+    return wall, cpu, rss, ok
+
+
+def benchmark(workdir):
+    cdn = StandInCDN()
+    threading.Thread(target=cdn.serve_forever, daemon=True).start()
+    packdir = os.path.join(workdir, 'packs')
+    os.makedirs(packdir)
+    server, port = start_server(packdir, workdir, cdn)
+    results = []
+    try:
+        for mods in PACK_SIZES:
+            base = os.path.join(workdir, str(mods))
+            cache_dir = os.path.join(base, 'cache')
+            for scenario in SCENARIOS:
+                generation = 0 if scenario in ('cold', 'warm') else 1
+                instance = os.path.join(base, 'instance2' if scenario == 'cached' else 'instance')
+                # Only one pack on the server at a time, so the client's "which pack?" answer is always 1.
+                with open(os.path.join(packdir, 'Bench.csv'), 'w') as f:
+                    f.write(make_pack(cdn, mods, generation))
+                cdn.take_stats()
+                wall, cpu, rss, ok = install(port, instance, cache_dir, cdn, workdir,
+                                             os.path.join(base, scenario + '.log'))
+                result = {'mods': mods, 'scenario': scenario, 'wall': round(wall, 3),
+                          'cpu': cpu and round(cpu, 3), 'peak_rss_kb': rss, 'ok': ok}
+                result.update(cdn.take_stats())
+                results.append(result)
+                print_result(result)
+    finally:
+        server.terminate()
+        server.wait()
+        cdn.shutdown()
+    return results
+
+
+def print_header():
+    print('%6s  %-12s %9s %9s %13s %8s %9s %10s  %s' % ('mods', 'scenario', 'wall (s)', 'requests', 'bytes',
+                                                      'CPU (s)', 'CPU s/GB', 'RSS (KB)', 'ok'))
+
+
+def print_result(result, baseline=None):
+    cpu = result.get('cpu')
+    per_gb = cpu / result['bytes'] * 1024 ** 3 if cpu is not None and result['bytes'] else None
+    line = '%6d  %-12s %9.2f %9d %13d %8s %9s %10s  %s' % (
+        result['mods'], result['scenario'], result['wall'], result['requests'], result['bytes'],
+        '-' if cpu is None else '%.2f' % cpu, '-' if per_gb is None else '%.1f' % per_gb, result['peak_rss_kb'],
+        'yes' if result['ok'] else 'FAILED')
+    if baseline is not None:
+        line += '   wall %+.1f%%, requests %+d, bytes %+d' % (
+            (result['wall'] / baseline['wall'] - 1) * 100 if baseline['wall'] else 0,
+            result['requests'] - baseline['requests'], result['bytes'] - baseline['bytes'])
+        if cpu is not None and baseline.get('cpu'):
+            line += ', CPU %+.1f%%' % ((cpu / baseline['cpu'] - 1) * 100)
+    print(line, flush=True)
+
+
+if __name__ == '__main__':
+    json_out = None
+    compare = None
+    keep = False
+    for arg in sys.argv[1:]:
+        if arg.startswith('--mods='):
+            PACK_SIZES = [int(n) for n in arg[7:].split(',')]
+        elif arg.startswith('--mean-size='):
+            MEAN_SIZE = int(arg[12:]) * 1024
+        elif arg.startswith('--latency='):
+            LATENCY = int(arg[10:]) / 1000
+        elif arg.startswith('--bandwidth='):
+            BANDWIDTH = int(arg[12:]) * 1024
+        elif arg.startswith('--fail-rate='):
+            FAIL_RATE = float(arg[12:])
+        elif arg == '--server-mirror':
+            SERVER_MIRROR = True
+        elif arg.startswith('--json='):
+            json_out = arg[7:]
+        elif arg.startswith('--compare='):
+            compare = arg[10:]
+        elif arg.startswith('--client-arg='):
+            CLIENT_ARGS.append(arg[13:])
+        elif arg == '--keep':
+            keep = True
+        else:
+            print('Usage: benchmark.py [--mods=N,N,...] [--mean-size=KB] [--latency=MS] [--bandwidth=KB]')
+            print('                    [--fail-rate=P] [--server-mirror] [--client-arg=ARG ...] [--json=FILE]')
+            print('                    [--compare=FILE] [--keep]')
+            print('Installs generated packs of each size in --mods (default %s) from a local stand-in'
+                  % ','.join(map(str, PACK_SIZES)))
+            print('CDN and server.py, and reports wall time, requests and bytes served by the CDN, and')
+            print("the client's CPU time and peak RSS.  --latency, --bandwidth (per connection, per second) and")
+            print('--fail-rate make the CDN behave more like the internet.  --server-mirror downloads')
+            print("through server.py's mirror instead of straight from the CDN.  --json saves the")
+            print('results, --compare shows the difference from ones saved earlier, and --keep leaves')
+            print('the instances, caches and client logs behind.  --client-arg passes ARG on to every')
+            print('run of the client (e.g. --client-arg=--no-zero-copy), and can be given more than once.')
+            exit()
+
+    workdir = tempfile.mkdtemp(prefix='swordfishpds-bench-')
+    print('Working in', workdir)
+    print_header()
+    try:
+        results = benchmark(workdir)
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if json_out is not None:
+        with open(json_out, 'w') as f:
+            json.dump(results, f, indent=1)
+    if compare is not None:
+        with open(compare) as f:
+            baselines = {(r['mods'], r['scenario']): r for r in json.load(f)}
+        print()
+        print('Compared with', compare)
+        print_header()
+        for result in results:
+            print_result(result, baselines.get((result['mods'], result['scenario'])))
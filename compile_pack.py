@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Compiles a pack -- a CSV, or a mod list in the old fixed width format reformat_modlist.py converts -- into the manifest
+that SwordfishPDS.py and server.py load in its place.  Repeated mods are dropped, and everything SwordfishPDS.py would
+otherwise only trip over halfway through an install (bad file IDs and version numbers, one file ID under two names,
+unknown rows) is reported up front instead of producing a manifest.
+
+With --resolve, the size of every download is looked up too, and with --hash its SHA-256, which SwordfishPDS.py holds
+the files it downloads to.  Whatever the previous compile of the same pack found out, and whatever the local mod cache
+already knows, is reused rather than looked up again.
+
+    compile_pack.py [options] pack.csv|modlist.txt output.pack
+"""
+import concurrent.futures
+import hashlib
+import http.client
+import os
+import sys
+
+import SwordfishPDS
+
+RESOLVE = False  # --resolve: HEAD every download for its size
+HASH = False  # --hash: download every file to find out its SHA-256 (and size)
+JOBS = 8  # --jobs=: how many files to look up at once
+CACHE_DIR = None  # --cache-dir=: mod cache to take sizes and hashes from; None means SwordfishPDS's default
+MIRROR = None  # --mirror=URL: server.py mirror to look files up through
+MOD_URL = 'https://media.forgecdn.net/files/{0}/{1}/{2}'  # what SwordfishPDS.py downloads MOD rows from
+
+
+def read_legacy(text):
+    """The MOD rows of a mod list in the fixed width format: a 7 digit file ID and then the filename, up to CONF."""
+    rows = []
+    for line in text.splitlines():
+        line = line[4:] if line.startswith('MODS') else line
+        if line.startswith('CONF'):
+            break
+        if line[:7].isdigit():
+            rows.append(['MOD', line[:7], line[7:].rstrip()])
+    return rows
+
+
+def read_pack(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data.startswith(SwordfishPDS.MANIFEST_MAGIC):
+        return SwordfishPDS.Pack.load(data).rows
+    text = data.decode('utf-8-sig')
+    if path.lower().endswith('.txt'):
+        return read_legacy(text)
+    return SwordfishPDS.parse_pack(text)
+
+
+def download_url(row):
+    """Where SwordfishPDS.py downloads the file a row installs from, or None if it doesn't install one we can size."""
+    if row[0] == 'MOD' and SwordfishPDS.row_source(row) is not None:
+        modid = int(row[1])
+        return MOD_URL.format(modid // 1000, modid % 1000, row[2]).replace(' ', '+')
+    if row[0] == 'Download':
+        return row[1]
+    return None
+
+
+def load_known(path, cache_dir):
+    """
+    ({source: size}, {source: SHA-256}) for everything the manifest at path (if there is one) and the mod cache in
+    cache_dir (likewise) know about.
+    """
+    sizes = {}
+    hashes = {}
+    if cache_dir is not None and os.path.isdir(cache_dir):
+        cache = SwordfishPDS.ModCache(cache_dir)
+        for key in list(cache.keys):
+            entry = cache.lookup(key)
+            if entry is not None:
+                hashes[key] = entry['sha256']
+                sizes[key] = cache.objects[entry['sha256']]['size']
+    try:
+        with open(path, 'rb') as f:
+            previous = SwordfishPDS.Pack.load(f.read())
+    except (OSError, SwordfishPDS.PackError):
+        pass
+    else:
+        sizes.update(previous.sizes)
+        hashes.update(previous.hashes)
+    return sizes, hashes
+
+
+def look_up(pool, url, want_hash):
+    """(size, SHA-256 or None) of the file at url.  Only downloads it if want_hash."""
+    with pool.request('GET' if want_hash else 'HEAD', url) as resp:
+        if resp.status != 200:
+            raise SwordfishPDS.DownloadError(resp)
+        if not want_hash:
+            return SwordfishPDS.get_content_length(resp, None), None
+        h = hashlib.sha256()
+        size = 0
+        for block in iter(lambda: resp.read(1024 * 1024), b''):
+            h.update(block)
+            size += len(block)
+    return size, h.hexdigest()
+
+
+def resolve(rows, sizes, hashes, want_hash, jobs=JOBS):
+    """Fill in sizes (and hashes, if want_hash) for every file rows download that they're missing.  Returns problems."""
+    todo = {}
+    for row in rows:
+        source, url = SwordfishPDS.row_source(row), download_url(row)
+        if url is not None and (source not in sizes or want_hash and source not in hashes):
+            todo[source] = url
+    pool = SwordfishPDS.ConnectionPool(mirror=MIRROR)
+    problems = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {source: executor.submit(look_up, pool, url, want_hash) for source, url in todo.items()}
+        for source, future in futures.items():
+            try:
+                size, digest = future.result()
+            except (OSError, SwordfishPDS.DownloadError, http.client.HTTPException) as e:
+                problems.append('%s: %s' % (todo[source], e))
+                continue
+            if size is not None:
+                sizes[source] = size
+            if digest is not None:
+                hashes[source] = digest
+    pool.close()
+    return problems
+
+
+def compile_pack(path, out):
+    """Compile the pack at path into a manifest at out.  Returns the Pack, or a list of problems if it can't."""
+    rows, dropped = SwordfishPDS.dedupe_rows(read_pack(path))
+    for row in dropped:
+        sys.stderr.write('dropped repeated %s\n' % ','.join(row))
+    problems = SwordfishPDS.check_rows(rows)
+    if problems:
+        return problems
+    sizes, hashes = load_known(out, CACHE_DIR or SwordfishPDS.default_cache_dir())
+    if RESOLVE or HASH:
+        problems = resolve(rows, sizes, hashes, HASH, JOBS)
+        if problems:
+            return problems
+    # Only what this pack downloads; the cache knows about plenty of other packs' files.
+    sources = {SwordfishPDS.row_source(row) for row in rows} - {None}
+    pack = SwordfishPDS.Pack(rows, {source: size for source, size in sizes.items() if source in sources},
+                             {source: digest for source, digest in hashes.items() if source in sources})
+    tmp = out + '.tmp%d' % os.getpid()
+    with open(tmp, 'wb') as f:
+        f.write(pack.dump())
+    os.replace(tmp, out)
+    return pack
+
+
+if __name__ == '__main__':
+    paths = []
+    for arg in sys.argv[1:]:
+        if arg == '--resolve':
+            RESOLVE = True
+        elif arg == '--hash':
+            HASH = True
+        elif arg.startswith('--jobs='):
+            JOBS = int(arg[7:])
+        elif arg.startswith('--cache-dir='):
+            CACHE_DIR = arg[12:]
+        elif arg.startswith('--mirror='):
+            MIRROR = arg[9:]
+        elif not arg.startswith('-'):
+            paths.append(arg)
+        else:
+            paths = []
+            break
+    if len(paths) != 2:
+        print('Usage: compile_pack.py [--resolve] [--hash] [--jobs=N] [--cache-dir=DIR] [--mirror=URL] INPUT OUTPUT')
+        print('Checks the pack INPUT (a CSV, or a .txt mod list in the old fixed width format) and')
+        print('compiles it into a manifest at OUTPUT, which SwordfishPDS.py and server.py can use in')
+        print('its place (server.py offers NAME.pack to clients that can read it, NAME.csv to the')
+        print('rest).  Repeated mods are dropped; anything else wrong with it is listed and nothing')
+        print('is written.')
+        print('--resolve looks up the size of every file the pack downloads, and --hash downloads')
+        print('them all to record their SHA-256, %d at a time (--jobs).  Sizes and hashes already in' % JOBS)
+        print('OUTPUT, or in the mod cache (%s, or --cache-dir),' % SwordfishPDS.default_cache_dir())
+        print("aren't looked up again.  --mirror=URL looks them up through a server.py mirror.")
+        exit()
+
+    result = compile_pack(*paths)
+    if isinstance(result, list):
+        sys.stderr.write('%s has problems, so no manifest was written:\n' % paths[0])
+        for problem in result:
+            sys.stderr.write(' - %s\n' % problem)
+        sys.exit(1)
+    mods = sum(1 for row in result.rows if row[0] == 'MOD')
+    print('%s: %d rows (%d mods), %d sizes and %d hashes known, version %s'
+          % (paths[1], len(result.rows), mods, len(result.sizes), len(result.hashes),
+             SwordfishPDS.format_version(result.version) if result.version else 'none'))
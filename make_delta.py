@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Makes deltas from the files one version of a pack downloads to the ones the next version downloads in their place, for
+server.py to hand out, so that SwordfishPDS.py can patch the new version of a mod together out of the old one it
+already has instead of downloading the whole thing again.
+
+Jars (and any other zip) are compared member by member: whatever the new version has byte for byte the same as the old
+one -- usually most of the classes, when a mod bumps its patch version -- is copied out of the old file, and only the
+rest goes in the delta.  Downloads are paired up by where they go, and mods by their filename with the version taken
+off.  Deltas are named after the SHA-256s of the two files and listed in index.json under the new file's source.
+
+    make_delta.py [options] old.csv|old.pack new.csv|new.pack
+"""
+import concurrent.futures
+import hashlib
+import http.client
+import io
+import json
+import os
+import re
+import struct
+import sys
+import zipfile
+import zlib
+
+import compile_pack
+import SwordfishPDS
+
+OUT_DIR = 'deltas'  # --out=: where the deltas go; what server.py --delta-dir serves
+JOBS = 8  # --jobs=: how many pairs of files to fetch and compare at once
+CACHE_DIR = None  # --cache-dir=: mod cache to take files from; None means SwordfishPDS's default
+MIRROR = None  # --mirror=URL: server.py mirror to download files through
+MAX_RATIO = 0.5  # --max-ratio=: deltas bigger than this fraction of the new file aren't worth keeping
+# Where the version starts in a mod's filename: the first separator followed by a number, perhaps with a v, r or mc.
+VERSION_RE = re.compile(r'[-_+ ]+(?:v|r|rv|mc)?\d')
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')  # a zip member's local file header, up to its name
+
+
+def mod_stem(filename):
+    """A mod's filename without its version, e.g. jei for jei_1.12.2-4.16.1.302.jar."""
+    name = os.path.splitext(filename)[0].lower()
+    match = VERSION_RE.search(name)
+    return name[:match.start()] if match else name
+
+
+def pair_rows(old_rows, new_rows):
+    """(old row, new row) for every file new_rows downloads in place of a different one old_rows did."""
+    def keyed(rows):
+        keys = {}
+        for row in rows:
+            if compile_pack.download_url(row) is None:
+                continue
+            key = ('Download', row[2]) if row[0] == 'Download' else ('MOD', mod_stem(row[2]))
+            # Two mods with the same name would be anybody's guess, so neither is paired with anything.
+            keys[key] = row if key not in keys else None
+        return keys
+    old, new = keyed(old_rows), keyed(new_rows)
+    pairs = []
+    for key, row in new.items():
+        if row is not None and old.get(key) is not None \
+                and SwordfishPDS.row_source(old[key]) != SwordfishPDS.row_source(row):
+            pairs.append((old[key], row))
+    return pairs
+
+
+def fetch(pool, cache, row):
+    """The contents of the file row downloads, out of cache if it's there."""
+    entry = cache and cache.lookup(SwordfishPDS.row_source(row))
+    if entry:
+        with open(cache.object_path(entry['sha256']), 'rb') as f:
+            return f.read()
+    with pool.request('GET', compile_pack.download_url(row)) as resp:
+        if resp.status != 200:
+            raise SwordfishPDS.DownloadError(resp)
+        return resp.read()
+
+
+def zip_members(data):
+    """(header start, data start, data end) of every member of the zip in data, in order, or [] if it isn't one."""
+    try:
+        infos = zipfile.ZipFile(io.BytesIO(data)).infolist()
+    except zipfile.BadZipFile:
+        return []
+    members = []
+    for info in infos:
+        start = info.header_offset
+        fields = LOCAL_HEADER.unpack_from(data, start) if start + LOCAL_HEADER.size <= len(data) else None
+        if fields is None or fields[0] != b'PK\x03\x04':
+            continue  # zipfile will have had something to say about it if it mattered
+        data_start = start + LOCAL_HEADER.size + fields[9] + fields[10]
+        members.append((start, data_start, data_start + info.compress_size))
+    return sorted(members)
+
+
+def make_delta(old, new):
+    """
+    A delta that turns old into new, in the format SwordfishPDS.apply_delta() reads.  Only the compressed data of zip
+    members (and their headers, where those haven't changed either) gets copied from old; everything else is inserted,
+    so a file that isn't a zip comes out as one big insert.
+    """
+    ops = []
+    inserts = []
+
+    def copy(offset, length):
+        if ops and ops[-1][0] is not None and ops[-1][0] + ops[-1][1] == offset:
+            ops[-1][1] += length
+        elif length:
+            ops.append([offset, length])
+
+    def insert(data):
+        if not data:
+            return
+        inserts.append(data)
+        if ops and ops[-1][0] is None:
+            ops[-1][1] += len(data)
+        else:
+            ops.append([None, len(data)])
+
+    # Members are looked up by their compressed data, so a class that moved, or whose header changed, still matches.
+    by_data = {}
+    for start, data_start, data_end in zip_members(old):
+        by_data.setdefault(old[data_start:data_end], (start, data_start, data_end))
+    pos = 0
+    for start, data_start, data_end in zip_members(new):
+        match = by_data.get(new[data_start:data_end]) if data_end > data_start else None
+        if match is None or start < pos:
+            continue
+        insert(new[pos:start])
+        old_start, old_data_start, old_data_end = match
+        if new[start:data_start] == old[old_start:old_data_start]:
+            copy(old_start, old_data_end - old_start)
+        else:
+            insert(new[start:data_start])
+            copy(old_data_start, old_data_end - old_data_start)
+        pos = data_end
+    insert(new[pos:])
+    header = {'from': hashlib.sha256(old).hexdigest(), 'size': len(new), 'sha256': hashlib.sha256(new).hexdigest(),
+              'ops': ops}
+    body = json.dumps(header, separators=(',', ':')).encode('ascii') + b'\n' + b''.join(inserts)
+    return SwordfishPDS.DELTA_MAGIC + zlib.compress(body, 9)
+
+
+def diff_pair(pool, cache, old_row, new_row):
+    """(SHA-256 of the old file, SHA-256 of the new one, size of the new one, delta) for a pair from pair_rows()."""
+    old = fetch(pool, cache, old_row)
+    new = fetch(pool, cache, new_row)
+    return hashlib.sha256(old).hexdigest(), hashlib.sha256(new).hexdigest(), len(new), make_delta(old, new)
+
+
+def load_index(out_dir):
+    try:
+        with open(os.path.join(out_dir, 'index.json')) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_index(out_dir, index):
+    # Forgetting whatever deltas somebody has deleted since, so clients don't go asking for them.
+    index = {source: {old: name for old, name in deltas.items() if os.path.exists(os.path.join(out_dir, name))}
+             for source, deltas in index.items()}
+    tmp = os.path.join(out_dir, 'index.json.tmp%d' % os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({source: deltas for source, deltas in index.items() if deltas}, f, indent=1, sort_keys=True)
+    os.replace(tmp, os.path.join(out_dir, 'index.json'))
+
+
+def make_deltas(old_path, new_path, out_dir):
+    """
+    Make a delta to every file the pack at new_path downloads in place of one the pack at old_path did, in out_dir,
+    and add them to its index.json.  Returns (deltas made, problems).
+    """
+    pairs = pair_rows(compile_pack.read_pack(old_path), compile_pack.read_pack(new_path))
+    cache_dir = CACHE_DIR or SwordfishPDS.default_cache_dir()
+    cache = SwordfishPDS.ModCache(cache_dir) if os.path.isdir(cache_dir) else None
+    pool = SwordfishPDS.ConnectionPool(mirror=MIRROR)
+    os.makedirs(out_dir, exist_ok=True)
+    index = load_index(out_dir)
+    made = 0
+    problems = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=JOBS) as executor:
+        futures = [(old_row, new_row, executor.submit(diff_pair, pool, cache, old_row, new_row))
+                   for old_row, new_row in pairs]
+        for old_row, new_row, future in futures:
+            try:
+                old_digest, new_digest, size, delta = future.result()
+            except (OSError, SwordfishPDS.DownloadError, http.client.HTTPException) as e:
+                problems.append('%s -> %s: %s' % (old_row[2], new_row[2], e))
+                continue
+            if old_digest == new_digest or len(delta) > size * MAX_RATIO:
+                print('%s -> %s: not worth a delta' % (old_row[2], new_row[2]))
+                continue
+            name = '%s-%s.delta' % (old_digest, new_digest)
+            tmp = os.path.join(out_dir, name + '.tmp%d' % os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(delta)
+            os.replace(tmp, os.path.join(out_dir, name))
+            index.setdefault(SwordfishPDS.row_source(new_row), {})[old_digest] = name
+            made += 1
+            print('%s -> %s: %s delta for %s' % (old_row[2], new_row[2], SwordfishPDS.format_bytes(len(delta)),
+                                                SwordfishPDS.format_bytes(size)))
+    pool.close()
+    save_index(out_dir, index)
+    return made, problems
+
+
+if __name__ == '__main__':
+    paths = []
+    for arg in sys.argv[1:]:
+        if arg.startswith('--out='):
+            OUT_DIR = arg[6:]
+        elif arg.startswith('--jobs='):
+            JOBS = int(arg[7:])
+        elif arg.startswith('--cache-dir='):
+            CACHE_DIR = arg[12:]
+        elif arg.startswith('--mirror='):
+            MIRROR = arg[9:]
+        elif arg.startswith('--max-ratio='):
+            MAX_RATIO = float(arg[12:])
+        elif not arg.startswith('-'):
+            paths.append(arg)
+        else:
+            paths = []
+            break
+    if len(paths) != 2:
+        print('Usage: make_delta.py [--out=DIR] [--jobs=N] [--cache-dir=DIR] [--mirror=URL] [--max-ratio=R] OLD NEW')
+        print('Finds every file the pack NEW (a CSV or a compiled manifest) downloads in place of one')
+        print('the pack OLD did -- mods whose version changed, Downloads to the same place from a new')
+        print('URL -- and saves a delta from the old file to the new one in --out (default %s),' % OUT_DIR)
+        print("for server.py --mirror to serve from its --delta-dir.  Clients that have the old file")
+        print('download the delta instead of the whole new file.  Jars are compared member by member;')
+        print('deltas bigger than --max-ratio (default %g) of the file they make are thrown away.' % MAX_RATIO)
+        print('Files are taken from the mod cache (%s, or --cache-dir) where they' % SwordfishPDS.default_cache_dir())
+        print('are there, and downloaded %d at a time (--jobs) otherwise, through --mirror if given.' % JOBS)
+        exit()
+
+    made, problems = make_deltas(paths[0], paths[1], OUT_DIR)
+    print('%d deltas made in %s' % (made, OUT_DIR))
+    if problems:
+        sys.stderr.write("Couldn't make deltas for:\n")
+        for problem in problems:
+            sys.stderr.write(' - %s\n' % problem)
+        sys.exit(1)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Turns CurseForge project slugs into the MOD,<file id>,<filename> lines SwordfishPDS.py installs from, by finding the
+newest file for the pack's game version on each project's files page and reading its filename off the file's own page.
+
+Projects are looked up several at a time, and every page fetched is kept on disk, so running it again over a pack
+that's only had a few mods added only has to ask about those.  File pages never change; listings are trusted for
+--max-age hours.
+
+    resolve_mods.py [options] slug[@game version] ... > mods.csv
+"""
+import concurrent.futures
+import csv
+import hashlib
+import html.parser
+import os
+import re
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+BASE_URL = 'https://www.curseforge.com'  # --base-url=, e.g. to point it at saved pages served locally
+# CurseForge's files page takes its game version filter as an opaque ID.  Anything not in here is passed through as is.
+GAME_VERSIONS = {'1.12.2': '1738749986:628'}
+GAME_VERSION = '1.12.2'  # --game-version=, for slugs that don't say
+JOBS = 8  # --jobs=: how many projects to look up at once
+CACHE_DIR = '_resolve_mods_cache'  # --cache-dir=
+MAX_AGE = 24 * 3600  # --max-age=HOURS: how long a cached listing is good for
+USER_AGENT = 'Mozilla/5.0 (compatible; SwordfishPDS resolve_mods)'
+TIMEOUT = 30
+
+
+class ResolveError(Exception):
+    pass
+
+
+class FileLinkFinder(html.parser.HTMLParser):
+    # The href of the first <a data-action="file-link">, which on a files page is the newest file.
+    def __init__(self):
+        super().__init__()
+        self.href = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if self.href is None and tag == 'a' and attrs.get('data-action') == 'file-link':
+            self.href = attrs.get('href')
+
+
+class FilenameFinder(html.parser.HTMLParser):
+    # The text of whatever element comes after <span>Filename</span> on a file's page.
+    VOID = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+    def __init__(self):
+        super().__init__()
+        self.depth = 0
+        self.span_text = None  # text of the <span> we're in, if we're in one
+        self.span_depth = None
+        self.sibling_depth = None  # depth the element after the label will open at, once we've seen the label
+        self.capture_depth = None  # depth of the element we're reading the filename out of
+        self.captured = []
+        self.filename = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.filename is not None or tag in self.VOID:
+            return
+        if self.sibling_depth is not None and self.depth == self.sibling_depth and self.capture_depth is None:
+            self.capture_depth = self.depth
+        if tag == 'span' and self.capture_depth is None:
+            self.span_text = []
+            self.span_depth = self.depth
+        self.depth += 1
+
+    def handle_endtag(self, tag):
+        if self.filename is not None or tag in self.VOID:
+            return
+        self.depth -= 1
+        if self.capture_depth is not None and self.depth == self.capture_depth:
+            self.filename = ''.join(self.captured).strip()
+        elif self.span_depth is not None and self.depth == self.span_depth:
+            if ''.join(self.span_text).strip() == 'Filename':
+                self.sibling_depth = self.depth
+            self.span_text = self.span_depth = None
+        elif self.sibling_depth is not None and self.depth < self.sibling_depth:
+            self.sibling_depth = None  # the label was the last thing in its parent
+
+    def handle_data(self, data):
+        if self.capture_depth is not None:
+            self.captured.append(data)
+        elif self.span_text is not None:
+            self.span_text.append(data)
+
+
+def fetch(url, max_age):
+    """The body of url as text, from the cache if we got it less than max_age seconds ago."""
+    path = os.path.join(CACHE_DIR, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.html')
+    try:
+        if time.time() - os.path.getmtime(path) < max_age:
+            with open(path, encoding='utf-8') as f:
+                return f.read()
+    except FileNotFoundError:
+        pass
+    req = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+    try:
+        with urllib.request.urlopen(req, timeout=TIMEOUT) as resp:
+            text = resp.read().decode(resp.headers.get_content_charset() or 'utf-8', 'replace')
+    except urllib.error.HTTPError as e:
+        raise ResolveError('%d %s from %s' % (e.code, e.reason, url))
+    except OSError as e:
+        raise ResolveError('%s fetching %s' % (e, url))
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = path + '.tmp%d' % os.getpid()
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp, path)
+    return text
+
+
+def resolve(spec):
+    """
+    Find the newest file of a project for a game version.
+
+    :param spec: The project's slug, optionally followed by @ and a game version (or CurseForge version filter ID).
+    :returns: (file ID, filename)
+    :raises ResolveError: if the project, a file for that game version, or its filename can't be found.
+    """
+    slug, _, version = spec.partition('@')
+    version = version or GAME_VERSION
+    query = urllib.parse.urlencode({'filter-game-version': GAME_VERSIONS.get(version, version)})
+    listing_url = '%s/minecraft/mc-mods/%s/files/all?%s' % (BASE_URL, urllib.parse.quote(slug), query)
+    finder = FileLinkFinder()
+    finder.feed(fetch(listing_url, MAX_AGE))
+    if finder.href is None:
+        raise ResolveError('no files for %s' % version)
+    file_url = urllib.parse.urljoin(listing_url, finder.href)
+    match = re.search(r'/minecraft/mc-mods/[^/]*/files/(\d+)$', urllib.parse.urlsplit(file_url).path)
+    if match is None:
+        raise ResolveError("don't understand the file link %s" % finder.href)
+    finder = FilenameFinder()
+    # A file's page describes that one file forever, so there's no need to ever fetch it twice.
+    finder.feed(fetch(file_url, float('inf')))
+    if not finder.filename:
+        raise ResolveError('no filename on %s' % file_url)
+    return match.group(1), finder.filename
+
+
+def resolve_all(specs, jobs=JOBS):
+    """Resolve every spec, jobs at a time.  Yields (spec, (file ID, filename) or a ResolveError) in order."""
+    def attempt(spec):
+        try:
+            return resolve(spec)
+        except ResolveError as e:
+            return e
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        yield from zip(specs, executor.map(attempt, specs))
+
+
+if __name__ == '__main__':
+    specs = []
+    for arg in sys.argv[1:]:
+        if arg.startswith('--base-url='):
+            BASE_URL = arg[11:].rstrip('/')
+        elif arg.startswith('--game-version='):
+            GAME_VERSION = arg[15:]
+        elif arg.startswith('--jobs='):
+            JOBS = int(arg[7:])
+        elif arg.startswith('--cache-dir='):
+            CACHE_DIR = arg[12:]
+        elif arg.startswith('--max-age='):
+            MAX_AGE = float(arg[10:]) * 3600
+        elif arg.startswith('--from='):
+            with (sys.stdin if arg[7:] == '-' else open(arg[7:])) as f:
+                specs += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        elif not arg.startswith('-'):
+            specs.append(arg)
+        else:
+            specs = []
+            break
+    if not specs:
+        print('Usage: resolve_mods.py [--game-version=VERSION] [--jobs=N] [--cache-dir=DIR] [--max-age=HOURS]')
+        print('                       [--base-url=URL] [--from=FILE|-] slug[@version] ...')
+        print("Looks up the newest file of each CurseForge project (by the slug in its URL) for the")
+        print('game version (default %s, or whatever follows an @) and prints the MOD lines for' % GAME_VERSION)
+        print('them that a SwordfishPDS pack takes.  --from reads slugs from a file, one per line.')
+        print('%d projects are looked up at once (--jobs), and pages are cached in --cache-dir' % JOBS)
+        print('(default %s); lists of files are fetched again after --max-age hours (default %g).'
+              % (CACHE_DIR, MAX_AGE / 3600))
+        print('--base-url points it somewhere other than %s, such as saved pages served locally.' % BASE_URL)
+        exit()
+
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    failed = 0
+    for spec, result in resolve_all(specs, JOBS):
+        if isinstance(result, ResolveError):
+            sys.stderr.write('%s: %s\n' % (spec, result))
+            failed += 1
+        else:
+            writer.writerow(['MOD', *result])
+            sys.stdout.flush()
+    sys.exit(1 if failed else 0)
@@ -1,21 +1,649 @@
+import csv
+import hashlib
+import http.server
+import json
 import socketserver
 import os
 import socket
-import shutil
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+
+PORT = 21617
+IDLE_TIMEOUT = 60  # seconds a client gets to pick a pack before we hang up on them
+WATCH_INTERVAL = 1.0  # seconds between looks at the packs for changes, while anybody is watching one
+SETTLE_TIME = 2.0  # a pack modified more recently than this may still be being written, so isn't looked at yet
+KEEPALIVE = 30  # seconds between reminders to a watching client that we're still here
+PROTOCOL = 'SWORDFISHPDS/2'
+MIRROR_PORT = 21618
+MIRROR_DIR = 'mirror'
+DELTA_DIR = 'deltas'  # where make_delta.py puts its deltas, which the mirror serves under /deltas/
+UPSTREAM = 'https://media.forgecdn.net'  # where /files/ paths on the mirror come from
+USER_AGENT = 'SwordfishPDS mirror'
+
+
+MANIFEST_MAGIC = b'SWORDFISHPDS-MANIFEST/1\n'  # what packs compiled by compile_pack.py start with
+
+
+def pack_rows(data):
+    """The rows of a pack file, be it a CSV or a manifest compile_pack.py made out of one."""
+    if data.startswith(MANIFEST_MAGIC):
+        return json.loads(zlib.decompress(data[len(MANIFEST_MAGIC):]))['rows']
+    lines = (line for line in data.decode('utf-8-sig').splitlines() if not line.startswith('#'))
+    return [[field.strip() for field in row] for row in csv.reader(lines)]
+
+
+class PackIndex:
+    def __init__(self, directory='.'):
+        """
+        The packs available in directory, kept in memory and only re-read when the directory's mtime says something
+        was added, removed or renamed.  Each pack is kept open so it can be sent with sendfile() straight out of the
+        page cache; it gets reopened if the file itself is modified.
+
+        A pack can be a CSV (name.csv), a manifest compiled from one (name.pack), or both.  Clients that say they can
+        read manifests get the manifest; everybody else gets the CSV.
+        """
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.listing = b'\n'
+        self.names = {}  # name -> {'.csv': path, '.pack': path}, for whichever of the two there are
+        self.packs = {}  # path -> (st_mtime_ns, st_size, open file)
+        # path -> (st_mtime_ns, st_size, sha256 of the file, zlib compressed file, rows, set of URLs it downloads)
+        self.bodies = {}
+        self.changed = threading.Condition()
+        self.generation = 0  # goes up every time the watcher sees a pack change
+        self.watcher = None
+
+    def refresh(self):
+        mtime = os.stat(self.directory).st_mtime_ns
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            names = {}
+            for item in os.listdir(self.directory):
+                name, ext = os.path.splitext(item)
+                if ext in ('.csv', '.pack'):
+                    names.setdefault(name, {})[ext] = os.path.join(self.directory, item)
+            paths = {path for kinds in names.values() for path in kinds.values()}
+            for path in set(self.packs) - paths:
+                self.packs.pop(path)[2].close()
+            for path in set(self.bodies) - paths:
+                del self.bodies[path]
+            self.listing = b''.join((name + '\n').encode('ascii') for name in sorted(names)) + b'\n'
+            self.names = names
+            self.mtime = mtime
+
+    def open(self, name):
+        """Returns (open file, length) for the CSV of the pack called name, or None if there isn't one."""
+        path = self.names.get(name, {}).get('.csv')
+        if path is None:
+            return None
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            cached = self.packs.get(path)
+            if cached is None or cached[:2] != (st.st_mtime_ns, st.st_size):
+                if cached is not None:
+                    cached[2].close()
+                cached = self.packs[path] = (st.st_mtime_ns, st.st_size, open(path, 'rb'))
+        return cached[2], cached[1]
+
+    def _load(self, name, path):
+        # The bodies entry for path, (re)reading it if it's new or has changed.  None if it's gone.
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        cached = self.bodies.get(path)
+        if cached is None or cached[:2] != (st.st_mtime_ns, st.st_size):
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()
+            try:
+                rows = pack_rows(data)
+            except (ValueError, zlib.error) as e:
+                print('cannot read', path + ':', e)
+                rows = []
+            if cached is not None and cached[2] != digest:
+                mine, theirs = set(map(tuple, rows)), set(map(tuple, cached[4]))
+                print('pack %s changed: %d lines added, %d removed' % (name, len(mine - theirs), len(theirs - mine)))
+            # Manifests are compressed already.
+            compressed = zlib.compress(data, 0 if data.startswith(MANIFEST_MAGIC) else 9)
+            urls = {row[1] for row in rows if len(row) > 1 and row[0] != 'MOD'}
+            cached = (st.st_mtime_ns, st.st_size, digest, compressed, rows, urls)
+            with self.lock:
+                self.bodies[path] = cached
+        return cached
+
+    def body(self, name, manifests=False):
+        """
+        Returns (sha256, compressed body) of the pack called name, or None if there isn't one.
+
+        :param manifests: Whether the client can read a compiled manifest, which it gets in preference to the CSV.
+        """
+        kinds = self.names.get(name, {})
+        path = manifests and kinds.get('.pack') or kinds.get('.csv')
+        cached = path and self._load(name, path)
+        return cached and cached[2:4]
+
+    def start_watching(self):
+        with self.changed:
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=self._watch, daemon=True)
+                self.watcher.start()
+
+    def _watch(self):
+        # Look every pack over every WATCH_INTERVAL, and wake up wait_for_change() when one's changed.  Only the stat()
+        # of each file, unless it has changed; _load() takes care of that.
+        digests = None
+        while True:
+            current = {}
+            try:
+                self.refresh()
+            except OSError as e:
+                print('cannot list packs:', e)
+            for name, kinds in list(self.names.items()):
+                for path in kinds.values():
+                    try:
+                        if time.time() - os.stat(path).st_mtime < SETTLE_TIME:
+                            current[path] = digests and digests.get(path)
+                            continue
+                    except FileNotFoundError:
+                        continue
+                    cached = self._load(name, path)
+                    if cached is not None:
+                        current[path] = cached[2]
+            if current != digests:
+                digests = current
+                with self.changed:
+                    self.generation += 1
+                    self.changed.notify_all()
+            time.sleep(WATCH_INTERVAL)
+
+    def wait_for_change(self, generation, timeout):
+        """Wait until a pack changes (since generation, if given) or timeout seconds pass.  Returns the generation."""
+        self.start_watching()
+        with self.changed:
+            self.changed.wait_for(lambda: generation is not None and self.generation != generation, timeout)
+            return self.generation
+
+    def allows(self, url):
+        """Whether any of our packs downloads url, i.e. whether the mirror should be willing to fetch it."""
+        self.refresh()
+        for name, kinds in list(self.names.items()):
+            for path in kinds.values():
+                cached = self._load(name, path)
+                if cached is not None and url in cached[5]:
+                    return True
+        return False
+
 
 class Handler(socketserver.StreamRequestHandler):
+    timeout = IDLE_TIMEOUT
+
     def handle(self):
-        for item in os.listdir('.'):
-            if item.endswith('.csv'):
-                self.wfile.write((item[:-4]+'\n').encode('ascii'))
-        self.wfile.write(b'\n')
-        requestedPack = self.rfile.readline().decode('ascii').strip()+'.txt'
-        if not os.path.exists(os.path.join(os.path.curdir, requestedPack)):
-            self.connection.sendall(b'FIN')
+        index = self.server.index
+        try:
+            index.refresh()
+            self.wfile.write(index.listing)
+            self.wfile.flush()
+            request = self.rfile.readline().decode('ascii')
+            if request.startswith(PROTOCOL + '\t'):
+                self.handle_v2(*(request.rstrip('\r\n').split('\t') + ['-', '-', '-', '-'])[1:6])
+                return
+            requestedPack = request.strip()
+            pack = index.open(requestedPack)
+            if pack is None:
+                self.connection.sendall(b'FIN')
+            else:
+                print('transmitting pack', requestedPack, 'to', self.client_address[0])
+                f, length = pack
+                # sendfile() with an explicit offset doesn't care where anyone else's copy of f has got to.
+                self.connection.sendfile(f, 0, length)
+        except (socket.timeout, ConnectionError, UnicodeDecodeError):
+            # Wandered off, hung up, or isn't one of ours.  Either way, next.
+            pass
+
+    def handle_v2(self, requestedPack, version, digest, formats, watch):
+        # The client told us which version of the pack it has installed, the hash of the copy of the pack file it
+        # last got from us, and (if it's new enough) whether it reads compiled manifests.  If what it has is still
+        # what we've got, tell it so rather than sending the whole thing again.  Otherwise send it compressed.
+        # A client that says watch (SwordfishPDS.py --daemon) stays connected after that, and gets sent the pack again
+        # every time it changes, and an UNCHANGED every KEEPALIVE seconds in between so it knows we're still here.
+        index = self.server.index
+        manifests = 'manifest' in formats.split(',')
+        watching = watch == 'watch'
+        generation = index.wait_for_change(None, 0) if watching else None
+        digest = self.send_pack(requestedPack, version, digest, manifests)
+        while watching:
+            self.wfile.flush()
+            generation = index.wait_for_change(generation, KEEPALIVE)
+            digest = self.send_pack(requestedPack, version, digest, manifests)
+
+    def send_pack(self, requestedPack, version, digest, manifests):
+        # Returns the digest the client now has.
+        body = self.server.index.body(requestedPack, manifests)
+        if body is None:
+            self.wfile.write(('%s NOTFOUND\n' % PROTOCOL).encode('ascii'))
+            return digest
+        if body[0] == digest:
+            self.wfile.write(('%s UNCHANGED%s\n' % (PROTOCOL, self.extras())).encode('ascii'))
+            return digest
+        print('transmitting pack', requestedPack, 'to', self.client_address[0], 'which has version', version)
+        self.wfile.write(('%s OK %d %s%s\n' % (PROTOCOL, len(body[1]), body[0], self.extras())).encode('ascii'))
+        self.wfile.write(body[1])
+        return body[0]
+
+    def extras(self):
+        # key=value pairs tacked onto the end of the status line.  Clients ignore any they don't understand.
+        if self.server.mirror_port is None:
+            return ''
+        # Whatever address the client reached us on is the one it can reach the mirror on too.
+        host = self.connection.getsockname()[0]
+        if ':' in host:
+            host = '[%s]' % host
+        return ' mirror=http://%s:%d/ deltas=http://%s:%d/deltas/' % ((host, self.server.mirror_port) * 2)
+
+
+class PackServer(socketserver.ThreadingTCPServer):
+    # One thread per client, so somebody sitting at the "which pack?" prompt doesn't hold up everybody else.
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, address, directory='.', mirror_port=None):
+        self.index = PackIndex(directory)
+        self.mirror_port = mirror_port
+        super().__init__(address, Handler)
+
+
+#####################################################
+############ LAN MIRROR #############################
+#####################################################
+
+class Fill:
+    def __init__(self, mirror, url, path):
+        """
+        One download from upstream into the mirror, to path + '.part' and then path, which the clients that want the
+        file are sent as it arrives rather than made to wait for all of it -- they'd time out waiting on a big file
+        from a slow upstream.  It carries on to the end even if they all hang up, so the next client finds it cached.
+        """
+        self.mirror = mirror
+        self.url = url
+        self.path = path
+        self.part = path + '.part'
+        self.cond = threading.Condition()
+        self.meta = None  # once upstream has answered
+        self.written = 0  # bytes of it in the .part so far
+        self.done = False  # whether it's all there, and at path
+        self.error = None  # whatever went wrong, if it did
+
+    def run(self):
+        sys.stdout.write('mirroring %s\n' % self.url)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            req = urllib.request.Request(self.url.replace(' ', '%20'), headers={'User-Agent': USER_AGENT})
+            with urllib.request.urlopen(req, timeout=60) as resp, open(self.part, 'wb', buffering=0) as f:
+                meta = self.mirror._metadata(self.url, resp, int(resp.headers.get('Content-Length') or 0))
+                with self.cond:
+                    self.meta = meta
+                    self.cond.notify_all()
+                while True:
+                    chunk = resp.read(256 * 1024)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    with self.cond:
+                        self.written += len(chunk)
+                        self.cond.notify_all()
+            if meta['size'] and self.written != meta['size']:
+                raise OSError('upstream sent %d of %d bytes' % (self.written, meta['size']))
+            meta = dict(meta, size=self.written)
+            with self.cond:
+                # Under the lock, so that open() finds it in one place or the other.
+                os.replace(self.part, self.path)
+                # The .json going in last is what marks the file as complete.
+                with open(self.path + '.json.tmp', 'w') as f:
+                    json.dump(meta, f)
+                os.replace(self.path + '.json.tmp', self.path + '.json')
+                self.done = True
+        except Exception as e:
+            with self.cond:
+                # http.client's errors for a response cut short aren't OSErrors, but they're the same thing here.
+                self.error = e if isinstance(e, OSError) else OSError(str(e) or type(e).__name__)
+            try:
+                os.unlink(self.part)
+            except FileNotFoundError:
+                pass
+        finally:
+            with self.mirror.lock:
+                self.mirror.fetching.pop(self.url, None)
+            with self.cond:
+                self.cond.notify_all()
+
+    def wait_for_meta(self):
+        """What upstream says about the file, once it has answered.  Raises whatever went wrong if it didn't."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.meta is not None or self.error is not None)
+            if self.meta is None:
+                raise self.error
+            return self.meta
+
+    def wait(self):
+        """Wait until it's all there.  Raises whatever went wrong if it didn't get there."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.done or self.error is not None)
+            if not self.done:
+                raise self.error
+
+    def wait_for(self, pos):
+        """Wait until there's more than pos bytes of the file.  Returns how many there are."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.written > pos or self.done or self.error is not None)
+            if self.written > pos:
+                return self.written
+            if self.error is not None:
+                raise self.error
+            raise OSError('upstream sent %d bytes' % self.written)
+
+    def open(self):
+        with self.cond:
+            return open(self.path if self.done else self.part, 'rb')
+
+
+class Mirror:
+    def __init__(self, directory=MIRROR_DIR):
+        """
+        Read-through cache of files from upstream.  Each file is stored under the sha256 of the URL it came from, with
+        a .json next to it holding the filename and content type upstream gave it.
+        """
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.fetching = {}  # url -> the Fill downloading it
+
+    def path(self, url):
+        digest = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def cached(self, url):
+        """Returns (path, metadata) for url if we have it, otherwise None."""
+        path = self.path(url)
+        try:
+            with open(path + '.json') as f:
+                return path, json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def head(self, url):
+        """What upstream says about url, as metadata like get() returns, without downloading it."""
+        req = urllib.request.Request(url.replace(' ', '%20'), headers={'User-Agent': USER_AGENT}, method='HEAD')
+        with urllib.request.urlopen(req, timeout=60) as resp:
+            return self._metadata(url, resp, int(resp.headers.get('Content-Length') or 0))
+
+    @staticmethod
+    def _metadata(url, resp, size):
+        filename = None
+        for part in (resp.headers.get('Content-Disposition') or '').split(';'):
+            part = part.strip()
+            if part.startswith('filename='):
+                filename = part[9:].strip('"')
+        if not filename:
+            filename = urllib.parse.unquote(urllib.parse.urlsplit(resp.geturl()).path.rsplit('/', 1)[-1])
+        return {'url': url, 'filename': filename, 'size': size,
+                'content_type': resp.headers.get('Content-Type', 'application/octet-stream'),
+                # Passed on so that clients resuming a download can tell whether it's still the same file.
+                'etag': resp.headers.get('ETag'), 'last_modified': resp.headers.get('Last-Modified')}
+
+    def get(self, url):
+        """
+        Returns (path, metadata) for url if we have it, otherwise the Fill downloading it, started if nobody has
+        already.  Only one thread downloads any given URL; everyone who wants it meanwhile is sent it from that one.
+        """
+        cached = self.cached(url)
+        if cached is not None:
+            return cached
+        with self.lock:
+            # It may have finished since we looked; Fills only leave fetching once the .json is in place.
+            cached = self.cached(url)
+            if cached is not None:
+                return cached
+            fill = self.fetching.get(url)
+            if fill is None:
+                fill = self.fetching[url] = Fill(self, url, self.path(url))
+                threading.Thread(target=fill.run, daemon=True).start()
+            return fill
+
+
+class MirrorHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Otherwise a small file sits in our send buffer waiting for the client's delayed ACK of the headers.
+    disable_nagle_algorithm = True
+    timeout = IDLE_TIMEOUT
+
+    def upstream_url(self):
+        """The URL the request is for, or None after sending an error if it isn't one we'll fetch."""
+        parts = urllib.parse.urlsplit(self.path)
+        if parts.path.startswith('/files/'):
+            return UPSTREAM + parts.path
+        if parts.path == '/fetch':
+            url = urllib.parse.parse_qs(parts.query).get('url', [''])[0]
+            # Only things our own packs download, or this is an open proxy for anybody on the network.
+            if url and self.server.index.allows(url):
+                return url
+            self.send_error(403)
+            return None
+        self.send_error(404)
+        return None
+
+    def delta(self):
+        """(path, metadata) of the file under /deltas/ the request is for, or None if it isn't for one."""
+        path = urllib.parse.urlsplit(self.path).path
+        if not path.startswith('/deltas/'):
+            return None
+        name = path[8:]
+        # Only the index and deltas, named as make_delta.py names them, and nothing from anywhere else on the disk.
+        if name != 'index.json' and not (name.endswith('.delta') and name[:-6]
+                                         and all(c in '0123456789abcdef-' for c in name[:-6])):
+            return None
+        path = os.path.join(self.server.deltas, name)
+        if not os.path.isfile(path):
+            return None
+        content_type = 'application/json' if name == 'index.json' else 'application/octet-stream'
+        return path, {'filename': name, 'content_type': content_type}
+
+    def do_HEAD(self):
+        delta = self.delta()
+        if delta is not None:
+            self.send_file(*delta, head=True)
+            return
+        url = self.upstream_url()
+        if url is None:
+            return
+        cached = self.server.mirror.cached(url)
+        if cached is not None:
+            self.send_file(*cached, head=True)
+            return
+        # Clients HEAD files to find out how big they are before deciding what to download first.  Downloading the
+        # whole thing to answer that would hold them up, so just ask upstream.
+        try:
+            meta = self.server.mirror.head(url)
+        except urllib.error.HTTPError as e:
+            self.send_error(404 if e.code == 404 else 502)
+            return
+        except OSError:
+            self.send_error(502)
+            return
+        self.send_response(200)
+        self.send_metadata(meta, meta['size'])
+        self.end_headers()
+
+    def do_GET(self):
+        delta = self.delta()
+        if delta is not None:
+            self.send_file(*delta)
+            return
+        url = self.upstream_url()
+        if url is None:
+            return
+        got = self.server.mirror.get(url)
+        try:
+            if isinstance(got, Fill):
+                meta = got.wait_for_meta()
+                if not meta['size']:
+                    # Upstream didn't say how long it is, so nor can we until we've got all of it.
+                    got.wait()
+        except urllib.error.HTTPError as e:
+            self.send_error(404 if e.code == 404 else 502)
+            return
+        except OSError as e:
+            sys.stdout.write('failed to mirror %s: %s\n' % (url, e))
+            self.send_error(502)
+            return
+        if isinstance(got, Fill) and meta['size']:
+            self.send_filling(got, meta)
         else:
-            print('transmitting pack', requestedPack)
-            with open(requestedPack, 'rb') as f:
-                self.connection.sendfile(f)
+            self.send_file(*(self.server.mirror.cached(url) if isinstance(got, Fill) else got))
+
+    def send_metadata(self, meta, length):
+        self.send_header('Content-Type', meta['content_type'])
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        filename = meta['filename'].replace('"', '').replace('\r', '').replace('\n', '')
+        self.send_header('Content-Disposition', 'attachment; filename="%s"' % filename)
+        if meta.get('etag'):
+            self.send_header('ETag', meta['etag'])
+        if meta.get('last_modified'):
+            self.send_header('Last-Modified', meta['last_modified'])
+
+    def send_head(self, meta, size):
+        """
+        Send the status and headers for the size byte file meta describes, going by Range and If-Range.  Returns
+        (start, end) of the part of it to send, or None if there's nothing to send.
+        """
+        start, end = 0, size
+        ranged = self.parse_range(self.headers.get('Range'), size)
+        if_range = self.headers.get('If-Range')
+        if if_range and if_range not in (meta.get('etag'), meta.get('last_modified')):
+            ranged = None  # they've got part of some other version of it, so they need all of this one
+        if ranged == 'unsatisfiable':
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        if ranged is not None:
+            start, end = ranged
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size))
+        else:
+            self.send_response(200)
+        self.send_metadata(meta, end - start)
+        self.end_headers()
+        return start, end
+
+    def send_file(self, path, meta, head=False):
+        with open(path, 'rb') as f:
+            span = self.send_head(meta, os.fstat(f.fileno()).st_size)
+            if not head and span is not None and span[1] > span[0]:
+                try:
+                    self.connection.sendfile(f, span[0], span[1] - span[0])
+                except ConnectionError:
+                    # They had what they needed, e.g. the first stream of a chunked download reaching the next chunk.
+                    self.close_connection = True
+
+    def send_filling(self, fill, meta):
+        # Like send_file(), for a file still on its way from upstream: each piece goes out as soon as it's in.
+        span = self.send_head(meta, meta['size'])
+        if span is None:
+            return
+        pos, end = span
+        with fill.open() as f:
+            try:
+                while pos < end:
+                    available = min(fill.wait_for(pos), end)
+                    self.connection.sendfile(f, pos, available - pos)
+                    pos = available
+            except OSError as e:
+                if not isinstance(e, ConnectionError):
+                    sys.stdout.write('failed to mirror %s: %s\n' % (fill.url, e))
+                # Too late for an error status.  Hanging up short of Content-Length tells them it went wrong, and they
+                # resume from where it got to.
+                self.close_connection = True
+
+    @staticmethod
+    def parse_range(header, size):
+        """(start, end) of a single byte range, None to send the whole thing, or 'unsatisfiable'."""
+        if not header or not header.startswith('bytes=') or ',' in header:
+            return None
+        first, _, last = header[6:].strip().partition('-')
+        try:
+            if not first:
+                start, end = max(size - int(last), 0), size
+            else:
+                start = int(first)
+                end = min(int(last) + 1, size) if last else size
+        except ValueError:
+            return None
+        if start >= size or end <= start:
+            return 'unsatisfiable'
+        return start, end
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MirrorServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, index, directory=MIRROR_DIR, deltas=DELTA_DIR):
+        self.index = index
+        self.mirror = Mirror(directory)
+        self.deltas = deltas
+        super().__init__(address, MirrorHandler)
+
 
 if __name__=='__main__':
-    socketserver.TCPServer(('',21617), Handler).serve_forever()
\ No newline at end of file
+    port = PORT
+    mirror_port = None
+    mirror_dir = MIRROR_DIR
+    delta_dir = DELTA_DIR
+    for arg in sys.argv[1:]:
+        if arg.startswith('--port='):
+            port = int(arg[7:])
+        elif arg.startswith('--upstream='):
+            UPSTREAM = arg[11:].rstrip('/')
+        elif arg == '--mirror':
+            mirror_port = MIRROR_PORT
+        elif arg.startswith('--mirror='):
+            mirror_port = int(arg[9:])
+        elif arg.startswith('--mirror-dir='):
+            mirror_dir = arg[13:]
+        elif arg.startswith('--delta-dir='):
+            delta_dir = arg[12:]
+        else:
+            print('Usage: server.py [--port=PORT] [--mirror[=PORT]] [--mirror-dir=DIR] [--delta-dir=DIR]')
+            print('                 [--upstream=URL]')
+            print('Serves every .csv in the current directory on port %d.  With --mirror, also runs a' % PORT)
+            print('caching HTTP mirror (port %d by default, files kept in %s/) that clients on the' % (MIRROR_PORT, MIRROR_DIR))
+            print('LAN download mods through instead of each fetching them from the internet.')
+            print('The mirror also serves the deltas make_delta.py has put in --delta-dir (default')
+            print('%s/), which clients patch the files they already have up to date with.' % DELTA_DIR)
+            print('Clients running SwordfishPDS.py --daemon stay connected, and are sent each pack they')
+            print('watch again as soon as its file changes.')
+            print('--upstream replaces %s as where the mirror gets /files/ from.' % UPSTREAM)
+            exit()
+    server = PackServer(('', port), mirror_port=mirror_port)
+    if mirror_port is not None:
+        mirror = MirrorServer(('', mirror_port), server.index, mirror_dir, delta_dir)
+        threading.Thread(target=mirror.serve_forever, daemon=True).start()
+    server.serve_forever()
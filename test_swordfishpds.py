@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+"""
+Tests for SwordfishPDS.py (and the server.py it talks to) that don't need the internet: MODs are served by a local
+stand-in for media.forgecdn.net, which the client is pointed at as its mirror.
+
+    python -m unittest test_swordfishpds
+"""
+import contextlib
+import functools
+import hashlib
+import http.client
+import http.server
+import io
+import json
+import os
+import shutil
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+import urllib.request
+import zipfile
+import zlib
+
+import SwordfishPDS
+import make_delta
+import resolve_mods
+import server
+
+
+class StandInCDN(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, files):
+        """
+        Serves files (path -> bytes) on localhost, counting the requests it gets in requests (and keeping their
+        headers in headers).  It honours Range, with If-Range against etag, unless ranges is set False; and if cut is
+        set, the next response is cut off after that many bytes of body.  delay is how long it takes to answer, and
+        drip how long between each 64 KiB of the body.
+        """
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.files = files
+        self.requests = []
+        self.headers = []
+        self.etag = '"1"'
+        self.ranges = True
+        self.bare_416 = False  # whether to leave the length out of 416s
+        self.cut = None
+        self.delay = 0
+        self.drip = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):  # clients hanging up on us is half the point
+            super().handle_error(request, client_address)
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        server = self.server
+        server.requests.append((self.command, self.path))
+        server.headers.append(self.headers)
+        time.sleep(server.delay)
+        body = server.files.get(self.path.partition('?')[0])
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        status, first, last = 200, 0, len(body)
+        wanted = self.headers.get('Range') if server.ranges else None
+        if wanted and self.headers.get('If-Range', server.etag) == server.etag:
+            start, _, end = wanted.partition('=')[2].partition('-')
+            if int(start) >= len(body):
+                self.send_response(416)
+                if not server.bare_416:
+                    self.send_header('Content-Range', 'bytes */%d' % len(body))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status, first, last = 206, int(start), int(end) + 1 if end else len(body)
+        self.send_response(status)
+        self.send_header('ETag', server.etag)
+        if server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (first, last - 1, len(body)))
+        self.send_header('Content-Length', str(last - first))
+        self.end_headers()
+        if head:
+            return
+        if server.cut is not None:
+            self.wfile.write(body[first:first + server.cut])
+            server.cut = None
+            self.close_connection = True
+            return
+        step = 65536 if server.drip else max(last - first, 1)
+        for pos in range(first, last, step):
+            self.wfile.write(body[pos:min(pos + step, last)])
+            self.wfile.flush()
+            time.sleep(server.drip)
+
+
+class SmallModIDTest(unittest.TestCase):
+    # CurseForge file IDs under 1000 live at /files/0/<id>/; they're known by the ID as written everywhere else.
+    JAR = b'PK\x05\x06' + bytes(18)  # an empty zip
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cdn = StandInCDN({'/files/0/123/tiny-1.0.jar': self.JAR})
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.addCleanup(self.cdn.server_close)
+        self.addCleanup(self.cdn.shutdown)
+        self.installer = SwordfishPDS.Installer(use_cache=True, cache_dir=os.path.join(self.tmp, 'cache'),
+                                                mirror=self.cdn.url, cookies=False, deltas=False, hedge=False,
+                                                surplus='leave', trace_file=False, progress_json=False,
+                                                stream=io.StringIO())
+
+    def install(self, name):
+        outdir = os.path.join(self.tmp, name)
+        os.makedirs(outdir, exist_ok=True)
+        self.assertTrue(self.installer.run(io.StringIO('MOD,123,tiny-1.0.jar\nVersion,1.0.0\n'), outdir))
+        return outdir
+
+    def test_sources_agree(self):
+        self.assertEqual(SwordfishPDS.row_source(['MOD', '123', 'tiny-1.0.jar']), SwordfishPDS.mod_source(123))
+        self.assertEqual(SwordfishPDS.mod_source('0000123'), 'cf:123')
+
+    def test_reinstall_is_a_no_op(self):
+        outdir = self.install('instance')
+        with open(os.path.join(outdir, '.minecraft', 'mods', 'tiny-1.0.jar'), 'rb') as f:
+            self.assertEqual(f.read(), self.JAR)
+        lock = SwordfishPDS.PackLock(outdir)
+        self.assertEqual([entry['source'] for entry in lock.files.values()], ['cf:123'])
+        del self.cdn.requests[:]
+        self.install('instance')
+        self.assertEqual(self.cdn.requests, [])
+
+    def test_second_instance_comes_from_the_cache(self):
+        self.install('first')
+        del self.cdn.requests[:]
+        outdir = self.install('second')
+        self.assertTrue(os.path.exists(os.path.join(outdir, '.minecraft', 'mods', 'tiny-1.0.jar')))
+        self.assertEqual(self.cdn.requests, [])
+
+
+class SharedCacheTest(unittest.TestCase):
+    # Installers sharing a mod cache put the same objects in place at the same time.
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def hammer(self, put, threads=8):
+        errors = []
+        start = threading.Barrier(threads)
+
+        def work(i):
+            src = os.path.join(self.tmp, 'mod%d.jar' % i)
+            with open(src, 'wb') as f:
+                f.write(b'the same mod' * 10000)
+            start.wait()
+            for _ in range(100):
+                try:
+                    put(src)
+                except Exception as e:
+                    errors.append(e)
+        workers = [threading.Thread(target=work, args=(i,)) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+
+    def leftovers(self):
+        return [name for _, _, names in os.walk(self.tmp) for name in names if name.endswith('-tmp')]
+
+    def test_link_or_copy(self):
+        dst = os.path.join(self.tmp, 'object')
+        self.hammer(lambda src: SwordfishPDS.link_or_copy(src, dst))
+        with open(dst, 'rb') as f:
+            self.assertEqual(f.read(), b'the same mod' * 10000)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_mod_cache_add(self):
+        root = os.path.join(self.tmp, 'cache')
+        caches = [SwordfishPDS.ModCache(root), SwordfishPDS.ModCache(root)]
+        self.hammer(lambda src: caches[hash(src) % 2].add('cf:1', src))
+        self.assertEqual(self.leftovers(), [])
+
+
+class DeadHostTest(unittest.TestCase):
+    def test_breaker_gives_up(self):
+        breaker = SwordfishPDS.CircuitBreaker(threshold=2, cooldown=0, give_up=2)
+        key = ('http', 'example.invalid')
+        for _ in range(2):
+            breaker.allow(key)
+            breaker.record(key, False)
+        for _ in range(2):  # the request let through to see if it's back fails, twice
+            breaker.allow(key)
+            breaker.record(key, False)
+        with self.assertRaises(SwordfishPDS.CircuitOpen) as cm:
+            breaker.allow(key)
+        self.assertIsNone(cm.exception.retry_after)
+        self.assertIsNone(SwordfishPDS.RetryPolicy(retries=10).wait(0, cm.exception))
+
+    def test_retry_policy(self):
+        policy = SwordfishPDS.RetryPolicy(retries=2, delay=1, max_delay=4)
+        self.assertIsNotNone(policy.wait(0, ConnectionRefusedError()))
+        self.assertIsNone(policy.wait(2, ConnectionRefusedError()))
+        not_found = types.SimpleNamespace(status=404, reason='Not Found', getheader=lambda name: None)
+        self.assertIsNone(policy.wait(0, SwordfishPDS.DownloadError(not_found)))
+        self.assertEqual(policy.wait(0, SwordfishPDS.CircuitOpen(('http', 'example.invalid'), 3)), 3)
+        self.assertIsNone(policy.wait(0, SwordfishPDS.CircuitOpen(('http', 'example.invalid'), 5)))
+
+    def test_install_fails_fast(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]  # nothing's listening once it's closed
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        pack = ''.join('Download,http://127.0.0.1:%d/mod%d.jar,.minecraft/mods/mod%d.jar\n' % (port, i, i)
+                       for i in range(8)) + 'Version,1.0.0\n'
+        installer = SwordfishPDS.Installer(use_cache=False, mirror=False, cookies=False, deltas=False, hedge=False,
+                                           surplus='leave', trace_file=False, progress_json=False,
+                                           stream=io.StringIO(), retries=100, retry_delay=0.01, retry_max_delay=1,
+                                           breaker_cooldown=0.2)
+        started = time.monotonic()
+        self.assertFalse(installer.run(io.StringIO(pack), tmp))
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertIn('giving up on it', installer.stream.getvalue())
+
+
+class ResumeTest(unittest.TestCase):
+    BODY = bytes(range(256)) * 1000
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cdn = StandInCDN({'/mod.jar': self.BODY})
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.addCleanup(self.cdn.server_close)
+        self.addCleanup(self.cdn.shutdown)
+        self.pool = SwordfishPDS.ConnectionPool()
+        self.addCleanup(self.pool.close)
+        self.pool.chunks = 1
+        self.dest = os.path.join(self.tmp, 'mod.jar')
+
+    def fetch(self):
+        return SwordfishPDS.fetch_file(self.pool, self.cdn.url + 'mod.jar', self.dest)
+
+    def cut_short(self):
+        self.cdn.cut = 100000
+        with self.assertRaises(http.client.IncompleteRead):
+            self.fetch()
+        self.assertFalse(os.path.exists(self.dest))
+        del self.cdn.headers[:]
+
+    def assertFetched(self):
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), self.BODY)
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+
+    def test_resume(self):
+        self.cut_short()
+        self.assertEqual(self.fetch(), self.dest)
+        self.assertFetched()
+        self.assertEqual([(h['Range'], h['If-Range']) for h in self.cdn.headers], [('bytes=100000-255999', '"1"')])
+
+    def test_file_changed(self):
+        self.cut_short()
+        self.cdn.etag = '"2"'
+        self.fetch()
+        self.assertFetched()
+        self.assertEqual([h['Range'] for h in self.cdn.headers], ['bytes=100000-255999', None])
+
+    def test_server_ignores_range(self):
+        self.cut_short()
+        self.cdn.ranges = False
+        self.fetch()
+        self.assertFetched()
+
+    def test_already_there(self):
+        with open(self.dest, 'wb') as f:
+            f.write(self.BODY)
+        self.assertIsNone(self.fetch())
+        self.assertEqual(len(self.cdn.requests), 1)
+
+    def test_416_without_a_length(self):
+        # Says nothing about what's there, which is the right length but not the right file.
+        with open(self.dest, 'wb') as f:
+            f.write(bytes(len(self.BODY)))
+        self.cdn.bare_416 = True
+        self.assertEqual(self.fetch(), self.dest)
+        self.assertFetched()
+
+
+class PackServerTest(unittest.TestCase):
+    PACK = b'MOD,123,tiny-1.0.jar\nVersion,1.0.0\n'
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        with open(os.path.join(self.tmp, 'tiny.csv'), 'wb') as f:
+            f.write(self.PACK)
+        self.outdir = os.path.join(self.tmp, 'instance')
+        os.makedirs(self.outdir)
+        quiet = contextlib.redirect_stdout(io.StringIO())  # both ends print what they're up to
+        quiet.__enter__()
+        self.addCleanup(quiet.__exit__, None, None, None)
+
+    def serve(self, server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server.server_address
+
+    def test_handshake(self):
+        address = self.serve(server.PackServer(('127.0.0.1', 0), self.tmp, mirror_port=1234))
+        for expected in ('OK', 'UNCHANGED'):
+            f, packs = SwordfishPDS._list_packs(address)
+            self.assertEqual(packs, ['tiny'])
+            with f:
+                SwordfishPDS.request_pack(f, 'tiny', self.outdir)
+                status, extras = SwordfishPDS.read_pack(f, self.outdir)
+            self.assertEqual(status, expected)
+            self.assertEqual(extras, {'mirror': 'http://127.0.0.1:1234/', 'deltas': 'http://127.0.0.1:1234/deltas/'})
+            with open(os.path.join(self.outdir, 'SwordfishPDS-Pack.csv'), 'rb') as saved:
+                self.assertEqual(saved.read(), self.PACK)
+
+    def test_old_client(self):
+        address = self.serve(server.PackServer(('127.0.0.1', 0), self.tmp))
+        with socket.create_connection(address) as s, s.makefile('rwb') as f:
+            self.assertEqual(f.readline(), b'tiny\n')
+            self.assertEqual(f.readline(), b'\n')
+            f.write(b'tiny\n')
+            f.flush()
+            self.assertEqual(f.read(), self.PACK)
+
+    def test_old_server(self):
+        class OldHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.wfile.write(b'tiny\n\n')
+                self.rfile.readline()  # not the name of a pack, so hang up
+        address = self.serve(socketserver.TCPServer(('127.0.0.1', 0), OldHandler))
+        f, packs = SwordfishPDS._list_packs(address)
+        self.assertIsNone(SwordfishPDS.fetch_pack(f, 'tiny', self.outdir))
+
+    def test_cut_short(self):
+        body = zlib.compress(self.PACK)
+        answer = ('%s OK %d -\n' % (SwordfishPDS.PROTOCOL, len(body))).encode('ascii')
+        with self.assertRaises(ConnectionError):
+            SwordfishPDS.read_pack(io.BytesIO(answer + body[:-1]), self.outdir)
+        with self.assertRaises(SwordfishPDS.PackError):
+            SwordfishPDS.read_pack(io.BytesIO(answer + bytes(len(body))), self.outdir)
+        with self.assertRaises(SwordfishPDS.PackError):
+            SwordfishPDS.read_pack(io.BytesIO(b'%s OK\n' % SwordfishPDS.PROTOCOL.encode('ascii')), self.outdir)
+
+    def test_extras_follow_the_server(self):
+        installer = SwordfishPDS.Installer(mirror=None, deltas=False)
+        installer.take_extras({'mirror': 'http://a/'})
+        self.assertEqual(installer.mirror, 'http://a/')
+        installer.take_extras({'mirror': 'http://b/'})
+        self.assertEqual(installer.mirror, 'http://b/')
+        installer.take_extras({})
+        self.assertIsNone(installer.mirror)
+        self.assertIsNone(installer.deltas)
+        self.assertEqual(SwordfishPDS.Installer(mirror='http://mine/').take_extras({'mirror': 'http://a/'}).mirror,
+                         'http://mine/')
+
+
+class MirrorTest(unittest.TestCase):
+    BODY = bytes(range(256)) * 2048
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.upstream = StandInCDN({'/files/1/2/big.jar': self.BODY, '/mod.jar': self.BODY})
+        self.addCleanup(self.upstream.server_close)
+        self.addCleanup(self.upstream.shutdown)
+        quiet = contextlib.redirect_stdout(io.StringIO())
+        quiet.__enter__()
+        self.addCleanup(quiet.__exit__, None, None, None)
+
+    def test_slow_upstream(self):
+        # A whole second of upstream, but never more than a tenth of one between pieces, so a client that gives up
+        # after half a second of silence still gets it -- as does one that asks while it's on its way.
+        self.upstream.drip = 0.1
+        mirror = server.MirrorServer(('127.0.0.1', 0), server.PackIndex(self.tmp), os.path.join(self.tmp, 'mirror'))
+        threading.Thread(target=mirror.serve_forever, daemon=True).start()
+        self.addCleanup(mirror.server_close)
+        self.addCleanup(mirror.shutdown)
+        old_upstream, server.UPSTREAM = server.UPSTREAM, self.upstream.url.rstrip('/')
+        self.addCleanup(setattr, server, 'UPSTREAM', old_upstream)
+        url = 'http://127.0.0.1:%d/files/1/2/big.jar' % mirror.server_address[1]
+        got = []
+
+        def fetch(headers={}):
+            req = urllib.request.Request(url, headers=headers)
+            with urllib.request.urlopen(req, timeout=0.5) as resp:
+                got.append((resp.status, resp.read()))
+        clients = [threading.Thread(target=fetch)]
+        clients[0].start()
+        time.sleep(0.3)
+        clients.append(threading.Thread(target=fetch, args=({'Range': 'bytes=100-'},)))
+        clients[1].start()
+        for client in clients:
+            client.join()
+        self.assertEqual(sorted(got), [(200, self.BODY), (206, self.BODY[100:])])
+        fetch()
+        self.assertEqual(len(self.upstream.requests), 1)
+
+    def test_mirror_timing_out(self):
+        mirror = StandInCDN({'/fetch': self.BODY})
+        self.addCleanup(mirror.server_close)
+        self.addCleanup(mirror.shutdown)
+        mirror.delay = 1
+        pool = SwordfishPDS.ConnectionPool(mirror=mirror.url)
+        pool.timeout = 0.5
+        self.addCleanup(pool.close)
+        with pool.request('GET', self.upstream.url + 'mod.jar') as resp:
+            self.assertFalse(resp.mirrored)
+            self.assertEqual(resp.read(), self.BODY)
+        self.assertEqual(pool.mirror, mirror.url)
+        mirror.delay = 0
+        with pool.request('GET', self.upstream.url + 'mod.jar') as resp:
+            self.assertTrue(resp.mirrored)
+
+
+class ResolveModsTest(unittest.TestCase):
+    # Trimmed down CurseForge pages in fixtures/curseforge, served as they would be from www.curseforge.com.
+    FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'curseforge')
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        handler = functools.partial(QuietFileHandler, directory=self.FIXTURES)
+        self.site = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.site.daemon_threads = True
+        threading.Thread(target=self.site.serve_forever, daemon=True).start()
+        self.addCleanup(self.site.server_close)
+        self.addCleanup(self.site.shutdown)
+        self.base_url = 'http://127.0.0.1:%d' % self.site.server_address[1]
+        for name, value in (('BASE_URL', self.base_url), ('CACHE_DIR', os.path.join(self.tmp, 'cache'))):
+            self.addCleanup(setattr, resolve_mods, name, getattr(resolve_mods, name))
+            setattr(resolve_mods, name, value)
+
+    def test_resolve(self):
+        self.assertEqual(resolve_mods.resolve('jei'), ('2995021', 'jei_1.12.2-4.16.1.301.jar'))
+
+    def test_no_files(self):
+        with self.assertRaisesRegex(resolve_mods.ResolveError, 'no files for 1.7.10'):
+            resolve_mods.resolve('empty@1.7.10')
+
+    def test_no_filename_label(self):
+        with self.assertRaisesRegex(resolve_mods.ResolveError, 'no filename on .*/nolabel/files/123'):
+            resolve_mods.resolve('nolabel')
+
+    def test_command_line(self):
+        result = subprocess.run([sys.executable, resolve_mods.__file__, '--base-url=' + self.base_url,
+                                 '--cache-dir=' + os.path.join(self.tmp, 'cli-cache'), 'jei', 'empty', 'missing'],
+                                capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.stdout, 'MOD,2995021,jei_1.12.2-4.16.1.301.jar\n')
+        self.assertEqual([line.partition(':')[0] for line in result.stderr.splitlines()], ['empty', 'missing'])
+        self.assertEqual(result.returncode, 1)
+
+
+class QuietFileHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def make_jar(members):
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as jar:
+        for name, data in members:
+            jar.writestr(zipfile.ZipInfo(name, (2020, 1, 1, 0, 0, 0)), data)
+    return out.getvalue()
+
+
+class InstallTest(unittest.TestCase):
+    # Installs Download rows from a StandInCDN with nothing but the lock file to go on.
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.cdn = StandInCDN({})
+        self.addCleanup(self.cdn.server_close)
+        self.addCleanup(self.cdn.shutdown)
+        self.outdir = os.path.join(self.tmp, 'instance')
+        os.makedirs(self.outdir)
+
+    def installer(self, **settings):
+        return SwordfishPDS.Installer(**dict(dict(use_cache=False, mirror=False, cookies=False, deltas=False,
+                                                  hedge=False, surplus='leave', trace_file=False, progress_json=False,
+                                                  stream=io.StringIO()), **settings))
+
+    def install(self, files, version='1.0.0', installer=None):
+        # files is {filename in mods: (path on the CDN, contents)}
+        pack = ''
+        for filename, (path, data) in sorted(files.items()):
+            self.cdn.files[path] = data
+            pack += 'Download,%s,.minecraft/mods/%s\n' % (self.cdn.url + path.lstrip('/'), filename)
+        self.assertTrue((installer or self.installer()).run(io.StringIO(pack + 'Version,%s\n' % version),
+                                                             self.outdir))
+        return pack
+
+    def mod(self, filename):
+        return os.path.join(self.outdir, '.minecraft', 'mods', filename)
+
+    def read(self, filename):
+        with open(self.mod(filename), 'rb') as f:
+            return f.read()
+
+
+class LockTest(InstallTest):
+    FILES = {'a.jar': ('/a-1.0.jar', b'a' * 1000), 'b.jar': ('/b-1.0.jar', b'b' * 2000)}
+
+    def setUp(self):
+        super().setUp()
+        self.pack = self.install(self.FILES)
+        del self.cdn.requests[:]
+
+    def is_installed(self):
+        pack = SwordfishPDS.Pack.load(self.pack.encode('ascii'))
+        mods_dir = os.path.join(self.outdir, '.minecraft', 'mods')
+        reconciler = SwordfishPDS.Reconciler(self.outdir, mods_dir)
+        return SwordfishPDS.is_installed(pack.rows, self.outdir, mods_dir, SwordfishPDS.PackLock(self.outdir),
+                                         reconciler)
+
+    def test_nothing_to_do(self):
+        self.assertTrue(self.is_installed())
+        self.install(self.FILES)
+        self.assertEqual(self.cdn.requests, [])
+
+    def test_changed_file(self):
+        with open(self.mod('a.jar'), 'wb') as f:
+            f.write(b'not a')
+        self.assertFalse(self.is_installed())
+        self.install(self.FILES)
+        self.assertEqual(self.read('a.jar'), b'a' * 1000)
+        self.assertIn(('GET', '/a-1.0.jar'), self.cdn.requests)
+
+    def test_same_size_but_touched(self):
+        with open(self.mod('b.jar'), 'wb') as f:
+            f.write(b'c' * 2000)
+        self.assertFalse(self.is_installed())
+        self.install(self.FILES)
+        self.assertEqual(self.read('b.jar'), b'b' * 2000)
+        self.assertTrue(self.is_installed())
+
+    def test_deleted_file(self):
+        os.unlink(self.mod('b.jar'))
+        self.assertFalse(self.is_installed())
+        self.install(self.FILES)
+        self.assertEqual(self.read('b.jar'), b'b' * 2000)
+
+
+class DeltaTest(InstallTest):
+    CLASSES = os.urandom(200000)  # stands in for most of a mod, which doesn't change from one version to the next
+    OLD = make_jar([('Big.class', CLASSES), ('Version.class', b'1.0')])
+    NEW = make_jar([('Big.class', CLASSES), ('Version.class', b'1.1'), ('New.class', b'new')])
+
+    def test_round_trip(self):
+        delta = make_delta.make_delta(self.OLD, self.NEW)
+        self.assertLess(len(delta), len(self.NEW) // 10)
+        old_path, path = os.path.join(self.tmp, 'old.jar'), os.path.join(self.tmp, 'new.jar')
+        with open(old_path, 'wb') as f:
+            f.write(self.OLD)
+        self.assertEqual(SwordfishPDS.apply_delta(delta, old_path, path), hashlib.sha256(self.NEW).hexdigest())
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.NEW)
+        for broken in (delta[:-1] + bytes([delta[-1] ^ 1]), SwordfishPDS.DELTA_MAGIC + b'junk', b'junk'):
+            os.unlink(path)
+            with self.assertRaises(SwordfishPDS.DeltaError):
+                SwordfishPDS.apply_delta(broken, old_path, path)
+            self.assertFalse(os.path.exists(path))
+            open(path, 'wb').close()
+
+    def test_update(self):
+        self.install({'mod.jar': ('/mod-1.0.jar', self.OLD)})
+        delta = make_delta.make_delta(self.OLD, self.NEW)
+        name = '%s-%s.delta' % (hashlib.sha256(self.OLD).hexdigest(), hashlib.sha256(self.NEW).hexdigest())
+        self.cdn.files['/deltas/index.json'] = json.dumps(
+            {self.cdn.url + 'mod-1.1.jar': {hashlib.sha256(self.OLD).hexdigest(): name}}).encode('ascii')
+        self.cdn.files['/deltas/' + name] = delta
+        del self.cdn.requests[:]
+        self.install({'mod.jar': ('/mod-1.1.jar', self.NEW)}, '1.0.1', self.installer(deltas=self.cdn.url + 'deltas/'))
+        self.assertEqual(self.read('mod.jar'), self.NEW)
+        self.assertNotIn(('GET', '/mod-1.1.jar'), self.cdn.requests)
+        self.assertIn(('GET', '/deltas/' + name), self.cdn.requests)
+
+
+if __name__ == '__main__':
+    unittest.main()